@@ -0,0 +1,215 @@
+import sys
+import time
+
+import numpy as np
+
+from program_loader import ProgramLoader
+from isa_encoder import encodeStoreWords
+from isa_model import BUFFER_SIZE
+
+
+# unified buffer bandwidth test and snapshot dump/restore over ProgramLoader
+#
+#   test     pattern-fill all 512 words, dump them back, verify, report TX/RX bytes/s
+#   dump     save the buffer to a snapshot file (.npz)
+#   restore  write a snapshot back (and dump it again to verify)
+#
+# writes are one immediate STORE per word (6 TX bytes) sent without the loader's
+# per-chunk pacing, so the write rate is the link's and not the host's sleeps;
+# dumps are FETCH bursts (4 TX bytes and 2 RX bytes per word). only the buffer
+# is visible through the ISA, so a snapshot does not include the PE array registers
+
+# fill patterns, each (count, rng) -> uint16 words
+PATTERNS = {
+    'zeros': lambda n, rng: np.zeros(n, dtype=np.uint16),
+    'ones': lambda n, rng: np.full(n, 0xFFFF, dtype=np.uint16),
+    'checker': lambda n, rng: np.where(np.arange(n) % 2, 0xAAAA, 0x5555).astype(np.uint16),
+    'walking': lambda n, rng: (1 << (np.arange(n) % 16)).astype(np.uint16),
+    'address': lambda n, rng: np.arange(n, dtype=np.uint16),
+    'random': lambda n, rng: rng.integers(0, 1 << 16, n, dtype=np.uint16),
+}
+
+
+# mismatching words and flipped bits between what was written and read back
+# a short read counts every missing word as a mismatch
+def compare_words(expected, received):
+    expected = np.asarray(expected, dtype=np.uint16)
+    received = np.asarray(received, dtype=np.uint16)
+    n = min(len(expected), len(received))
+    diff = expected[:n] ^ received[:n]
+    bad = np.flatnonzero(diff)
+    return {
+        'words': len(expected),
+        'received': len(received),
+        'mismatches': len(bad) + len(expected) - n,
+        'bit_errors': int(np.unpackbits(diff.view(np.uint8)).sum()),
+        'first_bad': bad[:8].tolist(),
+    }
+
+
+# link time and bytes of one transfer
+class Transfer:
+
+    def __init__(self, loader):
+        self.loader = loader
+
+    def __enter__(self):
+        self.tx = self.loader.txBytes
+        self.rx = self.loader.rxBytes
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.seconds = time.perf_counter() - self.start
+        self.tx = self.loader.txBytes - self.tx
+        self.rx = self.loader.rxBytes - self.rx
+        return False
+
+    def rate(self, count):
+        return count / self.seconds if self.seconds else 0.0
+
+
+# write words from base_addr, returns the Transfer (only the send is timed)
+def write_words(loader, words, base_addr=0):
+    program = encodeStoreWords(base_addr, words)
+    with Transfer(loader) as t:
+        loader.sendProgram(program, pace=False)
+    return t
+
+
+# dump num_words words from base_addr, returns (words, Transfer)
+def dump_words(loader, num_words=BUFFER_SIZE, base_addr=0, burst_words=None):
+    with Transfer(loader) as t:
+        words = loader.dumpBuffer(base_addr, num_words, burst_words)
+    return words, t
+
+
+def save_snapshot(path, words, base_addr=0):
+    np.savez(path, words=np.asarray(words, dtype=np.uint16), base_addr=base_addr)
+
+
+# (words, base_addr) of a snapshot file
+def load_snapshot(path):
+    with np.load(path) as data:
+        words = data['words'].astype(np.uint16)
+        base_addr = int(data['base_addr'])
+    if base_addr + len(words) > BUFFER_SIZE:
+        raise ValueError(f"{path}: {len(words)} words at 0x{base_addr:03X} do not fit the buffer")
+    return words, base_addr
+
+
+# fill, dump and verify every pattern `rounds` times
+# returns (results per pattern, total write/dump Transfers)
+def bandwidth_test(loader, patterns, rounds=1, burst_words=None, seed=0):
+    rng = np.random.default_rng(seed)
+    results = []
+    for _ in range(rounds):
+        for name in patterns:
+            words = PATTERNS[name](BUFFER_SIZE, rng)
+            write = write_words(loader, words)
+            received, dump = dump_words(loader, burst_words=burst_words)
+            results.append((name, write, dump, compare_words(words, received)))
+    return results
+
+
+def report_bandwidth(results, baud=None):
+    print(f"\n  {'pattern':<8} {'write TX B/s':>12} {'dump TX B/s':>12} {'dump RX B/s':>12}  verify")
+    for name, write, dump, check in results:
+        status = 'ok' if check['mismatches'] == 0 else \
+            f"{check['mismatches']} bad words, {check['bit_errors']} bit errors, first {check['first_bad']}"
+        print(f"  {name:<8} {write.rate(write.tx):>12.0f} {dump.rate(dump.tx):>12.0f} {dump.rate(dump.rx):>12.0f}  "
+              f"{status}")
+
+    tx = sum(w.tx + d.tx for _, w, d, _ in results)
+    rx = sum(d.rx for _, _, d, _ in results)
+    write_seconds = sum(w.seconds for _, w, _, _ in results)
+    dump_seconds = sum(d.seconds for _, _, d, _ in results)
+    seconds = write_seconds + dump_seconds
+    print(f"\nSustained: TX {tx / seconds:.0f} B/s, RX {rx / dump_seconds:.0f} B/s during dumps "
+          f"({tx} / {rx} bytes in {seconds:.2f} s)")
+    if baud:
+        print(f"Wire rate at {baud} baud: {baud / 10:.0f} B/s each way "
+              f"(TX at {100 * tx / seconds / (baud / 10):.1f}%)")
+    return all(check['mismatches'] == 0 for _, _, _, check in results)
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='uTPU unified buffer bandwidth test and snapshot tool')
+    parser.add_argument('action', choices=['test', 'dump', 'restore'])
+    parser.add_argument('file', nargs='?', default=None, help='Snapshot file (.npz) for dump/restore')
+    parser.add_argument('--port', '-p', type=str, default=None, help='Serial port, e.g. /dev/ttyUSB1')
+    parser.add_argument('--loopback', action='store_true', help='Run against the host ISA model instead of a board')
+    parser.add_argument('--baud', '-b', type=int, default=115200)
+    parser.add_argument('--patterns', type=str, default=','.join(PATTERNS),
+                        help='Comma-separated fill patterns: ' + ', '.join(PATTERNS))
+    parser.add_argument('--rounds', type=int, default=1)
+    parser.add_argument('--burst', type=int, default=ProgramLoader.DUMP_BURST_WORDS, help='Words per FETCH burst')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--no-verify', action='store_true', help='restore: skip the read-back check')
+    parser.add_argument('--verbose', '-v', action='store_true')
+    args = parser.parse_args()
+
+    if args.action != 'test' and args.file is None:
+        parser.error(f"{args.action} needs a snapshot file")
+    if not args.loopback and args.port is None:
+        parser.error("give --port or --loopback")
+    patterns = [p.strip() for p in args.patterns.split(',') if p.strip()]
+    unknown = [p for p in patterns if p not in PATTERNS]
+    if unknown:
+        parser.error(f"unknown patterns {unknown}")
+
+    print("=" * 60)
+    print("uTPU Buffer Tool")
+    print("=" * 60)
+
+    if args.loopback:
+        from loopback_uart import LoopbackUART
+        uart = LoopbackUART(baud=args.baud)
+    else:
+        from uart_driver import UARTDriver
+        uart = UARTDriver(args.port, baud=args.baud)
+    loader = ProgramLoader(uart, args.verbose)
+    uart.flush_input()
+
+    status = 0
+    try:
+        if args.action == 'test':
+            print(f"{len(patterns)} patterns x {args.rounds} rounds over {BUFFER_SIZE} words, "
+                  f"bursts of {args.burst} words ({uart.port})")
+            results = bandwidth_test(loader, patterns, args.rounds, args.burst, args.seed)
+            ok = report_bandwidth(results, args.baud)
+            print("\n✓ All patterns verified" if ok else "\n✗ Read-back mismatches")
+            status = 0 if ok else 1
+
+        elif args.action == 'dump':
+            words, t = dump_words(loader, burst_words=args.burst)
+            if len(words) < BUFFER_SIZE:
+                print(f"✗ Dump incomplete: {len(words)}/{BUFFER_SIZE} words")
+                status = 1
+            else:
+                save_snapshot(args.file, words)
+                print(f"Dumped {len(words)} words to {args.file} in {t.seconds:.2f} s "
+                      f"(RX {t.rate(t.rx):.0f} B/s)")
+
+        else:
+            words, base_addr = load_snapshot(args.file)
+            t = write_words(loader, words, base_addr)
+            print(f"Restored {len(words)} words at 0x{base_addr:03X} in {t.seconds:.2f} s "
+                  f"(TX {t.rate(t.tx):.0f} B/s)")
+            if not args.no_verify:
+                received, _ = dump_words(loader, len(words), base_addr, args.burst)
+                check = compare_words(words, received)
+                if check['mismatches']:
+                    print(f"✗ Verify failed: {check['mismatches']} bad words, first {check['first_bad']}")
+                    status = 1
+                else:
+                    print("✓ Verified")
+    finally:
+        uart.close()
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main())
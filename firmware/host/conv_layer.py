@@ -0,0 +1,164 @@
+import numpy as np
+import os
+import sys
+
+
+#im2col conv layers on the NxN array
+#
+#an exported conv layer is its (out, in_channels*k*k) im2col weight matrix plus
+#its geometry (export_weights.py: in_channels, kernel_size, stride, padding,
+#input_size). on the array each kernel row is padded to a multiple of N
+#columns, so every N-wide input operand is N horizontally adjacent pixels of
+#one channel and row. an operand is then fully described by the flat index of
+#its first pixel in the zero-padded input map, and the patch matrix never has
+#to exist: operands are gathered (or STOREd) one tile at a time.
+#neighbouring output positions read overlapping pixel runs, so the same
+#operand word serves several RUNs (see mlp_compiler for the buffer reuse)
+
+
+#output (height, width) of a conv layer
+def conv_output_size(conv):
+    k, s, p = conv['kernel_size'], conv['stride'], conv['padding']
+    return tuple((size + 2 * p - k) // s + 1 for size in conv['input_size'])
+
+
+#kernel row width on the array (kernel_size rounded up to a multiple of N)
+def kernel_row_width(conv, array_size):
+    return -(-conv['kernel_size'] // array_size) * array_size
+
+
+#(channels, height, width) of the zero-padded input map operands are read from
+#wide enough that the padded kernel row of the last output column stays in the row
+def padded_input_shape(conv, array_size):
+    height, width = conv['input_size']
+    p, s = conv['padding'], conv['stride']
+    out_width = conv_output_size(conv)[1]
+    padded_width = max(width + 2 * p, (out_width - 1) * s + kernel_row_width(conv, array_size))
+    return conv['in_channels'], height + 2 * p, padded_width
+
+
+#im2col weight matrix laid out for the array: (out, in_channels * k * row_width)
+#columns of the padded kernel positions are zero
+def im2col_weights(weight, conv, array_size):
+    c, k = conv['in_channels'], conv['kernel_size']
+    width = kernel_row_width(conv, array_size)
+    kernels = np.asarray(weight, dtype=np.int8).reshape(-1, c, k, k)
+    matrix = np.zeros((kernels.shape[0], c, k, width), dtype=np.int8)
+    matrix[..., :k] = kernels
+    return matrix.reshape(kernels.shape[0], -1)
+
+
+#int4 inputs (batch, in_channels*height*width) -> flat padded input maps (batch, C*Hp*Wp)
+def pad_input(inputs, conv, array_size):
+    channels, height, width = padded_input_shape(conv, array_size)
+    rows, cols = conv['input_size']
+    p = conv['padding']
+    padded = np.zeros((len(inputs), channels, height, width), dtype=np.int8)
+    padded[:, :, p:p + rows, p:p + cols] = np.asarray(inputs).reshape(len(inputs), channels, rows, cols)
+    return padded.reshape(len(inputs), -1)
+
+
+#flat start (into the padded map) of the operand of every output position and
+#im2col column tile, shape (positions, column tiles), positions row-major
+def operand_starts(conv, array_size):
+    n = array_size
+    _, height, width = padded_input_shape(conv, n)
+    k, s = conv['kernel_size'], conv['stride']
+    out_height, out_width = conv_output_size(conv)
+    row_tiles = kernel_row_width(conv, n) // n
+
+    #column tile j -> (channel, kernel row, first kernel column)
+    j = np.arange(conv['in_channels'] * k * row_tiles)
+    channel, rest = np.divmod(j, k * row_tiles)
+    ky, tile = np.divmod(rest, row_tiles)
+    offsets = channel * height * width + ky * width + tile * n
+
+    y, x = np.divmod(np.arange(out_height * out_width), out_width)
+    return (y * s * width + x * s)[:, None] + offsets[None, :]
+
+
+#exact int32 conv of int4 inputs (batch, in_features) -> (batch, out*positions),
+#flattened channel-major like torch's x.flatten(1)
+#sums the k*k shifted views of the input, no patch matrix
+def conv_int32(inputs, weight, conv):
+    c, k, s, p = conv['in_channels'], conv['kernel_size'], conv['stride'], conv['padding']
+    rows, cols = conv['input_size']
+    out_height, out_width = conv_output_size(conv)
+    kernels = np.asarray(weight, dtype=np.int32).reshape(-1, c, k, k)
+
+    x = np.zeros((len(inputs), c, rows + 2 * p, cols + 2 * p), dtype=np.int32)
+    x[:, :, p:p + rows, p:p + cols] = np.asarray(inputs).reshape(len(inputs), c, rows, cols)
+
+    accum = np.zeros((len(inputs), kernels.shape[0], out_height, out_width), dtype=np.int32)
+    for ky in range(k):
+        for kx in range(k):
+            view = x[:, :, ky:ky + s * (out_height - 1) + 1:s, kx:kx + s * (out_width - 1) + 1:s]
+            accum += np.einsum('oc,bcyx->boyx', kernels[:, :, ky, kx], view)
+    return accum.reshape(len(inputs), -1)
+
+
+#tiles, STOREs and bytes per image of compiled plans next to their accuracy
+#(numpy backend) on the same images
+def benchmark(plans, images, labels):
+    from mlp_compiler import preprocessImages
+
+    inputs = preprocessImages(images)
+    results = {}
+    for name, plan in plans.items():
+        summary = plan.summary()
+        logits = plan.forward(inputs)
+        results[name] = {
+            'accuracy': float(np.mean(np.argmax(logits, axis=1) == labels)),
+            'runs': sum(layer['runs'] for layer in summary['layers']),
+            'operand_stores': sum(layer['operand_stores'] for layer in summary['layers']),
+            'operand_uses': sum(layer['operand_uses'] for layer in summary['layers']),
+            'tx_bytes': summary['tx_bytes'],
+            'rx_bytes': summary['rx_bytes'],
+            'layers': summary['layers'],
+        }
+    return results
+
+
+def main():
+    import argparse
+    from tiled_inference import load_layers, get_default_paths
+    from mlp_compiler import MLPCompiler, printSummary
+
+    weights_dir, _, data_dir = get_default_paths()
+
+    parser = argparse.ArgumentParser(description='uTPU im2col conv vs fc benchmark')
+    parser.add_argument('--conv', type=str, required=True, help='Exported conv model (train.py --arch conv)')
+    parser.add_argument('--fc', type=str, default=weights_dir, help='Exported fc baseline')
+    parser.add_argument('--data', type=str, default=data_dir)
+    parser.add_argument('--num-samples', type=int, default=1000)
+    parser.add_argument('--verbose', '-v', action='store_true')
+    args = parser.parse_args()
+
+    print("=" * 60)
+    print("uTPU im2col Conv Benchmark")
+    print("=" * 60)
+
+    compiler = MLPCompiler(verbose=args.verbose)
+    plans = {}
+    for name, path in (('fc', args.fc), ('conv', args.conv)):
+        plans[name] = compiler.compile(load_layers(path))
+        print(f"\n{name} ({path}):")
+        printSummary(plans[name].summary())
+
+    images = np.load(os.path.join(args.data, 'mnist_14x14_test.npy'))[:args.num_samples]
+    labels = np.load(os.path.join(args.data, 'test_labels.npy'))[:args.num_samples]
+    results = benchmark(plans, images, labels)
+
+    print(f"\nPer image over {len(labels)} samples:")
+    print(f"  {'model':<6} {'accuracy':>9} {'tiles':>7} {'operand STOREs':>15} {'TX bytes':>9} {'RX bytes':>9}")
+    for name, r in results.items():
+        print(f"  {name:<6} {100 * r['accuracy']:>8.2f}% {r['runs']:>7} "
+              f"{r['operand_stores']:>6}/{r['operand_uses']:<8} {r['tx_bytes']:>9} {r['rx_bytes']:>9}")
+    fc, conv = results['fc'], results['conv']
+    print(f"\nconv/fc: tiles {conv['runs'] / fc['runs']:.2f}x, TX {conv['tx_bytes'] / fc['tx_bytes']:.2f}x, "
+          f"RX {conv['rx_bytes'] / fc['rx_bytes']:.2f}x, accuracy {100 * (conv['accuracy'] - fc['accuracy']):+.2f} pts")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,169 @@
+import json
+import os
+import sys
+
+import numpy as np
+
+
+#per-sample evaluation log (JSON lines), used as the checkpoint of a run
+#every record is flushed as soon as the sample finishes, so an interrupted
+#run resumes from the last complete line
+#the first line holds the run's meta (mode, range, model hash); resuming with
+#different meta raises instead of mixing results of two runs in one log
+class EvalLog:
+
+    def __init__(self, path, meta=None):
+        self.path = path
+        self.records = {}
+        self.meta = None
+
+        if os.path.exists(path):
+            self._load()
+
+        if meta is not None:
+            #compare as stored (tuples come back as lists)
+            meta = json.loads(json.dumps(meta))
+            if self.meta is not None and self.meta != meta:
+                raise ValueError(f"{path} belongs to a different run (log meta {self.meta}, this run {meta})")
+            if self.meta is None and self.records:
+                raise ValueError(f"{path} has records but no run meta, cannot check it belongs to this run")
+
+        self.file = open(path, 'a')
+        if meta is not None and self.meta is None:
+            self._write({'meta': meta})
+            self.meta = meta
+
+    def _load(self):
+        valid = 0
+        with open(self.path, 'rb') as f:
+            for raw in f:
+                if not raw.endswith(b'\n'):
+                    break
+                try:
+                    record = json.loads(raw)
+                except ValueError:
+                    break
+                valid += len(raw)
+                if 'meta' in record and self.meta is None:
+                    self.meta = record['meta']
+                if 'index' in record:
+                    self.records[record['index']] = record
+
+        #drop a torn last line so new records start on a fresh line
+        if valid != os.path.getsize(self.path):
+            with open(self.path, 'r+b') as f:
+                f.truncate(valid)
+
+    def _write(self, record):
+        self.file.write(json.dumps(record) + "\n")
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def done(self, index):
+        return index in self.records
+
+    #record one sample
+    def add(self, index, pred, label, seconds, logits=None):
+        record = {
+            'index': int(index),
+            'pred': int(pred),
+            'label': int(label),
+            'correct': bool(pred == label),
+            'seconds': float(seconds),
+        }
+        if logits is not None:
+            record['logits'] = [float(v) for v in logits]
+        self.records[record['index']] = record
+        self._write(record)
+
+    #(correct, total) over the records with index in indices (all if None)
+    def score(self, indices=None):
+        records = self.records.values() if indices is None else \
+            [self.records[i] for i in indices if i in self.records]
+        records = list(records)
+        return sum(r['correct'] for r in records), len(records)
+
+    def close(self):
+        self.file.close()
+
+
+#parse "start:stop" (either side optional) into a (start, stop) range over total samples
+def parse_range(spec, total):
+    start, _, stop = spec.partition(':')
+    start = int(start) if start else 0
+    stop = int(stop) if stop else total
+    if not 0 <= start <= stop <= total:
+        raise ValueError(f"Sample range {spec} is outside 0:{total}")
+    return start, stop
+
+
+#read one or more logs into {index: record}; later files win on duplicates
+def read_logs(paths):
+    records = {}
+    for path in paths:
+        with open(path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if 'index' in record:
+                    records[record['index']] = record
+    return records
+
+
+#merge per-shard logs into one JSONL log and, optionally, npy arrays of
+#predictions/labels/timings (and logits when every record has them)
+def merge_logs(paths, output=None, npy_prefix=None):
+    records = read_logs(paths)
+    indices = sorted(records)
+
+    if output is not None:
+        with open(output, 'w') as f:
+            for i in indices:
+                f.write(json.dumps(records[i]) + "\n")
+
+    if npy_prefix is not None:
+        np.save(f'{npy_prefix}_indices.npy', np.array(indices, dtype=np.int64))
+        np.save(f'{npy_prefix}_preds.npy', np.array([records[i]['pred'] for i in indices], dtype=np.int64))
+        np.save(f'{npy_prefix}_labels.npy', np.array([records[i]['label'] for i in indices], dtype=np.int64))
+        np.save(f'{npy_prefix}_seconds.npy', np.array([records[i]['seconds'] for i in indices]))
+        if indices and all('logits' in records[i] for i in indices):
+            np.save(f'{npy_prefix}_logits.npy', np.array([records[i]['logits'] for i in indices], dtype=np.float32))
+
+    correct = sum(records[i]['correct'] for i in indices)
+    missing = []
+    if indices:
+        missing = sorted(set(range(indices[0], indices[-1] + 1)) - set(indices))
+    return {
+        'samples': len(indices),
+        'correct': correct,
+        'accuracy': correct / len(indices) if indices else 0.0,
+        'missing': missing,
+        'seconds': sum(records[i]['seconds'] for i in indices),
+    }
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Merge uTPU evaluation logs')
+    parser.add_argument('logs', nargs='+', help='JSONL logs written with --log')
+    parser.add_argument('--output', '-o', type=str, default=None, help='Merged JSONL log')
+    parser.add_argument('--npy', type=str, default=None, help='Prefix for merged .npy arrays')
+    args = parser.parse_args()
+
+    result = merge_logs(args.logs, args.output, args.npy)
+
+    print("=" * 60)
+    print(f"Merged {len(args.logs)} logs: {result['samples']} samples")
+    print(f"Accuracy: {100*result['accuracy']:.2f}% ({result['correct']}/{result['samples']})")
+    print(f"Total sample time: {result['seconds']:.1f} s")
+    if result['missing']:
+        print(f"WARNING: {len(result['missing'])} indices missing, first: {result['missing'][:10]}")
+    print("=" * 60)
+    return 1 if result['missing'] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,18 +1,39 @@
 
 import numpy as np
+import json
 import sys
 import os
+import time
 
 from tiled_inference import TiledInferenceEngine, get_default_paths
+from isa_model import quantizeAccumulatorArray, leakyReluArray
+from result_cache import ResultCache, hashParts, hashFile
+from eval_log import EvalLog, parse_range
+
+
+#bit-accurate model of one RUN: int16 accumulator >>> (ACC - COMPUTE) into
+#int4 (with wrap), then leaky relu >>> ALPHA if the tile runs with relu
+def emulate_run(acc, relu=False):
+    out = quantizeAccumulatorArray(acc)
+    if relu:
+        out = leakyReluArray(out)
+    return out
 
 
 #runs inference on physical fpga hardware
 #uses simulation when hardware not connected
+#emulate=True replaces the board with a bit-accurate NumPy model of what each
+#RUN returns (quantizer + optional leaky relu), batched across images
 class FPGAInference:
 
-    def __init__(self, port=None, verbose=False):
+    def __init__(self, port=None, verbose=False, pipelined=False, emulate=False, retries=3):
         self.verbose = verbose
-        self.simulation_mode = port is None
+        self.simulation_mode = port is None or emulate
+        self.emulate = emulate
+        self.pipelined = pipelined
+        #RUN flags used for every hardware tile
+        self.tile_quantize = True
+        self.tile_relu = False
 
         weights_dir, model_path, _ = get_default_paths()
 
@@ -23,9 +44,13 @@ class FPGAInference:
             try:
                 from uart_driver import UARTDriver
                 from program_loader import ProgramLoader
+                from resilient_dispatch import ResilientDispatcher
 
                 self.uart = UARTDriver(port, baud=115200)
-                self.loader = ProgramLoader(self.uart, verbose=verbose)
+                self.loader = ProgramLoader(self.uart, verbose=verbose, array_size=self.engine.array_size)
+                #failed tile programs are resynced and re-sent instead of ending the run
+                self.dispatcher = ResilientDispatcher(self.loader, link=port, max_retries=retries,
+                                                      verbose=verbose)
                 self._log(f"Connected to FPGA on {port}")
                 self.loader.resetChip()
             except Exception as e:
@@ -33,59 +58,206 @@ class FPGAInference:
                 print("Falling back to simulation mode")
                 self.simulation_mode = True
 
-        if self.simulation_mode:
+        if self.emulate:
+            self.engine.tile_runner = self.run_tile_emulated
+            self.engine.batch_tile_runner = self.run_tile_batch_emulated
+            self._log("Running in HARDWARE EMULATION mode (per-tile quantized outputs)")
+        elif self.simulation_mode:
             self._log("Running in SIMULATION mode")
         else:
             self.engine.tile_runner = self.run_tile_on_hardware
-            self._log("Running in HARDWARE tile mode (2x2 tiles via UART)")
-            print("NOTE: Hardware tile mode uses per-tile quantized outputs; accuracy may differ from software.")
+            self.engine.batch_tile_runner = self.run_tile_batch_on_hardware
+            if pipelined:
+                self.engine.tiles_runner = self.run_tiles_pipelined
+            n = self.engine.array_size
+            self._log(f"Running in HARDWARE tile mode ({n}x{n} tiles via UART)")
+            print("NOTE: Hardware tile mode uses per-tile quantized outputs; accuracy may differ from software (--emulate predicts it).")
 
     def _log(self, msg):
         if self.verbose:
             print(f"[FPGA] {msg}")
 
-    #run single 2x2 tile on hardware
+    #run single NxN tile on hardware
     def run_tile_on_hardware(self, weights, inputs):
         if self.simulation_mode:
             #simulate hardware behavior
-            w = weights.astype(np.int32)
-            x = inputs.astype(np.int32)
-            return np.array([
-                w[0, 0] * x[0] + w[0, 1] * x[1],
-                w[1, 0] * x[0] + w[1, 1] * x[1]
-            ], dtype=np.int32)
+            return self.run_tile_simulated(weights, inputs)
         else:
             weight_list = weights.astype(np.int8).flatten().tolist()
             input_list = inputs.astype(np.int8).flatten().tolist()
-            results = self.loader.execute2x2MatMul(
+            results = self.dispatcher.executeTileMatMul(
                 weight_list,
                 input_list,
                 self.loader.BUFFER_SECTION_B,
                 self.loader.BUFFER_SECTION_A,
                 self.loader.BUFFER_SECTION_C,
-                quantize=True,
-                relu=False,
+                quantize=self.tile_quantize,
+                relu=self.tile_relu,
             )
-            if len(results) < 2:
-                raise RuntimeError("FPGA tile read returned no data (UART timeout?)")
-            return np.array(results, dtype=np.int32)
+            return np.array(results[:len(weights)], dtype=np.int32)
+
+    #run one weight tile against a batch of input vectors on hardware
+    #the weight tile is loaded once for the whole batch
+    def run_tile_batch_on_hardware(self, weights, input_tiles):
+        if self.simulation_mode:
+            return input_tiles.astype(np.int32) @ weights.astype(np.int32).T
+
+        weight_list = weights.astype(np.int8).flatten().tolist()
+        input_lists = input_tiles.astype(np.int8).tolist()
+        results = self.dispatcher.executeWeightStationary(
+            weight_list,
+            input_lists,
+            self.loader.BUFFER_SECTION_B,
+            self.loader.BUFFER_SECTION_A,
+            self.loader.BUFFER_SECTION_C,
+            quantize=self.tile_quantize,
+            relu=self.tile_relu,
+        )
+        return np.array(results, dtype=np.int32).reshape(-1, len(weights))
+
+    #run every tile of a layer as one double-buffered instruction stream
+    def run_tiles_pipelined(self, tiles):
+        tile_lists = [(w.astype(np.int8).flatten().tolist(), x.astype(np.int8).flatten().tolist())
+                      for w, x in tiles]
+        results = self.dispatcher.executeTilesPipelined(tile_lists, quantize=self.tile_quantize,
+                                                        relu=self.tile_relu)
+        return np.array(results, dtype=np.int32).reshape(-1, self.engine.array_size)
 
     #simulated hardware tile
     def run_tile_simulated(self, weights, inputs):
-        w = weights.astype(np.int32)
-        x = inputs.astype(np.int32)
-        return np.array([
-            w[0, 0] * x[0] + w[0, 1] * x[1],
-            w[1, 0] * x[0] + w[1, 1] * x[1]
-        ], dtype=np.int32)
+        return weights.astype(np.int32) @ inputs.astype(np.int32)
+
+    def _emulate_run(self, acc):
+        return emulate_run(acc, self.tile_relu)
+
+    #emulated hardware tile
+    def run_tile_emulated(self, weights, inputs):
+        return self._emulate_run(weights.astype(np.int32) @ inputs.astype(np.int32))
+
+    #emulated hardware tile for a batch of input vectors, (B, N) -> (B, N)
+    def run_tile_batch_emulated(self, weights, input_tiles):
+        return self._emulate_run(input_tiles.astype(np.int32) @ weights.astype(np.int32).T)
+
+    #predicted hardware accuracy next to the software (host-accumulated) accuracy
+    def evaluate_emulated(self, images, labels, max_samples=None, batch_size=1000):
+        if max_samples is not None:
+            images = images[:max_samples]
+            labels = labels[:max_samples]
+
+        engine = self.engine
+        hw_preds = []
+        sw_preds = []
+        for start in range(0, len(labels), batch_size):
+            batch = images[start:start + batch_size]
+            hw_preds.append(engine.predict_batch(batch)[0])
+
+            #same engine without the per-tile quantizer
+            runners = engine.tile_runner, engine.batch_tile_runner
+            engine.tile_runner = engine.batch_tile_runner = None
+            try:
+                sw_preds.append(engine.predict_batch(batch)[0])
+            finally:
+                engine.tile_runner, engine.batch_tile_runner = runners
+
+        hw_preds = np.concatenate(hw_preds)
+        sw_preds = np.concatenate(sw_preds)
+        return {
+            'total': len(labels),
+            'hardware_accuracy': float(np.mean(hw_preds == labels)),
+            'software_accuracy': float(np.mean(sw_preds == labels)),
+            'agreement': float(np.mean(hw_preds == sw_preds)),
+        }
 
     #predict digit for image
     def predict(self, image):
         return self.engine.predict(image)
 
+    #predict digits for a batch of images (weight-stationary schedule)
+    def predict_batch(self, images):
+        return self.engine.predict_batch(images)
+
     #evaluate accuracy
-    def evaluate(self, images, labels, max_samples=None):
-        return self.engine.evaluate(images, labels, max_samples)
+    #workers > 1 shards the samples over a process pool (parallel_eval.py); only
+    #in simulation or emulation mode, the board has a single UART
+    def evaluate(self, images, labels, max_samples=None, batch_size=None, sample_range=None, log=None,
+                 workers=None):
+        if workers is not None and workers > 1:
+            if not self.simulation_mode:
+                raise ValueError("Parallel evaluation needs simulation or emulation mode (one UART per board)")
+            from parallel_eval import evaluate_parallel
+            if max_samples is not None:
+                images = images[:max_samples]
+                labels = labels[:max_samples]
+            return evaluate_parallel(self.engine, images, labels, workers, batch_size=batch_size,
+                                     sample_range=sample_range, log=log,
+                                     emulate_relu=self.tile_relu if self.emulate else None)
+        return self.engine.evaluate(images, labels, max_samples, batch_size=batch_size,
+                                    sample_range=sample_range, log=log)
+
+    #name of the schedule that produces the logits (part of the result cache key)
+    def schedule_mode(self, batch_size=None):
+        if self.emulate:
+            return 'emulate'
+        if self.simulation_mode:
+            return 'simulation'
+        if batch_size is not None:
+            return 'weight_stationary'
+        return 'pipelined' if self.pipelined else 'tile'
+
+    #hash of everything on the host and board side that determines the logits
+    def model_hash(self, bitstream=None):
+        engine = self.engine
+        parts = [engine.array_size, self.tile_quantize, self.tile_relu]
+        for layer in engine.layers:
+            parts += [layer['weight'], layer['scale'], layer['requant'], layer['activation']]
+            if layer['conv'] is not None:
+                parts.append(sorted(layer['conv'].items()))
+        if bitstream is not None:
+            parts.append(hashFile(bitstream))
+        return hashParts(parts)
+
+    #meta of an --eval --log run over sample_range (JSON-serializable, the
+    #model hash as hex): EvalLog refuses to resume a log written by another run
+    def log_meta(self, sample_range, batch_size=None, bitstream=None):
+        return {'mode': self.schedule_mode(batch_size),
+                'range': list(sample_range),
+                'model': self.model_hash(bitstream).hex()}
+
+    #evaluate through a ResultCache: cached samples are served from disk and
+    #only misses are run (and appended to the cache)
+    def evaluate_cached(self, images, labels, cache, max_samples=None, batch_size=None):
+        if max_samples is not None:
+            images = images[:max_samples]
+            labels = labels[:max_samples]
+
+        total = len(labels)
+        keys = [cache.key(image) for image in images]
+        logits = np.zeros((total, cache.numLogits), dtype=np.float32)
+        missing = []
+        for i, key in enumerate(keys):
+            cached = cache.get(key)
+            if cached is None:
+                missing.append(i)
+            else:
+                logits[i] = cached
+        print(f"Cache: {total - len(missing)} hits, {len(missing)} to run")
+
+        step = batch_size or 1
+        for start in range(0, len(missing), step):
+            chunk = missing[start:start + step]
+            if batch_size is not None:
+                _, chunk_logits = self.predict_batch(images[chunk])
+            else:
+                chunk_logits = [self.predict(images[chunk[0]])[1]]
+            logits[chunk] = chunk_logits
+            cache.putMany([keys[i] for i in chunk], chunk_logits)
+
+            done = min(start + step, len(missing))
+            if done // 1000 > start // 1000:
+                print(f"Progress: {done}/{len(missing)} uncached samples")
+
+        correct = int(np.sum(np.argmax(logits, axis=1) == labels))
+        return correct / total, correct, total
 
     #close uart connection
     def close(self):
@@ -103,6 +275,26 @@ def main():
                         help='Serial port (e.g. COM3). Omit for simulation.')
     parser.add_argument('--eval', action='store_true')
     parser.add_argument('--num-samples', type=int, default=None)
+    parser.add_argument('--batch-size', type=int, default=None,
+                        help='Stream this many images through each loaded weight tile')
+    parser.add_argument('--pipelined', action='store_true',
+                        help='Send each layer as one double-buffered tile stream')
+    parser.add_argument('--emulate', action='store_true',
+                        help='Bit-accurate NumPy emulation of the per-tile hardware outputs (no board)')
+    parser.add_argument('--cache', type=str, default=None,
+                        help='Result cache file: reuse logits of unchanged samples across --eval runs')
+    parser.add_argument('--bitstream', type=str, default=None,
+                        help='Bitstream file to include in the cache key')
+    parser.add_argument('--log', type=str, default=None,
+                        help='Stream per-sample results to this JSONL file and resume from it')
+    parser.add_argument('--range', type=str, default=None, metavar='START:STOP',
+                        help='Only evaluate these sample indices (merge shards with eval_log.py)')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='Shard --eval over this many processes (simulation/emulation only)')
+    parser.add_argument('--trace', type=str, default=None,
+                        help='Append an --eval timing record (JSONL) for perf_model.py --calibrate')
+    parser.add_argument('--retries', type=int, default=3,
+                        help='Re-send a failed tile program this many times before giving up')
     parser.add_argument('--sample', type=int, default=None)
     parser.add_argument('--interactive', '-i', action='store_true')
     parser.add_argument('--verbose', '-v', action='store_true')
@@ -114,7 +306,8 @@ def main():
     print("=" * 60)
 
     #initialize
-    fpga = FPGAInference(port=args.port, verbose=args.verbose)
+    fpga = FPGAInference(port=args.port, verbose=args.verbose, pipelined=args.pipelined,
+                         emulate=args.emulate, retries=args.retries)
 
     #load test data
     test_images = np.load(os.path.join(data_dir, 'mnist_14x14_test.npy'))
@@ -131,11 +324,61 @@ def main():
         print(f"  Actual:    {actual}")
         print(f"  {'CORRECT' if pred == actual else 'WRONG'}")
 
+    elif args.eval and args.emulate and args.workers is None and args.log is None and args.range is None \
+            and args.cache is None:
+        #predicted hardware accuracy (sharded, logged or cached runs go through evaluate below)
+        print(f"\nEmulating hardware tiles...")
+        start = time.perf_counter()
+        result = fpga.evaluate_emulated(test_images, test_labels, args.num_samples,
+                                        batch_size=args.batch_size or 1000)
+        elapsed = time.perf_counter() - start
+        print(f"\nPredicted hardware accuracy: {100*result['hardware_accuracy']:.2f}%")
+        print(f"Software accuracy:           {100*result['software_accuracy']:.2f}%")
+        print(f"Prediction agreement:        {100*result['agreement']:.2f}%")
+        print(f"Samples: {result['total']} in {elapsed:.2f} s")
+
     elif args.eval:
         #full evaluation
         print(f"\nEvaluating...")
-        acc, correct, total = fpga.evaluate(test_images, test_labels, args.num_samples)
+        start = time.perf_counter()
+        if args.cache is not None:
+            cache = ResultCache(args.cache, fpga.model_hash(args.bitstream),
+                                fpga.schedule_mode(args.batch_size))
+            acc, correct, total = fpga.evaluate_cached(test_images, test_labels, cache, args.num_samples,
+                                                       batch_size=args.batch_size)
+        else:
+            count = len(test_labels) if args.num_samples is None else min(args.num_samples, len(test_labels))
+            sample_range = parse_range(args.range, count) if args.range else None
+            log = None
+            if args.log is not None:
+                log = EvalLog(args.log, meta=fpga.log_meta(sample_range or (0, count), args.batch_size,
+                                                           args.bitstream))
+            acc, correct, total = fpga.evaluate(test_images, test_labels, args.num_samples,
+                                                batch_size=args.batch_size, sample_range=sample_range, log=log,
+                                                workers=args.workers)
+            if log is not None:
+                log.close()
+        elapsed = time.perf_counter() - start
         print(f"\nAccuracy: {100*acc:.2f}% ({correct}/{total})")
+        if not fpga.simulation_mode:
+            print(fpga.dispatcher.report())
+
+        #cached runs do not time the hardware, so they are not traced
+        if args.trace is not None and not fpga.simulation_mode and args.cache is None:
+            engine = fpga.engine
+            record = {
+                'strategy': fpga.schedule_mode(args.batch_size),
+                'layers': [list(layer['weight'].shape) for layer in engine.layers],
+                'array_size': engine.array_size,
+                'batch_size': args.batch_size,
+                'baud': fpga.uart.baud,
+                'fifo_size': fpga.uart.FIFO_SIZE,
+                'images': total,
+                'seconds': elapsed,
+            }
+            with open(args.trace, 'a') as f:
+                f.write(json.dumps(record) + "\n")
+            print(f"Trace appended to {args.trace}")
 
     elif args.interactive:
         #interactive mode
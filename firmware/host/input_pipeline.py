@@ -0,0 +1,328 @@
+import gzip
+import os
+import queue
+import struct
+import sys
+import threading
+import time
+
+import numpy as np
+
+
+FRAME_SHAPE = (28, 28)
+FRAME_BYTES = FRAME_SHAPE[0] * FRAME_SHAPE[1]
+# IDX magic: two zero bytes, element type, number of dimensions
+IDX_UBYTE = 0x08
+RAW_SUFFIXES = ('.raw', '.bin')
+
+
+#streaming input pipeline: raw 28x28 uint8 frames -> 2x2 pool -> int4 -> engine
+#
+#  source --(frames)--> pool --(14x14 float)--> quantize --(int4)--> [queue] --> engine
+#
+#the source, pool and quantize stages are chained generators run by a producer
+#thread, the engine runs on the caller's thread. the bounded queue between them
+#is the backpressure: the producer stays up to queue_size batches ahead of the
+#engine (and its UART) and blocks when the engine falls behind, so memory stays
+#bounded no matter how fast frames arrive.
+#pool and quantize match software/preprocesses/downscale.py and
+#TiledInferenceEngine.preprocess_image, so streamed frames give the same
+#logits as mnist_14x14_test.npy
+
+
+def _open_binary(path):
+    return gzip.open(path, 'rb') if path.endswith('.gz') else open(path, 'rb')
+
+
+#(type, dims) of an IDX header
+def _read_idx_header(f, path):
+    header = f.read(4)
+    if len(header) < 4 or header[:2] != b'\0\0':
+        raise ValueError(f"{path} is not an IDX file")
+    dtype, ndim = header[2], header[3]
+    dims = struct.unpack(f'>{ndim}I', f.read(4 * ndim))
+    return dtype, dims
+
+
+#frames of an IDX image file (e.g. t10k-images-idx3-ubyte[.gz]), read one at a time
+def read_idx(path):
+    with _open_binary(path) as f:
+        dtype, dims = _read_idx_header(f, path)
+        if dtype != IDX_UBYTE or tuple(dims[1:]) != FRAME_SHAPE:
+            raise ValueError(f"{path}: expected uint8 frames of {FRAME_SHAPE}, got type 0x{dtype:02X} dims {dims}")
+        for i in range(dims[0]):
+            data = f.read(FRAME_BYTES)
+            if len(data) < FRAME_BYTES:
+                raise ValueError(f"{path}: truncated at frame {i} of {dims[0]}")
+            yield np.frombuffer(data, dtype=np.uint8).reshape(FRAME_SHAPE)
+
+
+#labels of an IDX label file (t10k-labels-idx1-ubyte[.gz])
+def read_idx_labels(path):
+    with _open_binary(path) as f:
+        dtype, dims = _read_idx_header(f, path)
+        if dtype != IDX_UBYTE or len(dims) != 1:
+            raise ValueError(f"{path}: expected a 1-d uint8 label file")
+        return np.frombuffer(f.read(dims[0]), dtype=np.uint8).astype(np.int64)
+
+
+#back-to-back raw 784-byte frames from a binary stream (e.g. stdin) until EOF
+def read_stream(stream):
+    while True:
+        data = stream.read(FRAME_BYTES)
+        if not data:
+            return
+        #pipes may return short reads, keep reading until the frame is complete
+        while len(data) < FRAME_BYTES:
+            more = stream.read(FRAME_BYTES - len(data))
+            if not more:
+                raise ValueError(f"Stream ended inside a frame ({len(data)}/{FRAME_BYTES} bytes)")
+            data += more
+        yield np.frombuffer(data, dtype=np.uint8).reshape(FRAME_SHAPE)
+
+
+#frames of every file in a directory, in name order
+#.npy holds one frame (28, 28) or a stack (N, 28, 28), .raw/.bin raw frames,
+#anything with an IDX header (*-ubyte, *.idx, *.gz) is read as IDX
+def read_directory(path):
+    for name in sorted(os.listdir(path)):
+        file = os.path.join(path, name)
+        if not os.path.isfile(file):
+            continue
+        if name.endswith('.npy'):
+            frames = np.load(file)
+            if frames.dtype != np.uint8 or frames.shape[-2:] != FRAME_SHAPE:
+                raise ValueError(f"{file}: expected uint8 frames of {FRAME_SHAPE}, got {frames.dtype} {frames.shape}")
+            yield from frames.reshape(-1, *FRAME_SHAPE)
+        elif name.endswith(RAW_SUFFIXES):
+            with open(file, 'rb') as f:
+                yield from read_stream(f)
+        elif name.endswith(('-ubyte', '.idx', '.gz')):
+            yield from read_idx(file)
+
+
+#frame source for a path: '-' is stdin, a directory or an IDX file
+def open_source(spec):
+    if spec == '-':
+        return read_stream(sys.stdin.buffer)
+    if os.path.isdir(spec):
+        return read_directory(spec)
+    return read_idx(spec)
+
+
+#items and busy time of one pipeline stage
+class StageCounter:
+
+    def __init__(self, name):
+        self.name = name
+        self.items = 0
+        self.seconds = 0.0
+
+    def add(self, items, seconds):
+        self.items += items
+        self.seconds += seconds
+
+    #items per busy second (what the stage could sustain on its own)
+    @property
+    def rate(self):
+        return self.items / self.seconds if self.seconds else 0.0
+
+
+#group frames into (batch, 28, 28) arrays, timing the source under counter
+def batch_frames(frames, batch_size, counter=None):
+    frames = iter(frames)
+    while True:
+        start = time.perf_counter()
+        batch = [frame for _, frame in zip(range(batch_size), frames)]
+        if counter is not None:
+            counter.add(len(batch), time.perf_counter() - start)
+        if not batch:
+            return
+        yield np.stack(batch)
+
+
+#2x2 average pool of uint8 frame batches -> float (batch, 14, 14) in [0, 1]
+#same arithmetic as downscale.py (normalize, then average each block), the
+#four block pixels are summed in the same order so the result is bit-identical
+def pool_frames(batches, counter=None):
+    for frames in batches:
+        start = time.perf_counter()
+        x = frames.astype(np.float32) / 255.0
+        blocks = x.reshape(len(x), 14, 2, 14, 2).transpose(0, 1, 3, 2, 4)
+        images = blocks.reshape(len(x), 14, 14, 4).mean(axis=-1)
+        if counter is not None:
+            counter.add(len(images), time.perf_counter() - start)
+        yield images
+
+
+#14x14 float batches -> int4 inputs (batch, 196) as int8
+#matches qat_model.py: quantize_int4(x * 15 - 8)
+def quantize_frames(batches, counter=None):
+    for images in batches:
+        start = time.perf_counter()
+        x = np.clip(np.round(images.reshape(len(images), -1) * 15.0 - 8.0), -8, 7).astype(np.int8)
+        if counter is not None:
+            counter.add(len(x), time.perf_counter() - start)
+        yield x
+
+
+# producer thread + bounded queue in front of an inference function
+# infer takes int4 inputs (batch, 196) and returns logits (batch, classes),
+# e.g. TiledInferenceEngine.forward_int4_batch
+class InputPipeline:
+
+    def __init__(self, frames, infer, batch_size=64, queue_size=8, verbose=False):
+        self.frames = frames
+        self.infer = infer
+        self.batch_size = batch_size
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.verbose = verbose
+        self.counters = {name: StageCounter(name) for name in ('read', 'pool', 'quantize', 'infer')}
+        #producer time blocked on a full queue, consumer time waiting on an empty one
+        self.producer_blocked = 0.0
+        self.consumer_starved = 0.0
+        self.max_depth = 0
+        self.seconds = 0.0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _log(self, msg):
+        if self.verbose:
+            print(f"[InputPipeline] {msg}")
+
+    def _produce(self):
+        c = self.counters
+        try:
+            stages = quantize_frames(pool_frames(batch_frames(self.frames, self.batch_size, c['read']),
+                                                 c['pool']), c['quantize'])
+            for batch in stages:
+                if not self._put(batch):
+                    return
+            self._put(None)
+        except Exception as e:
+            #hand the error to the consumer instead of dying silently
+            self._put(e)
+
+    #put with periodic stop checks, False if the pipeline was closed
+    def _put(self, item):
+        start = time.perf_counter()
+        while not self._stop.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                self.producer_blocked += time.perf_counter() - start
+                self.max_depth = max(self.max_depth, self.queue.qsize())
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    #run the pipeline, yields (int4 inputs, logits) per batch in frame order
+    def __iter__(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._produce, name='input-pipeline', daemon=True)
+        start = time.perf_counter()
+        self._thread.start()
+        try:
+            while True:
+                wait = time.perf_counter()
+                item = self.queue.get()
+                self.consumer_starved += time.perf_counter() - wait
+                if item is None:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+
+                begin = time.perf_counter()
+                logits = self.infer(item)
+                self.counters['infer'].add(len(item), time.perf_counter() - begin)
+                yield item, logits
+        finally:
+            self.seconds += time.perf_counter() - start
+            self.close()
+
+    def close(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self._log("Stopped")
+
+    #per-stage counters and end-to-end throughput
+    def summary(self):
+        frames = self.counters['infer'].items
+        return {
+            'frames': frames,
+            'seconds': self.seconds,
+            'fps': frames / self.seconds if self.seconds else 0.0,
+            'stages': {name: {'items': c.items, 'seconds': c.seconds, 'rate': c.rate}
+                       for name, c in self.counters.items()},
+            'producer_blocked': self.producer_blocked,
+            'consumer_starved': self.consumer_starved,
+            'max_queue_depth': self.max_depth,
+        }
+
+    def report(self):
+        s = self.summary()
+        lines = [f"{s['frames']} frames in {s['seconds']:.2f} s ({s['fps']:.1f} frames/s end to end)"]
+        for name, stage in s['stages'].items():
+            lines.append(f"  {name:<9} {stage['items']:>7} frames  {stage['seconds']:>8.3f} s busy  "
+                         f"{stage['rate']:>10.1f} frames/s")
+        lines.append(f"  producer blocked {s['producer_blocked']:.3f} s, engine starved {s['consumer_starved']:.3f} s, "
+                     f"max queue depth {s['max_queue_depth']}/{self.queue.maxsize}")
+        return "\n".join(lines)
+
+
+def main():
+    import argparse
+    from fpga_inference import FPGAInference
+
+    parser = argparse.ArgumentParser(description='uTPU streaming inference from raw 28x28 frames')
+    parser.add_argument('source', type=str,
+                        help="IDX image file (optionally .gz), directory of frames, or '-' for raw frames on stdin")
+    parser.add_argument('--labels', type=str, default=None, help='IDX label file, reports accuracy')
+    parser.add_argument('--port', '-p', type=str, default=None,
+                        help='Serial port (e.g. COM3). Omit for software inference.')
+    parser.add_argument('--emulate', action='store_true',
+                        help='Emulate the hardware tile outputs without a board')
+    parser.add_argument('--pipelined', action='store_true')
+    parser.add_argument('--batch-size', type=int, default=64)
+    parser.add_argument('--queue-size', type=int, default=8, help='Batches the producer may run ahead')
+    parser.add_argument('--max-frames', type=int, default=None)
+    parser.add_argument('--verbose', '-v', action='store_true')
+    args = parser.parse_args()
+
+    print("=" * 60)
+    print("uTPU Streaming Input Pipeline")
+    print("=" * 60)
+
+    fpga = FPGAInference(port=args.port, verbose=args.verbose, pipelined=args.pipelined,
+                         emulate=args.emulate)
+    labels = read_idx_labels(args.labels) if args.labels else None
+
+    frames = open_source(args.source)
+    if args.max_frames is not None:
+        frames = (frame for _, frame in zip(range(args.max_frames), frames))
+
+    pipeline = InputPipeline(frames, fpga.engine.forward_int4_batch, batch_size=args.batch_size,
+                             queue_size=args.queue_size, verbose=args.verbose)
+    correct = 0
+    count = 0
+    for inputs, logits in pipeline:
+        preds = np.argmax(logits, axis=1)
+        if labels is not None:
+            if count + len(preds) > len(labels):
+                print(f"Error: more frames than the {len(labels)} labels")
+                return 1
+            correct += int(np.sum(preds == labels[count:count + len(preds)]))
+        count += len(preds)
+
+    print(pipeline.report())
+    if labels is not None and count:
+        print(f"Accuracy: {100 * correct / count:.2f}% ({correct}/{count})")
+
+    fpga.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
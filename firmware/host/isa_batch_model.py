@@ -0,0 +1,440 @@
+import sys
+import time
+from typing import List, NamedTuple
+
+import numpy as np
+
+from isa_encoder import (
+    OPCODE_STORE,
+    OPCODE_FETCH,
+    OPCODE_RUN,
+    OPCODE_LOAD,
+    OPCODE_HALT,
+    OPCODE_NOP,
+    ISAEncoder,
+    encodeStoreAddress,
+)
+from isa_model import (BUFFER_SIZE, RESULT_LANES, RUN_COMPUTE, RUN_QUANTIZE, RUN_RELU, ISAModel,
+                       inputWords, weightWords, resultWords, quantizeAccumulatorArray, leakyReluArray)
+from utpu_config import ARRAY_SIZE
+
+
+OPCODES = (OPCODE_STORE, OPCODE_FETCH, OPCODE_RUN, OPCODE_LOAD, OPCODE_HALT, OPCODE_NOP)
+NIBBLE_SHIFTS = np.array([0, 4, 8, 12], dtype=np.uint16)
+
+
+#decoded instruction streams as arrays, one row per program
+#columns past a program's length are NOP padding
+class ProgramArrays(NamedTuple):
+    opcode: np.ndarray    # (K, T) uint8
+    addr: np.ndarray      # (K, T) int32, destination/source/result address
+    operand: np.ndarray   # (K, T) uint16, STORE immediate word or source address
+    flags: np.ndarray     # (K, T) uint8, bits 3-6 of the first word
+    lengths: np.ndarray   # (K,) instructions per program
+
+    @property
+    def instructions(self) -> int:
+        return int(self.lengths.sum())
+
+
+#decode one byte stream into (opcode, addr, operand, flags) arrays
+#same rules and errors as isa_model.decodeProgram
+def decodeArrays(program: bytes):
+    if len(program) % 2:
+        raise ValueError(f"Program length {len(program)} is not a whole number of words")
+    words = np.frombuffer(program, dtype='<u2')
+    ops = (words & 0x7).tolist()
+
+    #instruction starts are sequential (STORE takes 3 words)
+    starts = []
+    i = 0
+    count = len(ops)
+    while i < count:
+        starts.append(i)
+        i += 3 if ops[i] == OPCODE_STORE else 1
+    starts = np.array(starts, dtype=np.int64)
+
+    first = words[starts]
+    opcode = (first & 0x7).astype(np.uint8)
+    bad = ~np.isin(opcode, OPCODES)
+    if bad.any():
+        at = int(starts[np.argmax(bad)])
+        raise ValueError(f"Unknown opcode {int(words[at]) & 0x7:03b} at word {at}")
+
+    store = opcode == OPCODE_STORE
+    if store.any() and starts[store][-1] + 2 >= len(words):
+        raise ValueError(f"Truncated STORE at word {int(starts[store][-1])}")
+
+    addr = (first >> 7).astype(np.int32)
+    operand = np.zeros(len(starts), dtype=np.uint16)
+    addr[store] = words[starts[store] + 2] & 0x1FF
+    operand[store] = words[starts[store] + 1]
+    return opcode, addr, operand, ((first >> 3) & 0xF).astype(np.uint8)
+
+
+#decode K programs into padded ProgramArrays
+def decodePrograms(programs: List[bytes]) -> ProgramArrays:
+    decoded = [decodeArrays(program) for program in programs]
+    lengths = np.array([len(d[0]) for d in decoded], dtype=np.int64)
+    steps = int(lengths.max()) if len(lengths) else 0
+
+    opcode = np.full((len(decoded), steps), OPCODE_NOP, dtype=np.uint8)
+    addr = np.zeros((len(decoded), steps), dtype=np.int32)
+    operand = np.zeros((len(decoded), steps), dtype=np.uint16)
+    flags = np.zeros((len(decoded), steps), dtype=np.uint8)
+    for k, (o, a, v, f) in enumerate(decoded):
+        opcode[k, :len(o)] = o
+        addr[k, :len(o)] = a
+        operand[k, :len(o)] = v
+        flags[k, :len(o)] = f
+    return ProgramArrays(opcode, addr, operand, flags, lengths)
+
+
+#one program broadcast to K instances (e.g. a template whose STORE operands
+#are then patched per instance)
+def tilePrograms(program: bytes, instances: int) -> ProgramArrays:
+    opcode, addr, operand, flags = decodeArrays(program)
+    tile = lambda a: np.ascontiguousarray(np.broadcast_to(a, (instances, len(a))))
+    return ProgramArrays(tile(opcode), tile(addr), tile(operand), tile(flags),
+                         np.full(instances, len(opcode), dtype=np.int64))
+
+
+# K independent uTPU cores as seen through the ISA, executed in lockstep
+# state is held as arrays (buffer (K, 512), PE weights (K, N, N), inputs (K, N))
+# and step t runs instruction t of every program at once, one vectorized
+# update per opcode present in that step. semantics match ISAModel exactly;
+# an instruction ISAModel would raise on instead faults its instance, which
+# stops there (state untouched by the faulting instruction) while the others
+# keep running
+class BatchISAModel:
+
+    def __init__(self, instances: int, array_size: int = ARRAY_SIZE):
+        self.instances = instances
+        self.arraySize = array_size
+        self.reset()
+
+    def reset(self) -> None:
+        n, k = self.arraySize, self.instances
+        self.buffer = np.zeros((k, BUFFER_SIZE), dtype=np.uint16)
+        self.weights = np.zeros((k, n, n), dtype=np.int8)
+        self.inputs = np.zeros((k, n), dtype=np.int8)
+        self.instructionCount = np.zeros(k, dtype=np.int64)
+        # instruction index each instance faulted at, -1 if it did not
+        self.faults = np.full(k, -1, dtype=np.int64)
+        self.faultMessages = {}
+
+    def _fault(self, idx, step, message):
+        for k in idx.tolist():
+            if self.faults[k] < 0:
+                self.faults[k] = step
+                self.faultMessages[k] = message
+
+    #count consecutive int4 values at addr for instances idx, (len(idx), count)
+    #addresses that would run past the buffer fault instead
+    def _readNibbles(self, idx, addr, count, step):
+        words = (count + 3) // 4
+        over = addr + words > BUFFER_SIZE
+        if over.any():
+            self._fault(idx[over], step, f"Read of {words} words runs past the buffer")
+            idx, addr = idx[~over], addr[~over]
+        data = self.buffer[idx[:, None], addr[:, None] + np.arange(words)]
+        nibbles = ((data[:, :, None] >> NIBBLE_SHIFTS) & 0xF).astype(np.int8).reshape(len(idx), -1)
+        return idx, ((nibbles ^ 8) - 8)[:, :count]
+
+    def _store(self, idx, addr, operand, flags):
+        immediate = (flags & 0b10).astype(bool)
+        value = np.where(immediate, operand, self.buffer[idx, operand & 0x1FF])
+        self.buffer[idx, addr] = value
+
+    def _load(self, idx, addr, flags, step):
+        n = self.arraySize
+        weights = (flags & 0b1).astype(bool)
+        if weights.any():
+            w, nibbles = self._readNibbles(idx[weights], addr[weights], n * n, step)
+            self.weights[w] = nibbles.reshape(-1, n, n)
+        if (~weights).any():
+            i, nibbles = self._readNibbles(idx[~weights], addr[~weights], n, step)
+            self.inputs[i] = nibbles
+
+    def _run(self, idx, addr, flags, step):
+        n = self.arraySize
+        compute = (flags & RUN_COMPUTE).astype(bool)
+        quantize = (flags & RUN_QUANTIZE).astype(bool)
+        relu = (flags & RUN_RELU).astype(bool)
+
+        passthrough = ~compute & relu & ~quantize
+        unsupported = ~(compute & quantize) & ~passthrough
+        if unsupported.any():
+            self._fault(idx[unsupported], step, "Unsupported RUN flag combination")
+        over = addr + resultWords(n) > BUFFER_SIZE
+        if (over & ~unsupported).any():
+            self._fault(idx[over & ~unsupported], step, "RUN result runs past the buffer")
+        ok = ~unsupported & ~over
+        idx, addr, compute, relu = idx[ok], addr[ok], compute[ok], relu[ok]
+
+        acc = np.einsum('kij,kj->ki', self.weights[idx].astype(np.int32), self.inputs[idx].astype(np.int32))
+        outputs = np.where(compute[:, None], quantizeAccumulatorArray(acc), self.inputs[idx].astype(np.int32))
+        outputs = np.where(relu[:, None], leakyReluArray(outputs), outputs)
+
+        #output r goes to nibble RESULT_LANES[r % 2] of word r // 2, other nibbles are cleared
+        words = np.zeros((len(idx), resultWords(n)), dtype=np.uint16)
+        for r in range(n):
+            words[:, r // 2] |= ((outputs[:, r] & 0xF) << (4 * RESULT_LANES[r % 2])).astype(np.uint16)
+        self.buffer[idx[:, None], addr[:, None] + np.arange(resultWords(n))] = words
+
+    #execute one program per instance in lockstep
+    #programs is a list of K byte streams or already decoded ProgramArrays
+    #returns the bytes each instance transmits (FETCH results)
+    #strict raises ValueError on the first fault like ISAModel.execute
+    def execute(self, programs, strict: bool = True) -> List[bytes]:
+        arrays = programs if isinstance(programs, ProgramArrays) else decodePrograms(programs)
+        if len(arrays.lengths) != self.instances:
+            raise ValueError(f"Got {len(arrays.lengths)} programs for {self.instances} instances")
+
+        steps = arrays.opcode.shape[1]
+        fetches = (arrays.opcode == OPCODE_FETCH).sum(axis=1)
+        received = np.zeros((self.instances, int(fetches.max()) if steps else 0), dtype=np.uint8)
+        sent = np.zeros(self.instances, dtype=np.int64)
+
+        #which opcodes occur in which step, so each step only touches what it needs
+        present = {op: (arrays.opcode == op).any(axis=0) for op in (OPCODE_STORE, OPCODE_FETCH,
+                                                                     OPCODE_RUN, OPCODE_LOAD)}
+        faulted = False
+        for t in range(steps):
+            opcode = arrays.opcode[:, t]
+            live = (t < arrays.lengths) & (self.faults < 0) if faulted else t < arrays.lengths
+            self.instructionCount += live
+
+            for op in (OPCODE_STORE, OPCODE_LOAD, OPCODE_RUN, OPCODE_FETCH):
+                if not present[op][t]:
+                    continue
+                idx = np.flatnonzero(live & (opcode == op))
+                if not len(idx):
+                    continue
+                addr, flags = arrays.addr[idx, t], arrays.flags[idx, t]
+                if op == OPCODE_STORE:
+                    self._store(idx, addr, arrays.operand[idx, t], flags)
+                elif op == OPCODE_LOAD:
+                    self._load(idx, addr, flags, t)
+                elif op == OPCODE_RUN:
+                    self._run(idx, addr, flags, t)
+                else:
+                    word = self.buffer[idx, addr]
+                    received[idx, sent[idx]] = np.where(flags & 0b1, word >> 8, word & 0xFF)
+                    sent[idx] += 1
+            faulted = faulted or bool((self.faults >= 0).any())
+
+        if strict and faulted:
+            k = int(np.argmax(self.faults >= 0))
+            raise ValueError(f"Instance {k} faulted at instruction {self.faults[k]}: {self.faultMessages[k]}")
+        return [received[k, :sent[k]].tobytes() for k in range(self.instances)]
+
+    #ISAModel holding the state of one instance
+    def toScalar(self, k: int) -> ISAModel:
+        model = ISAModel(array_size=self.arraySize)
+        model.buffer = self.buffer[k].astype(int).tolist()
+        model.weights = self.weights[k].astype(int).tolist()
+        model.inputs = self.inputs[k].astype(int).tolist()
+        model.instructionCount = int(self.instructionCount[k])
+        return model
+
+
+# batch tile runner for TiledInferenceEngine backed by a BatchISAModel
+# every input tile of the batch runs on its own instance: one ISAEncoder
+# template (STORE weights, STORE inputs, LOADWEI, LOADIN, RUN, FETCH) whose
+# input STORE operands are patched per instance
+class BatchTileRunner:
+
+    WEIGHT_ADDR = 0x080
+    INPUT_ADDR = 0x000
+    RESULT_ADDR = 0x100
+
+    def __init__(self, array_size: int = ARRAY_SIZE, quantize: bool = True, relu: bool = False):
+        self.arraySize = array_size
+        self.quantize = quantize
+        self.relu = relu
+        self.instructions = 0
+        self.seconds = 0.0
+
+    def program(self, weight_tile, input_tile) -> bytes:
+        n = self.arraySize
+        encoder = ISAEncoder()
+        encoder.storeWords(self.WEIGHT_ADDR, np.asarray(weight_tile, dtype=np.int8).flatten().tolist())
+        encoder.storeWords(self.INPUT_ADDR, np.asarray(input_tile, dtype=np.int8).tolist())
+        encoder.loadWeights(self.WEIGHT_ADDR)
+        encoder.loadInputs(self.INPUT_ADDR)
+        encoder.run(self.RESULT_ADDR, compute=True, quantize=self.quantize, relu=self.relu)
+        encoder.fetchResults(self.RESULT_ADDR, n)
+        encoder.halt()
+        return encoder.getProgram()
+
+    def __call__(self, weight_tile, input_tiles):
+        n = self.arraySize
+        input_tiles = np.asarray(input_tiles, dtype=np.int8)
+        start = time.perf_counter()
+
+        arrays = tilePrograms(self.program(weight_tile, np.zeros(n, dtype=np.int8)), len(input_tiles))
+        #input STOREs follow the weight STOREs
+        first = weightWords(n)
+        padded = np.zeros((len(input_tiles), 4 * inputWords(n)), dtype=np.uint16)
+        padded[:, :n] = input_tiles.astype(np.uint16) & 0xF
+        words = (padded.reshape(len(input_tiles), -1, 4) << NIBBLE_SHIFTS).sum(axis=-1, dtype=np.uint16)
+        arrays.operand[:, first:first + inputWords(n)] = words
+
+        model = BatchISAModel(len(input_tiles), n)
+        received = model.execute(arrays)
+        self.instructions += arrays.instructions
+        self.seconds += time.perf_counter() - start
+
+        outputs = np.frombuffer(b''.join(received), dtype=np.uint8).reshape(len(input_tiles), n).astype(np.int32)
+        return ((outputs & 0xF) ^ 8) - 8
+
+
+#random ISAEncoder program over the whole ISA
+#with probability faultRate an instruction is one the RTL rejects (LOAD/RUN
+#past the end of the buffer, unsupported RUN flags) so fault handling is fuzzed too
+def randomProgram(rng, length: int, array_size: int = ARRAY_SIZE, faultRate: float = 0.002) -> bytes:
+    n = array_size
+    encoder = ISAEncoder()
+    program = b''
+    for _ in range(length):
+        kind = rng.integers(8)
+        fault = rng.random() < faultRate
+        #mostly a small window so LOADs and FETCHes see earlier STOREs and RUNs
+        addr = int(rng.integers(64) if rng.random() < 0.9 else rng.integers(BUFFER_SIZE))
+        if kind <= 1:
+            encoder.store(addr, rng.integers(-8, 8, size=4).tolist())
+        elif kind == 2:
+            program += encoder.getProgram() + encodeStoreAddress(addr, int(rng.integers(64)))
+            encoder.clear()
+        elif kind == 3:
+            words = weightWords(n)
+            encoder.loadWeights(BUFFER_SIZE - 1 if fault and words > 1 else min(addr, BUFFER_SIZE - words))
+        elif kind == 4:
+            encoder.loadInputs(min(addr, BUFFER_SIZE - inputWords(n)))
+        elif kind == 5:
+            compute, quantize, relu = True, True, bool(rng.integers(2))
+            if rng.random() < 0.1:
+                #result passthrough of the inputs
+                compute, quantize, relu = False, False, True
+            if fault:
+                compute, quantize = bool(rng.integers(2)), False
+                relu = relu and compute
+            encoder.run(min(addr, BUFFER_SIZE - resultWords(n)), compute=compute, quantize=quantize, relu=relu)
+        elif kind == 6:
+            encoder.fetchResults(min(addr, BUFFER_SIZE - resultWords(n)), n)
+        else:
+            encoder.nop() if rng.random() < 0.5 else encoder.halt()
+    return program + encoder.getProgram()
+
+
+#run programs on BatchISAModel and on one ISAModel each, list of mismatching instances
+#instances that fault must fault in the scalar model too; others must agree on
+#transmitted bytes, buffer, PE weights and inputs
+def compareWithScalar(programs, array_size: int = ARRAY_SIZE):
+    batch = BatchISAModel(len(programs), array_size)
+    received = batch.execute(programs, strict=False)
+
+    mismatches = []
+    for k, program in enumerate(programs):
+        model = ISAModel(array_size=array_size)
+        try:
+            scalarReceived = model.execute(program)
+        except ValueError:
+            if batch.faults[k] < 0:
+                mismatches.append(k)
+            continue
+        state = batch.toScalar(k)
+        if (batch.faults[k] >= 0 or scalarReceived != received[k] or state.buffer != model.buffer
+                or state.weights != model.weights or state.inputs != model.inputs
+                or state.instructionCount != model.instructionCount):
+            mismatches.append(k)
+    return mismatches
+
+
+def main():
+    import argparse
+    import os
+    from tiled_inference import TiledInferenceEngine, get_default_paths
+
+    weights_dir, model_path, data_dir = get_default_paths()
+
+    parser = argparse.ArgumentParser(description='uTPU vectorized multi-instance ISA simulator')
+    parser.add_argument('--instances', '-k', type=int, default=1024)
+    parser.add_argument('--length', type=int, default=256, help='Instructions per fuzz program')
+    parser.add_argument('--rounds', type=int, default=4)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--weights', type=str, default=weights_dir)
+    parser.add_argument('--model', type=str, default=model_path)
+    parser.add_argument('--data', type=str, default=data_dir)
+    parser.add_argument('--num-samples', type=int, default=100,
+                        help='Images for the tiled engine comparison (0 to skip)')
+    args = parser.parse_args()
+
+    print("=" * 60)
+    print("uTPU Batch ISA Simulator")
+    print("=" * 60)
+
+    rng = np.random.default_rng(args.seed)
+    n = ARRAY_SIZE
+    failures = 0
+    batchSeconds = scalarSeconds = 0.0
+    instructions = 0
+    for round in range(args.rounds):
+        programs = [randomProgram(rng, args.length, n) for _ in range(args.instances)]
+        arrays = decodePrograms(programs)
+        instructions += arrays.instructions
+
+        start = time.perf_counter()
+        BatchISAModel(args.instances, n).execute(arrays, strict=False)
+        batchSeconds += time.perf_counter() - start
+
+        #scalar reference speed on a slice, the full comparison follows
+        start = time.perf_counter()
+        for program in programs[:64]:
+            try:
+                ISAModel(array_size=n).execute(program)
+            except ValueError:
+                pass
+        scalarSeconds += (time.perf_counter() - start) * len(programs) / min(64, len(programs))
+
+        mismatches = compareWithScalar(programs, n)
+        failures += len(mismatches)
+        print(f"Round {round}: {args.instances} programs, {arrays.instructions} instructions, "
+              f"{len(mismatches)} mismatches")
+
+    print(f"\nFuzz: {failures} mismatching programs")
+    print(f"Batch:  {instructions / batchSeconds / 1e6:.2f} M instructions/s")
+    print(f"Scalar: {instructions / scalarSeconds / 1e6:.2f} M instructions/s (estimated)")
+
+    if args.num_samples:
+        images = np.load(os.path.join(args.data, 'mnist_14x14_test.npy'))[:args.num_samples]
+
+        #scalar reference: each tile is its own program on one ISAModel
+        runner = BatchTileRunner(n)
+        def run_tile(weight_tile, input_tile):
+            received = ISAModel(array_size=n).execute(runner.program(weight_tile, input_tile))
+            return ((np.frombuffer(received, dtype=np.uint8).astype(np.int32) & 0xF) ^ 8) - 8
+
+        scalar = TiledInferenceEngine(args.weights, args.model, tile_runner=run_tile)
+        start = time.perf_counter()
+        expected = np.stack([scalar.forward(image) for image in images])
+        scalarTime = time.perf_counter() - start
+
+        batch = TiledInferenceEngine(args.weights, args.model, batch_tile_runner=runner)
+        start = time.perf_counter()
+        logits = batch.forward_batch(images)
+        batchTime = time.perf_counter() - start
+
+        match = np.array_equal(expected, logits)
+        print(f"\nTiled engine on {len(images)} images: logits {'identical' if match else 'DIFFER'}")
+        print(f"  Scalar ISAModel per tile: {scalarTime:.2f} s")
+        print(f"  BatchISAModel per batch:  {batchTime:.2f} s "
+              f"({runner.instructions / runner.seconds / 1e6:.2f} M instructions/s in the simulator)")
+        failures += 0 if match else 1
+
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
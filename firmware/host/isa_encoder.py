@@ -1,6 +1,8 @@
 from typing import List, Tuple
 import struct
 
+import numpy as np
+
 
 OPCODE_STORE = 0b000 #0 - store data to buffer
 OPCODE_FETCH = 0b001 #1 - fetch data from buffer
@@ -23,6 +25,11 @@ def int4To16(values: List[int]) -> int:
         result |= (nibble << (i*4))
     return result
 
+#pack any number of int4 values into 16-bit words (4 per word, low nibble first)
+def int4ToWords(values: List[int]) -> List[int]:
+    values = list(values)
+    return [int4To16(values[i:i + 4]) for i in range(0, max(len(values), 1), 4)]
+
 #check if valid address
 def encodeAddress(addr: int) -> int:
     if not 0 <= addr <= 511: 
@@ -112,6 +119,36 @@ def encodeFetch(addr: int, top_half: bool = True) -> bytes:
     instruction |= (addr << 7) #bits 7-15
     return instructionToBytes(instruction)
 
+#FETCH both halves of num_words consecutive words (bottom byte first)
+#built as one uint16 array, so whole-buffer bursts cost no per-instruction python
+def encodeFetchWords(base_addr: int, num_words: int) -> bytes:
+    if num_words <= 0:
+        return b''
+    encodeAddress(base_addr)
+    encodeAddress(base_addr + num_words - 1)
+    addrs = np.repeat(np.arange(base_addr, base_addr + num_words, dtype=np.uint16), 2)
+    top = np.tile(np.array([0, 1], dtype=np.uint16), num_words)
+    return (OPCODE_FETCH | (top << 3) | (addrs << 7)).astype('<u2').tobytes()
+
+#immediate STORE of raw 16-bit words to consecutive addresses from base_addr
+#same bytes as one encodeStoreValues per word, built as one array
+def encodeStoreWords(base_addr: int, words) -> bytes:
+    words = np.asarray(words, dtype=np.int64).reshape(-1)
+    if words.size == 0:
+        return b''
+    encodeAddress(base_addr)
+    encodeAddress(base_addr + words.size - 1)
+    program = np.empty((words.size, 3), dtype='<u2')
+    program[:, 0] = OPCODE_STORE | (1 << 4)
+    program[:, 1] = words & 0xFFFF
+    program[:, 2] = np.arange(base_addr, base_addr + words.size)
+    return program.tobytes()
+
+#FETCH the first `rows` bytes of a RUN result region
+#RUN stores one output per byte: output r is in word r // 2, top half if r is odd
+def encodeFetchResults(result_addr: int, rows: int) -> bytes:
+    return b''.join(encodeFetch(result_addr + r // 2, top_half=bool(r % 2)) for r in range(rows))
+
 #encode HALT instruction
 def encodeHalt() -> bytes: 
     """
@@ -136,6 +173,12 @@ class ISAEncoder:
         self.instructions.append(encodeStoreValues(addr, values))
         return self
     
+    #add one STORE per word needed to hold values (tiles larger than 2x2)
+    def storeWords(self, addr: int, values: List[int]) -> "ISAEncoder":
+        for i, word in enumerate(int4ToWords(values)):
+            self.instructions.append(encodeStoreValues(addr + i, [(word >> (4 * j)) & 0xF for j in range(4)]))
+        return self
+
     #add LOADWEI instruction
     def loadWeights(self, addr: int) -> "ISAEncoder":
         self.instructions.append(encodeLoadWeights(addr))
@@ -157,6 +200,11 @@ class ISAEncoder:
         self.instructions.append(encodeFetch(addr, top_half))
         return self
     
+    #add FETCHes for the first `rows` outputs of a RUN result region
+    def fetchResults(self, result_addr: int, rows: int) -> "ISAEncoder":
+        self.instructions.append(encodeFetchResults(result_addr, rows))
+        return self
+
     #add HALT instruction
     def halt(self) -> "ISAEncoder":
         self.instructions.append(encodeHalt())
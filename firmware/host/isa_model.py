@@ -0,0 +1,272 @@
+from typing import List, NamedTuple
+import struct
+
+import numpy as np
+
+from isa_encoder import (
+    OPCODE_STORE,
+    OPCODE_FETCH,
+    OPCODE_RUN,
+    OPCODE_LOAD,
+    OPCODE_HALT,
+    OPCODE_NOP,
+    instructionToBytes,
+    int4ToWords,
+)
+from utpu_config import ARRAY_SIZE, ACCUMULATOR_DATA_WIDTH, INPUT_DATA_WIDTH, RELU_ALPHA
+
+
+# hardware arithmetic (mirrors rtl/quantizer and rtl/LeakyReLU)
+COMPUTE_DATA_WIDTH = INPUT_DATA_WIDTH
+
+BUFFER_SIZE = 512
+
+# RUN writes output row r of the array to nibble 2r of the result region,
+# i.e. nibble RESULT_LANES[r % 2] of word r // 2, so each FETCH byte carries
+# one result in its low nibble
+RESULT_LANES = (0, 2)
+
+
+#words read by LOADWEI for an NxN array (N*N nibbles, row-major)
+def weightWords(array_size: int = ARRAY_SIZE) -> int:
+    return (array_size * array_size + 3) // 4
+
+#words read by LOADIN (N nibbles)
+def inputWords(array_size: int = ARRAY_SIZE) -> int:
+    return (array_size + 3) // 4
+
+#words written by RUN (one output per byte)
+def resultWords(array_size: int = ARRAY_SIZE) -> int:
+    return (array_size + 1) // 2
+
+# RUN flag bits (bits 3-5 of the instruction)
+RUN_COMPUTE = 0b001
+RUN_QUANTIZE = 0b010
+RUN_RELU = 0b100
+
+
+#decoded instruction
+#addr is the destination (STORE), source (LOAD/FETCH) or result (RUN) address
+#operand is the immediate word or source address of a STORE
+#flags holds bits 3-6 of the first instruction word
+class Instruction(NamedTuple):
+    opcode: int
+    addr: int = 0
+    operand: int = 0
+    flags: int = 0
+
+    #STORE with an immediate value (vs copy from address)
+    @property
+    def immediate(self) -> bool:
+        return bool(self.flags & 0b10)
+
+    #number of bytes this instruction takes on the wire
+    @property
+    def size(self) -> int:
+        return 6 if self.opcode == OPCODE_STORE else 2
+
+    def toBytes(self) -> bytes:
+        if self.opcode == OPCODE_STORE:
+            word1 = OPCODE_STORE | (self.flags << 3)
+            return (instructionToBytes(word1) + instructionToBytes(self.operand)
+                    + instructionToBytes(self.addr))
+        return instructionToBytes(self.opcode | (self.flags << 3) | (self.addr << 7))
+
+
+#sign extend the low `bits` bits of value
+def wrapSigned(value: int, bits: int) -> int:
+    mask = (1 << bits) - 1
+    value &= mask
+    if value >= 1 << (bits - 1):
+        value -= 1 << bits
+    return value
+
+
+#int16 accumulator -> int4 (quantizer.sv: in >>> (ACC - COMPUTE))
+def quantizeAccumulator(acc: int) -> int:
+    acc = wrapSigned(acc, ACCUMULATOR_DATA_WIDTH)
+    return wrapSigned(acc >> (ACCUMULATOR_DATA_WIDTH - COMPUTE_DATA_WIDTH), COMPUTE_DATA_WIDTH)
+
+
+#leaky_relu.sv: x if x >= 0 else x >>> ALPHA
+def leakyRelu(value: int) -> int:
+    return value if value >= 0 else value >> RELU_ALPHA
+
+
+#vectorized quantizeAccumulator over an integer array (any shape)
+def quantizeAccumulatorArray(acc: np.ndarray) -> np.ndarray:
+    acc = np.asarray(acc, dtype=np.int32)
+    half = 1 << (ACCUMULATOR_DATA_WIDTH - 1)
+    acc = ((acc + half) & ((1 << ACCUMULATOR_DATA_WIDTH) - 1)) - half
+    acc >>= ACCUMULATOR_DATA_WIDTH - COMPUTE_DATA_WIDTH
+    half = 1 << (COMPUTE_DATA_WIDTH - 1)
+    return ((acc + half) & ((1 << COMPUTE_DATA_WIDTH) - 1)) - half
+
+
+#vectorized leakyRelu
+def leakyReluArray(values: np.ndarray) -> np.ndarray:
+    values = np.asarray(values, dtype=np.int32)
+    return np.where(values >= 0, values, values >> RELU_ALPHA)
+
+
+#unpack a 16-bit word into four signed int4 values
+def wordToInt4(word: int) -> List[int]:
+    return [wrapSigned(word >> (4 * i), 4) for i in range(4)]
+
+
+#pack RUN outputs into result words
+def packResultWords(outputs: List[int]) -> List[int]:
+    nibbles = [0] * (4 * ((len(outputs) + 1) // 2))
+    for r, value in enumerate(outputs):
+        nibbles[2 * r] = value
+    return int4ToWords(nibbles)
+
+#pack 2x2 RUN outputs into a result word
+def packResultWord(outputs: List[int]) -> int:
+    return packResultWords(outputs)[0]
+
+
+#decode one byte stream into a list of instructions
+def decodeProgram(program: bytes) -> List[Instruction]:
+    if len(program) % 2:
+        raise ValueError(f"Program length {len(program)} is not a whole number of words")
+
+    words = struct.unpack(f"<{len(program) // 2}H", program)
+    instructions = []
+    i = 0
+    while i < len(words):
+        word = words[i]
+        opcode = word & 0x7
+        flags = (word >> 3) & 0xF
+
+        if opcode == OPCODE_STORE:
+            if i + 2 >= len(words):
+                raise ValueError(f"Truncated STORE at word {i}")
+            instructions.append(Instruction(OPCODE_STORE, words[i + 2] & 0x1FF, words[i + 1], flags))
+            i += 3
+            continue
+
+        if opcode not in (OPCODE_FETCH, OPCODE_RUN, OPCODE_LOAD, OPCODE_HALT, OPCODE_NOP):
+            raise ValueError(f"Unknown opcode {opcode:03b} at word {i}")
+
+        instructions.append(Instruction(opcode, word >> 7, 0, flags))
+        i += 1
+
+    return instructions
+
+
+#encode a list of instructions back into a byte stream
+def encodeProgram(instructions: List[Instruction]) -> bytes:
+    return b''.join(instr.toBytes() for instr in instructions)
+
+
+#host-side model of the uTPU core as seen through the ISA
+#HALT is treated as an end-of-program marker: the host keeps sending programs after it
+class ISAModel:
+    def __init__(self, array_size: int = ARRAY_SIZE):
+        self.arraySize = array_size
+        self.reset()
+
+    def reset(self) -> None:
+        n = self.arraySize
+        self.buffer = [0] * BUFFER_SIZE
+        self.weights = [[0] * n for _ in range(n)]
+        self.inputs = [0] * n
+        self.instructionCount = 0
+
+    #consecutive int4 values starting at addr
+    def readNibbles(self, addr: int, count: int) -> List[int]:
+        words = (count + 3) // 4
+        if addr + words > BUFFER_SIZE:
+            raise ValueError(f"Read of {words} words at 0x{addr:03X} runs past the buffer")
+        nibbles = []
+        for i in range(words):
+            nibbles.extend(wordToInt4(self.buffer[addr + i]))
+        return nibbles[:count]
+
+    #read a word from the unified buffer
+    def readWord(self, addr: int) -> int:
+        return self.buffer[addr]
+
+    #write a word to the unified buffer
+    def writeWord(self, addr: int, value: int) -> None:
+        self.buffer[addr] = value & 0xFFFF
+
+    #compute the NxN array outputs for the current PE array state
+    def runOutputs(self, flags: int) -> List[int]:
+        compute = bool(flags & RUN_COMPUTE)
+        quantize = bool(flags & RUN_QUANTIZE)
+        relu = bool(flags & RUN_RELU)
+
+        if compute:
+            if not quantize:
+                raise ValueError("RUN with compute but without quantize is not supported by the RTL")
+            outputs = []
+            for row in self.weights:
+                acc = sum(w * x for w, x in zip(row, self.inputs))
+                outputs.append(quantizeAccumulator(acc))
+        elif relu and not quantize:
+            outputs = list(self.inputs)
+        else:
+            raise ValueError(f"Unsupported RUN flag combination {flags:03b}")
+
+        if relu:
+            outputs = [leakyRelu(v) for v in outputs]
+        return outputs
+
+    #execute one instruction, returns the bytes the chip would transmit
+    def step(self, instr: Instruction) -> bytes:
+        self.instructionCount += 1
+        opcode = instr.opcode
+
+        if opcode == OPCODE_STORE:
+            value = instr.operand if instr.immediate else self.buffer[instr.operand & 0x1FF]
+            self.writeWord(instr.addr, value)
+        elif opcode == OPCODE_LOAD:
+            n = self.arraySize
+            if instr.flags & 0b1:
+                nibbles = self.readNibbles(instr.addr, n * n)
+                self.weights = [nibbles[r * n:(r + 1) * n] for r in range(n)]
+            else:
+                self.inputs = self.readNibbles(instr.addr, n)
+        elif opcode == OPCODE_RUN:
+            words = packResultWords(self.runOutputs(instr.flags))
+            if instr.addr + len(words) > BUFFER_SIZE:
+                raise ValueError(f"RUN result at 0x{instr.addr:03X} runs past the buffer")
+            for i, word in enumerate(words):
+                self.writeWord(instr.addr + i, word)
+        elif opcode == OPCODE_FETCH:
+            word = self.buffer[instr.addr]
+            return bytes([(word >> 8) & 0xFF if instr.flags & 0b1 else word & 0xFF])
+        return b''
+
+    #execute a full program, returns everything the chip would transmit
+    def execute(self, program: bytes) -> bytes:
+        return b''.join(self.step(instr) for instr in decodeProgram(program))
+
+
+if __name__ == "__main__":
+    from isa_encoder import ISAEncoder
+
+    print("ISA Model Test")
+    print("=" * 50)
+
+    encoder = ISAEncoder()
+    encoder.store(0x080, [1, 2, 3, 4])
+    encoder.loadWeights(0x080)
+    encoder.store(0x000, [1, 1, 0, 0])
+    encoder.loadInputs(0x000)
+    encoder.run(0x100, compute=True, quantize=True, relu=True)
+    encoder.fetch(0x100, top_half=False)
+    encoder.fetch(0x100, top_half=True)
+    encoder.halt()
+
+    program = encoder.getProgram()
+    model = ISAModel()
+    received = model.execute(program)
+
+    print(f"Decoded: {decodeProgram(program)}")
+    print(f"Round trip exact: {encodeProgram(decodeProgram(program)) == program}")
+    print(f"Weights: {model.weights}, inputs: {model.inputs}")
+    print(f"Result word: 0x{model.readWord(0x100):04X}")
+    print(f"Fetched: {received.hex()}")
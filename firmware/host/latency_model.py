@@ -0,0 +1,114 @@
+import numpy as np
+from collections import deque
+from typing import Dict, Optional
+
+
+#learns per-operation round-trip times so the host can wait exactly as long as needed
+#times are stored per unit (e.g. per expected RX byte) so batches of any size share a model
+class LatencyModel:
+
+    def __init__(self, alpha: float = 0.2, percentile: float = 99.0, window: int = 256,
+                 margin: float = 2.0, floor: float = 0.005, initial_timeout: float = 0.5,
+                 warmup: int = 8):
+        self.alpha = alpha
+        self.percentile = percentile
+        self.window = window
+        self.margin = margin
+        self.floor = floor
+        self.initial_timeout = initial_timeout
+        self.warmup = warmup
+        self.ops = {}
+
+    def _stats(self, op):
+        if op not in self.ops:
+            self.ops[op] = {
+                'ewma': None,
+                'samples': deque(maxlen=self.window),
+                'count': 0,
+                'timeouts': 0,
+                'backoff': 1.0,
+            }
+        return self.ops[op]
+
+    #record a completed round trip of `size` units
+    def record(self, op: str, seconds: float, size: int = 1) -> None:
+        stats = self._stats(op)
+        perUnit = seconds / max(size, 1)
+
+        if stats['ewma'] is None:
+            stats['ewma'] = perUnit
+        else:
+            stats['ewma'] += self.alpha * (perUnit - stats['ewma'])
+
+        stats['samples'].append(perUnit)
+        stats['count'] += 1
+        stats['backoff'] = 1.0
+
+    #record a round trip that ran into its timeout, widens the next timeout
+    def recordTimeout(self, op: str) -> None:
+        stats = self._stats(op)
+        stats['timeouts'] += 1
+        stats['backoff'] = min(stats['backoff'] * 2.0, 16.0)
+
+    #smoothed expected time for `size` units
+    def expected(self, op: str, size: int = 1) -> Optional[float]:
+        stats = self.ops.get(op)
+        if stats is None or stats['ewma'] is None:
+            return None
+        return stats['ewma'] * size
+
+    #tail latency for `size` units
+    def tail(self, op: str, size: int = 1) -> Optional[float]:
+        stats = self.ops.get(op)
+        if stats is None or not stats['samples']:
+            return None
+        return float(np.percentile(stats['samples'], self.percentile)) * size
+
+    #how long to wait for `size` units before giving up
+    #starts at initial_timeout and shrinks toward margin * tail once warmed up
+    def timeout(self, op: str, size: int = 1) -> float:
+        stats = self.ops.get(op)
+        base = self.initial_timeout + 0.002 * size
+        if stats is None or len(stats['samples']) < self.warmup:
+            backoff = stats['backoff'] if stats is not None else 1.0
+            return base * backoff
+
+        learned = max(self.floor, self.margin * self.tail(op, size))
+        return min(learned, base) * stats['backoff']
+
+    #per-op snapshot of the model
+    def summary(self) -> Dict[str, dict]:
+        return {
+            op: {
+                'count': stats['count'],
+                'timeouts': stats['timeouts'],
+                'ewma': stats['ewma'],
+                'tail': self.tail(op),
+                'timeout': self.timeout(op),
+            }
+            for op, stats in self.ops.items()
+        }
+
+    #human readable summary (times per unit, in ms)
+    def report(self) -> str:
+        lines = [f"{'op':<12} {'count':>6} {'timeouts':>8} {'ewma ms':>9} {'p' + format(self.percentile, 'g') + ' ms':>9} {'timeout ms':>10}"]
+        for op, s in self.summary().items():
+            ewma = f"{1000 * s['ewma']:.3f}" if s['ewma'] is not None else "-"
+            tail = f"{1000 * s['tail']:.3f}" if s['tail'] is not None else "-"
+            lines.append(f"{op:<12} {s['count']:>6} {s['timeouts']:>8} {ewma:>9} {tail:>9} {1000 * s['timeout']:>10.3f}")
+        return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    print("Latency Model Test")
+    print("=" * 50)
+
+    rng = np.random.default_rng(0)
+    model = LatencyModel()
+    for i in range(50):
+        model.record('tile', 0.004 + rng.exponential(0.001), size=2)
+        if i in (0, 7, 8, 49):
+            print(f"after {i+1:>2} samples: timeout {1000 * model.timeout('tile', 2):.2f} ms")
+
+    print()
+    print(model.report())
@@ -0,0 +1,98 @@
+import time
+from typing import Optional
+
+import numpy as np
+
+from isa_encoder import OPCODE_STORE
+from isa_model import ISAModel, decodeProgram
+from utpu_config import ARRAY_SIZE
+
+
+# board stand-in with the UARTDriver interface: every byte sent is executed by
+# the host ISA model and whatever the core would transmit is queued for reading
+# instructions may be split across writes (bytes are held until one is complete)
+# baud set adds the wire time of every TX and RX byte (10 bits per byte), so
+# bandwidth numbers come out close to a real link at that rate
+# drop_rate loses each transmitted byte with that probability (fault injection:
+# the host sees a short read, i.e. a timeout)
+class LoopbackUART:
+    FIFO_SIZE = 256
+
+    def __init__(self, array_size: int = ARRAY_SIZE, baud: Optional[int] = None,
+                 model: Optional[ISAModel] = None, drop_rate: float = 0.0, seed: int = 0):
+        self.port = 'loopback'
+        self.baud = baud
+        self.model = model if model is not None else ISAModel(array_size)
+        self.dropRate = drop_rate
+        self.rng = np.random.default_rng(seed)
+        self.dropped = 0
+        self.rx = bytearray()
+        self.pending = bytearray()
+
+    def _wire(self, count: int) -> None:
+        if self.baud:
+            time.sleep(10.0 * count / self.baud)
+
+    # bytes of whole instructions at the front of pending
+    def _complete(self) -> int:
+        pos = 0
+        while pos + 2 <= len(self.pending):
+            size = 6 if self.pending[pos] & 0x7 == OPCODE_STORE else 2
+            if pos + size > len(self.pending):
+                break
+            pos += size
+        return pos
+
+    def send_byte(self, data: int) -> None:
+        if not 0 <= data <= 255:
+            raise ValueError(f"Byte value must be 0-255, got {data}")
+        self.send_bytes_to_chip(bytes([data]))
+
+    def send_bytes_to_chip(self, data: bytes) -> None:
+        self._wire(len(data))
+        self.pending += data
+        complete = self._complete()
+        if complete:
+            for instr in decodeProgram(bytes(self.pending[:complete])):
+                data = self.model.step(instr)
+                if data and self.dropRate and self.rng.random() < self.dropRate:
+                    self.dropped += len(data)
+                    continue
+                self.rx += data
+            del self.pending[:complete]
+
+    def receive_byte(self) -> Optional[int]:
+        data = self.receive_bytes(1)
+        return data[0] if data else None
+
+    # nothing arrives later on a loopback, so every receive returns what is queued
+    def receive_bytes(self, count: int) -> bytes:
+        data = bytes(self.rx[:count])
+        del self.rx[:count]
+        self._wire(len(data))
+        return data
+
+    def receive_exact(self, count: int, timeout: Optional[float] = None) -> bytes:
+        return self.receive_bytes(count)
+
+    def receive_blocking(self, count: int, timeout: float) -> bytes:
+        return self.receive_bytes(count)
+
+    def flush_input(self) -> None:
+        self.rx.clear()
+
+    def flush_output(self) -> None:
+        pass
+
+    def bytes_waiting(self) -> int:
+        return len(self.rx)
+
+    def close(self) -> None:
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+        return False
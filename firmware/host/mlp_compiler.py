@@ -0,0 +1,584 @@
+import json
+import os
+import sys
+import time
+from collections import OrderedDict
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+
+from isa_encoder import ISAEncoder, encodeStoreValues
+from isa_model import (decodeProgram, inputWords, resultWords, weightWords,
+                       quantizeAccumulatorArray, leakyReluArray)
+from program_loader import PingPongAllocator
+from result_cache import hashParts
+from result_decoder import unpackInt4
+from tiled_inference import load_layers, requantize_leaky_relu_, get_default_paths
+from conv_layer import im2col_weights, pad_input, operand_starts, conv_output_size
+from export_weights import nonzero_tile_mask
+from utpu_config import ARRAY_SIZE
+
+
+PLAN_VERSION = 2
+BACKENDS = ('numpy', 'emulate', 'board')
+# an immediate STORE is (opcode word, value word, address word)
+STORE_BYTES = len(encodeStoreValues(0, [0]))
+STORE_VALUE_OFFSET = 2
+
+# conv streams: cached operand words, resident weight tiles, RUN results
+CONV_OPERAND_REGION = (0x000, 0x100)
+CONV_WEIGHT_REGION = (0x100, 0x180)
+CONV_RESULT_REGION = (0x180, 0x200)
+
+
+# compiled form of one layer
+# the layer is a sequence of RUNs: RUN g multiplies weight tile runWeights[g]
+# with the N input values starting at runOperands[g] of the padded input
+# (the input vector for fc layers, the zero-padded map for conv layers) and
+# its outputs accumulate into output features resultIndex[g] (-1: padding row).
+# program is the layer's instruction stream with every operand word zero: per
+# image only the value words at inputSlots change, slot k takes the
+# slotLengths[k] (<= 4) input values starting at slotStarts[k]
+class LayerPlan(NamedTuple):
+    name: str
+    kind: str
+    shape: Tuple[int, int]
+    activation: str
+    scale: float
+    requant: Tuple[int, int]
+    conv: Optional[Dict]
+    gridTiles: int
+    weights: np.ndarray
+    runWeights: np.ndarray
+    runOperands: np.ndarray
+    resultIndex: np.ndarray
+    addresses: np.ndarray
+    program: bytes
+    inputSlots: np.ndarray
+    slotStarts: np.ndarray
+    slotLengths: np.ndarray
+    instructions: int
+
+    # RX bytes one image returns (one per RUN output)
+    @property
+    def resultBytes(self) -> int:
+        return int(self.resultIndex.size)
+
+
+# tiled execution plan for a whole layer stack
+# quantize/relu are the RUN flags of every hardware tile; the layer activation
+# and requantization always run on the host after the int32 accumulation
+class MLPPlan(NamedTuple):
+    modelHash: bytes
+    arraySize: int
+    quantize: bool
+    relu: bool
+    layers: List[LayerPlan]
+
+    # int4 inputs (batch, in_features) -> padded inputs the operands index into
+    def padInputs(self, layer: LayerPlan, inputs: np.ndarray) -> np.ndarray:
+        n = self.arraySize
+        if layer.kind == 'conv':
+            return pad_input(inputs, layer.conv, n)
+        padded = np.zeros((len(inputs), -(-layer.shape[1] // n) * n), dtype=np.int8)
+        padded[:, :layer.shape[1]] = inputs
+        return padded
+
+    # value words of every input slot for padded inputs, (batch, slots)
+    def slotWordArray(self, layer: LayerPlan, padded: np.ndarray) -> np.ndarray:
+        lanes = np.arange(4)
+        padded = np.concatenate([padded, np.zeros((len(padded), 4), dtype=padded.dtype)], axis=1)
+        nibbles = padded[:, layer.slotStarts[:, None] + lanes].astype(np.uint16) & 0xF
+        nibbles[:, lanes[None, :] >= layer.slotLengths[:, None]] = 0
+        return (nibbles << (4 * lanes).astype(np.uint16)).sum(axis=-1, dtype=np.uint16)
+
+    # the layer's instruction stream for one int4 input vector
+    def instantiate(self, layer: LayerPlan, inputs: np.ndarray) -> bytes:
+        padded = self.padInputs(layer, np.asarray(inputs).reshape(1, -1))
+        words = self.slotWordArray(layer, padded)[0]
+        program = np.frombuffer(layer.program, dtype=np.uint8).copy()
+        program[layer.inputSlots] = words & 0xFF
+        program[layer.inputSlots + 1] = words >> 8
+        return program.tobytes()
+
+    # per-RUN outputs of a layer, (batch, runs, N)
+    # numpy: exact int32 tile products (what the host-accumulated reference computes)
+    # emulate: bit-accurate RUN outputs (int16 wrap, >>12, int4 wrap, optional relu)
+    # board: the instantiated stream through a ProgramLoader
+    def tileOutputs(self, layer: LayerPlan, inputs: np.ndarray, backend: str = 'numpy',
+                    loader=None) -> np.ndarray:
+        n = self.arraySize
+        if backend == 'board':
+            if loader is None:
+                raise ValueError("The board backend needs a ProgramLoader")
+            outputs = np.empty((len(inputs), len(layer.runWeights), n), dtype=np.int32)
+            for b, x in enumerate(inputs):
+                received = loader.streamProgram(self.instantiate(layer, x), layer.resultBytes)
+                if len(received) < layer.resultBytes:
+                    raise RuntimeError(f"{layer.name}: board returned {len(received)}/{layer.resultBytes} "
+                                       f"bytes (UART timeout?)")
+                outputs[b] = unpackInt4(received)[0::2].reshape(-1, n)
+            return outputs
+
+        padded = self.padInputs(layer, inputs).astype(np.int32)
+        operands = padded[:, layer.runOperands[:, None] + np.arange(n)]
+        outputs = np.einsum('gij,bgj->bgi', layer.weights.astype(np.int32)[layer.runWeights], operands)
+        if backend == 'emulate':
+            outputs = quantizeAccumulatorArray(outputs)
+            if self.relu:
+                outputs = leakyReluArray(outputs)
+        return outputs
+
+    # int32 accumulators of a layer, (batch, out_features)
+    def accumulate(self, layer: LayerPlan, inputs: np.ndarray, backend: str = 'numpy',
+                   loader=None) -> np.ndarray:
+        outputs = self.tileOutputs(layer, inputs, backend, loader)
+        out_features = layer.shape[0]
+        index = np.where(layer.resultIndex < 0, out_features, layer.resultIndex).reshape(-1)
+        accum = np.zeros((len(inputs), out_features + 1), dtype=np.int32)
+        np.add.at(accum, (slice(None), index), outputs.reshape(len(inputs), -1))
+        return accum[:, :out_features]
+
+    # run the plan on int4 inputs (batch, in), returns float logits (batch, out)
+    def forward(self, inputs: np.ndarray, backend: str = 'numpy', loader=None) -> np.ndarray:
+        if backend not in BACKENDS:
+            raise ValueError(f"Unknown backend '{backend}', expected one of {BACKENDS}")
+        x = np.asarray(inputs, dtype=np.int8)
+        for index, layer in enumerate(self.layers):
+            accum = self.accumulate(layer, x, backend, loader)
+            if index == len(self.layers) - 1:
+                return accum.astype(np.float32) * layer.scale
+            multiplier, shift = layer.requant
+            x = requantize_leaky_relu_(accum, multiplier, shift, layer.activation == 'leaky_relu').astype(np.int8)
+        return x
+
+    # per-layer and total plan statistics
+    # operand_stores is how many operand words the stream STOREs, operand_uses
+    # how many LOADINs read one (equal unless operand words are reused)
+    def summary(self) -> Dict[str, object]:
+        layers = []
+        for layer in self.layers:
+            layers.append({
+                'name': layer.name,
+                'kind': layer.kind,
+                'shape': list(layer.shape),
+                'activation': layer.activation,
+                'tiles': len(layer.weights),
+                'zero_tiles': layer.gridTiles - len(layer.weights),
+                'runs': len(layer.runWeights),
+                'operand_stores': len(layer.inputSlots),
+                'operand_uses': len(layer.runWeights) * inputWords(self.arraySize),
+                'instructions': layer.instructions,
+                'tx_bytes': len(layer.program),
+                'rx_bytes': layer.resultBytes,
+                'buffer_top': int(layer.addresses.max()) if len(layer.addresses) else 0,
+            })
+        return {
+            'model_hash': self.modelHash.hex()[:16],
+            'array_size': self.arraySize,
+            'layers': layers,
+            'tx_bytes': sum(layer['tx_bytes'] for layer in layers),
+            'rx_bytes': sum(layer['rx_bytes'] for layer in layers),
+        }
+
+
+# compiles exported layer stacks (tiled_inference.load_layers) into MLPPlans
+# plans are cached per model hash in memory and, with cache_dir, on disk as
+# <hash>.npz so a model is only compiled once
+class MLPCompiler:
+
+    def __init__(self, array_size: int = ARRAY_SIZE, quantize: bool = True, relu: bool = False,
+                 cache_dir: Optional[str] = None, verbose: bool = False):
+        self.arraySize = array_size
+        self.quantize = quantize
+        self.relu = relu
+        self.cacheDir = cache_dir
+        self.verbose = verbose
+        self.plans = {}   # model hash -> MLPPlan
+        self.stats = {'compiles': 0, 'hits': 0, 'disk_hits': 0}
+
+    def _log(self, message):
+        if self.verbose:
+            print(f"[MLPCompiler] {message}")
+
+    # everything that changes the plan: layers, array size and RUN flags
+    def modelHash(self, layers) -> bytes:
+        parts = [PLAN_VERSION, self.arraySize, self.quantize, self.relu]
+        for layer in layers:
+            conv = layer.get('conv')
+            parts += [layer['name'], layer['weight'], layer['scale'], tuple(layer['requant']),
+                      layer['activation'], sorted(conv.items()) if conv else None]
+        return hashParts(parts)
+
+    # plan for a layer stack, from the cache when this model was compiled before
+    def compile(self, layers) -> MLPPlan:
+        key = self.modelHash(layers)
+        if key in self.plans:
+            self.stats['hits'] += 1
+            return self.plans[key]
+
+        plan = self._loadPlan(key)
+        if plan is not None:
+            self.stats['disk_hits'] += 1
+        else:
+            start = time.perf_counter()
+            plan = MLPPlan(key, self.arraySize, self.quantize, self.relu,
+                           [self._compileConvLayer(layer) if layer.get('conv') else self._compileLayer(layer)
+                            for layer in layers])
+            self.stats['compiles'] += 1
+            self._log(f"Compiled {len(layers)} layers in {1000 * (time.perf_counter() - start):.1f} ms")
+            self._savePlan(plan)
+
+        self.plans[key] = plan
+        return plan
+
+    # nonzero NxN tiles of a weight matrix: (row, col) positions, the tiles
+    # and the size of the full tile grid
+    def _tiles(self, matrix):
+        n = self.arraySize
+        mask = nonzero_tile_mask(matrix, n)
+        rows, cols = mask.shape
+        padded = np.zeros((rows * n, cols * n), dtype=np.int8)
+        padded[:matrix.shape[0], :matrix.shape[1]] = matrix
+        tiles = np.argwhere(mask).astype(np.int32).reshape(-1, 2)
+        return tiles, padded.reshape(rows, n, cols, n).transpose(0, 2, 1, 3)[tiles[:, 0], tiles[:, 1]], mask.size
+
+    # STORE an operand with placeholder values, recording where its value words are
+    # offset is the stream length before the encoder's current instructions
+    def _storeOperand(self, encoder, offset, addr, start, inputSlots, slotStarts, slotLengths):
+        n = self.arraySize
+        slotBase = offset + len(encoder.getProgram())
+        encoder.storeWords(addr, [0] * (4 * inputWords(n)))
+        for w in range(inputWords(n)):
+            inputSlots.append(slotBase + STORE_BYTES * w + STORE_VALUE_OFFSET)
+            slotStarts.append(start + 4 * w)
+            slotLengths.append(min(4, n - 4 * w))
+
+    def _layerPlan(self, layer, kind, shape, gridTiles, weights, runs, addresses, program, slots):
+        runWeights, runOperands, resultIndex = runs
+        inputSlots, slotStarts, slotLengths = slots
+        self._log(f"{layer['name']}: {len(runWeights)} RUNs over {len(weights)}/{gridTiles} tiles, "
+                  f"{len(inputSlots)} operand STOREs, {len(program)} bytes")
+        return LayerPlan(
+            name=layer['name'],
+            kind=kind,
+            shape=shape,
+            activation=layer['activation'],
+            scale=float(layer['scale']),
+            requant=tuple(int(v) for v in layer['requant']),
+            conv=dict(layer['conv']) if layer.get('conv') else None,
+            gridTiles=gridTiles,
+            weights=weights,
+            runWeights=np.array(runWeights, dtype=np.int64),
+            runOperands=np.array(runOperands, dtype=np.int64),
+            resultIndex=np.array(resultIndex, dtype=np.int64).reshape(-1, self.arraySize),
+            addresses=np.array(addresses, dtype=np.int32).reshape(-1, 3),
+            program=bytes(program),
+            inputSlots=np.array(inputSlots, dtype=np.int64),
+            slotStarts=np.array(slotStarts, dtype=np.int64),
+            slotLengths=np.array(slotLengths, dtype=np.int64),
+            instructions=len(decodeProgram(bytes(program))),
+        )
+
+    # tile order, buffer allocation and instruction stream of an fc layer
+    # tiles go row tile by row tile (the order TiledInferenceEngine accumulates in),
+    # addresses come from the same ping-pong allocator as buildPipelinedProgram,
+    # so the instantiated stream is byte-identical to the pipelined dispatch
+    def _compileLayer(self, layer) -> LayerPlan:
+        n = self.arraySize
+        weight = np.asarray(layer['weight'], dtype=np.int8)
+        out_dim, in_dim = weight.shape
+        tiles, weights, gridTiles = self._tiles(weight)
+
+        allocator = PingPongAllocator(array_size=n)
+        encoder = ISAEncoder()
+        program = bytearray()
+        addresses = []
+        runs = ([], [], [])
+        slots = ([], [], [])
+        pendingResult = None
+        for t, ((row, col), tile) in enumerate(zip(tiles, weights)):
+            weightAddr, inputAddr, resultAddr = allocator.allocate()
+            addresses.append((weightAddr, inputAddr, resultAddr))
+
+            encoder.clear()
+            encoder.storeWords(weightAddr, tile.flatten().tolist())
+            self._storeOperand(encoder, len(program), inputAddr, int(col) * n, *slots)
+
+            if pendingResult is not None:
+                encoder.fetchResults(pendingResult, n)
+            encoder.loadWeights(weightAddr)
+            encoder.loadInputs(inputAddr)
+            encoder.run(resultAddr, compute=True, quantize=self.quantize, relu=self.relu)
+            pendingResult = resultAddr
+            program += encoder.getProgram()
+
+            outputs = int(row) * n + np.arange(n)
+            runs[0].append(t)
+            runs[1].append(int(col) * n)
+            runs[2].extend(np.where(outputs < out_dim, outputs, -1).tolist())
+
+        encoder.clear()
+        if pendingResult is not None:
+            encoder.fetchResults(pendingResult, n)
+        encoder.halt()
+        program += encoder.getProgram()
+
+        return self._layerPlan(layer, 'fc', (out_dim, in_dim), gridTiles, weights, runs, addresses,
+                               program, slots)
+
+    # instruction stream of a conv layer over its im2col matrix
+    # the nonzero weight tiles are stored once per image and stay resident;
+    # output rows are processed in order and, within a row, each weight tile is
+    # loaded once and run against the operand of every output column
+    # (weight stationary). operand words live in an LRU cache keyed by their
+    # position in the padded input, so a pixel run shared by neighbouring
+    # output positions or kernel rows is STOREd once and only re-sent after
+    # eviction. RUN results are fetched in RUN order at the end of each output
+    # row, or earlier when the result region wraps
+    def _compileConvLayer(self, layer) -> LayerPlan:
+        n = self.arraySize
+        conv = layer['conv']
+        matrix = im2col_weights(layer['weight'], conv, n)
+        tiles, weights, gridTiles = self._tiles(matrix)
+        out_channels = matrix.shape[0]
+        out_height, out_width = conv_output_size(conv)
+        positions = out_height * out_width
+        starts = operand_starts(conv, n)
+
+        weightStride = weightWords(n)
+        if len(weights) * weightStride > CONV_WEIGHT_REGION[1] - CONV_WEIGHT_REGION[0]:
+            raise ValueError(f"{layer['name']}: {len(weights)} weight tiles do not fit the conv weight region")
+        weightAddrs = [CONV_WEIGHT_REGION[0] + u * weightStride for u in range(len(weights))]
+
+        operandStride = inputWords(n)
+        freeOperands = list(range(CONV_OPERAND_REGION[0], CONV_OPERAND_REGION[1] - operandStride + 1,
+                                  operandStride))
+        cached = OrderedDict()   # operand start -> address, least recently used first
+        resultStride = resultWords(n)
+        resultSlots = (CONV_RESULT_REGION[1] - CONV_RESULT_REGION[0]) // resultStride
+        nextResult = 0
+        pending = []
+
+        encoder = ISAEncoder()
+        program = bytearray()
+        addresses = []
+        runs = ([], [], [])
+        slots = ([], [], [])
+
+        def flush():
+            for addr in pending:
+                encoder.fetchResults(addr, n)
+            pending.clear()
+
+        encoder.clear()
+        for addr, tile in zip(weightAddrs, weights):
+            encoder.storeWords(addr, tile.flatten().tolist())
+        program += encoder.getProgram()
+
+        for y in range(out_height):
+            for u, (row, col) in enumerate(tiles):
+                encoder.clear()
+                encoder.loadWeights(weightAddrs[u])
+                channels = int(row) * n + np.arange(n)
+                for x in range(out_width):
+                    p = y * out_width + x
+                    start = int(starts[p, col])
+
+                    inputAddr = cached.get(start)
+                    if inputAddr is None:
+                        inputAddr = freeOperands.pop(0) if freeOperands else cached.popitem(last=False)[1]
+                        cached[start] = inputAddr
+                        self._storeOperand(encoder, len(program), inputAddr, start, *slots)
+                    else:
+                        cached.move_to_end(start)
+                    encoder.loadInputs(inputAddr)
+
+                    if len(pending) == resultSlots:
+                        flush()
+                    resultAddr = CONV_RESULT_REGION[0] + (nextResult % resultSlots) * resultStride
+                    nextResult += 1
+                    encoder.run(resultAddr, compute=True, quantize=self.quantize, relu=self.relu)
+                    pending.append(resultAddr)
+                    addresses.append((weightAddrs[u], inputAddr, resultAddr))
+
+                    runs[0].append(u)
+                    runs[1].append(start)
+                    runs[2].extend(np.where(channels < out_channels, channels * positions + p, -1).tolist())
+                program += encoder.getProgram()
+
+            encoder.clear()
+            flush()
+            program += encoder.getProgram()
+
+        encoder.clear()
+        encoder.halt()
+        program += encoder.getProgram()
+
+        in_features = conv['in_channels'] * conv['input_size'][0] * conv['input_size'][1]
+        return self._layerPlan(layer, 'conv', (out_channels * positions, in_features), gridTiles, weights,
+                               runs, addresses, program, slots)
+
+    def _planPath(self, key):
+        return os.path.join(self.cacheDir, f"{key.hex()}.npz")
+
+    # arrays and stream bytes go into the npz, the rest into a JSON header
+    def _savePlan(self, plan: MLPPlan):
+        if self.cacheDir is None:
+            return
+        os.makedirs(self.cacheDir, exist_ok=True)
+        meta = {'version': PLAN_VERSION, 'array_size': plan.arraySize, 'quantize': plan.quantize,
+                'relu': plan.relu, 'layers': []}
+        arrays = {}
+        for i, layer in enumerate(plan.layers):
+            meta['layers'].append({'name': layer.name, 'kind': layer.kind, 'shape': list(layer.shape),
+                                   'activation': layer.activation, 'scale': layer.scale,
+                                   'requant': list(layer.requant), 'conv': layer.conv,
+                                   'grid_tiles': layer.gridTiles, 'instructions': layer.instructions})
+            for field in ('weights', 'runWeights', 'runOperands', 'resultIndex', 'addresses',
+                          'inputSlots', 'slotStarts', 'slotLengths'):
+                arrays[f'{i}_{field}'] = getattr(layer, field)
+            arrays[f'{i}_program'] = np.frombuffer(layer.program, dtype=np.uint8)
+        arrays['meta'] = np.frombuffer(json.dumps(meta).encode(), dtype=np.uint8)
+
+        #write then rename so an interrupted save never leaves a torn plan
+        path = self._planPath(plan.modelHash)
+        with open(path + '.tmp', 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(path + '.tmp', path)
+        self._log(f"Saved plan to {path}")
+
+    def _loadPlan(self, key) -> Optional[MLPPlan]:
+        if self.cacheDir is None or not os.path.exists(self._planPath(key)):
+            return None
+        with np.load(self._planPath(key)) as data:
+            meta = json.loads(data['meta'].tobytes())
+            if meta['version'] != PLAN_VERSION:
+                return None
+            layers = []
+            for i, layer in enumerate(meta['layers']):
+                layers.append(LayerPlan(
+                    name=layer['name'],
+                    kind=layer['kind'],
+                    shape=tuple(layer['shape']),
+                    activation=layer['activation'],
+                    scale=layer['scale'],
+                    requant=tuple(layer['requant']),
+                    conv=layer['conv'],
+                    gridTiles=layer['grid_tiles'],
+                    weights=data[f'{i}_weights'],
+                    runWeights=data[f'{i}_runWeights'],
+                    runOperands=data[f'{i}_runOperands'],
+                    resultIndex=data[f'{i}_resultIndex'],
+                    addresses=data[f'{i}_addresses'],
+                    program=data[f'{i}_program'].tobytes(),
+                    inputSlots=data[f'{i}_inputSlots'],
+                    slotStarts=data[f'{i}_slotStarts'],
+                    slotLengths=data[f'{i}_slotLengths'],
+                    instructions=layer['instructions'],
+                ))
+        self._log(f"Loaded plan from {self._planPath(key)}")
+        return MLPPlan(key, meta['array_size'], meta['quantize'], meta['relu'], layers)
+
+
+#int4 input vectors for 14x14 images, matches TiledInferenceEngine.preprocess_image
+def preprocessImages(images) -> np.ndarray:
+    x = np.asarray(images, dtype=np.float32).reshape(len(images), -1)
+    return np.clip(np.round(x * 15.0 - 8.0), -8, 7).astype(np.int8)
+
+
+def printSummary(summary):
+    print(f"Plan {summary['model_hash']} ({summary['array_size']}x{summary['array_size']} tiles)")
+    for layer in summary['layers']:
+        print(f"  {layer['name']} ({layer['kind']}): {layer['shape'][1]} -> {layer['shape'][0]} "
+              f"({layer['activation']}), {layer['runs']} RUNs over {layer['tiles']} tiles "
+              f"({layer['zero_tiles']} zero skipped), {layer['instructions']} instructions, "
+              f"{layer['tx_bytes']} B TX / {layer['rx_bytes']} B RX, "
+              f"{layer['operand_stores']}/{layer['operand_uses']} operand words stored, "
+              f"buffer up to 0x{layer['buffer_top']:03X}")
+    print(f"  Total per image: {summary['tx_bytes']} B TX, {summary['rx_bytes']} B RX")
+
+
+def main():
+    import argparse
+
+    weights_dir, model_path, data_dir = get_default_paths()
+
+    parser = argparse.ArgumentParser(description='uTPU MLP compiler')
+    parser.add_argument('--weights', type=str, default=weights_dir)
+    parser.add_argument('--model', type=str, default=model_path,
+                        help='Model file, only needed for --check')
+    parser.add_argument('--data', type=str, default=data_dir)
+    parser.add_argument('--num-samples', type=int, default=1000)
+    parser.add_argument('--backend', choices=BACKENDS, default='numpy')
+    parser.add_argument('--port', '-p', type=str, default=None, help='Serial port for --backend board')
+    parser.add_argument('--plan-cache', type=str, default=None,
+                        help='Directory of compiled plans (default: <weights>/plans)')
+    parser.add_argument('--check', action='store_true',
+                        help='Compare logits with TiledInferenceEngine (numpy: software, emulate/board: '
+                             'hardware emulation)')
+    parser.add_argument('--verbose', '-v', action='store_true')
+    args = parser.parse_args()
+
+    print("=" * 60)
+    print("uTPU MLP Compiler")
+    print("=" * 60)
+
+    layers = load_layers(args.weights)
+    cache_dir = args.plan_cache or os.path.join(args.weights, 'plans')
+    compiler = MLPCompiler(cache_dir=cache_dir, verbose=args.verbose)
+
+    start = time.perf_counter()
+    plan = compiler.compile(layers)
+    source = 'cache' if compiler.stats['disk_hits'] else 'compiled'
+    print(f"Plan ready in {1000 * (time.perf_counter() - start):.1f} ms ({source})")
+    printSummary(plan.summary())
+
+    images = np.load(os.path.join(args.data, 'mnist_14x14_test.npy'))[:args.num_samples]
+    labels = np.load(os.path.join(args.data, 'test_labels.npy'))[:args.num_samples]
+    inputs = preprocessImages(images)
+
+    loader = None
+    uart = None
+    if args.backend == 'board':
+        if args.port is None:
+            print("Error: --backend board needs --port")
+            return 1
+        from uart_driver import UARTDriver
+        from program_loader import ProgramLoader
+        uart = UARTDriver(args.port, baud=115200)
+        loader = ProgramLoader(uart, verbose=args.verbose, array_size=plan.arraySize)
+        loader.resetChip()
+
+    start = time.perf_counter()
+    logits = plan.forward(inputs, backend=args.backend, loader=loader)
+    elapsed = time.perf_counter() - start
+    preds = np.argmax(logits, axis=1)
+    correct = int(np.sum(preds == labels))
+    print(f"\n{args.backend}: {100 * correct / len(labels):.2f}% ({correct}/{len(labels)}) "
+          f"in {elapsed:.2f} s ({1000 * elapsed / len(labels):.3f} ms/image)")
+
+    status = 0
+    if args.check:
+        from tiled_inference import TiledInferenceEngine
+        engine = TiledInferenceEngine(args.weights, args.model)
+        if args.backend != 'numpy':
+            #same per-tile RUN model as FPGAInference --emulate
+            def run_tile_batch(weights, input_tiles):
+                out = quantizeAccumulatorArray(input_tiles.astype(np.int32) @ weights.astype(np.int32).T)
+                return leakyReluArray(out) if plan.relu else out
+            engine.batch_tile_runner = run_tile_batch
+        reference = engine.forward_batch(images)
+        match = np.array_equal(reference, logits)
+        agree = int(np.sum(np.argmax(reference, axis=1) == preds))
+        print(f"Engine check: logits {'identical' if match else 'DIFFER'}, "
+              f"argmax agreement {agree}/{len(labels)}")
+        status = 0 if match else 1
+
+    if uart is not None:
+        uart.close()
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,288 @@
+import numpy as np
+import sys
+from collections import OrderedDict
+from typing import Dict
+
+from isa_model import BUFFER_SIZE, weightWords, inputWords
+from isa_encoder import int4ToWords
+from utpu_config import ARRAY_SIZE
+from resilient_dispatch import ResilientDispatcher
+
+
+# keeps the weight tiles of several models resident in the unified buffer
+# each model gets one contiguous partition of the weight region holding its
+# unique nonzero tiles, so switching between resident models only changes
+# LOADWEI addresses. when a model does not fit, least-recently-used models
+# are evicted until a gap is large enough.
+# the scratch region (section A by default) holds inputs and RUN results
+# resident tiles run through a ResilientDispatcher: a failed read resyncs the
+# loader (which invalidates residency) and the retry uploads the model again
+class ModelRegistry:
+
+    def __init__(self, loader=None, region=(0x080, BUFFER_SIZE), scratch=(0x000, 0x080),
+                 array_size: int = ARRAY_SIZE, dispatcher=None, verbose: bool = False):
+        self.loader = loader
+        if loader is not None and dispatcher is None:
+            dispatcher = ResilientDispatcher(loader, verbose=verbose)
+        self.dispatcher = dispatcher
+        self.verbose = verbose
+        self.arraySize = array_size if loader is None else loader.arraySize
+        self.regionStart, self.regionEnd = region
+        self.inputAddr = scratch[0]
+        self.resultAddr = scratch[0] + (scratch[1] - scratch[0]) // 2
+        self.tileWords = weightWords(self.arraySize)
+
+        if self.regionStart < scratch[1] and scratch[0] < self.regionEnd:
+            raise ValueError("Weight region overlaps the scratch region")
+        if self.resultAddr - self.inputAddr < inputWords(self.arraySize):
+            raise ValueError("Scratch region too small for one input vector")
+
+        self.models = {}                # name -> {'tiles': {bytes: index}, 'words': [...]}
+        self.resident = OrderedDict()   # name -> base address, least recently used first
+        self.active = None
+        self.stats = {
+            'switches': 0,
+            'uploads': 0,
+            'hits': 0,
+            'evictions': 0,
+            'replacements': 0,
+            'words_uploaded': 0,
+            'invalidations': 0,
+        }
+        if loader is not None:
+            loader.resyncListeners.append(self.invalidate)
+
+    def _log(self, message):
+        if self.verbose:
+            print(f"[ModelRegistry] {message}")
+
+    # register a model as a list of int4 weight matrices (out, in)
+    # only unique nonzero NxN tiles are kept: zero tiles never reach the array
+    def register(self, name, layers):
+        n = self.arraySize
+        tiles = {}
+        words = []
+        for weights in layers:
+            weights = np.asarray(weights, dtype=np.int8)
+            rows = -(-weights.shape[0] // n)
+            cols = -(-weights.shape[1] // n)
+            padded = np.zeros((rows * n, cols * n), dtype=np.int8)
+            padded[:weights.shape[0], :weights.shape[1]] = weights
+
+            for r in range(rows):
+                for c in range(cols):
+                    tile = padded[r * n:(r + 1) * n, c * n:(c + 1) * n]
+                    key = tile.tobytes()
+                    if not tile.any() or key in tiles:
+                        continue
+                    tiles[key] = len(tiles)
+                    words.extend(int4ToWords(tile.flatten().tolist()))
+
+        size = len(words)
+        if size > self.regionEnd - self.regionStart:
+            raise ValueError(f"Model '{name}' needs {size} words, weight region holds "
+                             f"{self.regionEnd - self.regionStart}")
+
+        if name in self.models:
+            #a replacement, not an LRU eviction
+            self._release(name)
+            self.stats['replacements'] += 1
+            self._log(f"Replacing '{name}'")
+        self.models[name] = {'tiles': tiles, 'words': words}
+        self._log(f"Registered '{name}': {len(tiles)} unique tiles, {size} words")
+
+    # words a model occupies when resident
+    def footprint(self, name):
+        return len(self.models[name]['words'])
+
+    # first gap in the weight region that holds size words, None if there is none
+    def _findGap(self, size):
+        addr = self.regionStart
+        for base, name in sorted((base, name) for name, base in self.resident.items()):
+            if base - addr >= size:
+                return addr
+            addr = max(addr, base + self.footprint(name))
+        if self.regionEnd - addr >= size:
+            return addr
+        return None
+
+    # free a model's partition, True if it was resident
+    def _release(self, name):
+        if name not in self.resident:
+            return False
+        del self.resident[name]
+        if self.active == name:
+            self.active = None
+        return True
+
+    def evict(self, name):
+        if self._release(name):
+            self.stats['evictions'] += 1
+            self._log(f"Evicted '{name}'")
+
+    # forget every resident model (buffer contents unknown, e.g. after a
+    # loader resync); registered models are uploaded again on activate
+    def invalidate(self):
+        self.resident.clear()
+        self.active = None
+        self.stats['invalidations'] += 1
+        self._log("Residency invalidated")
+
+    # make a model resident and current, uploading (and evicting) only if needed
+    # returns the base address of its partition
+    def activate(self, name):
+        if name not in self.models:
+            raise KeyError(f"Unknown model '{name}'")
+
+        if name == self.active and name in self.resident:
+            return self.resident[name]
+
+        self.stats['switches'] += 1
+        self.active = name
+
+        if name in self.resident:
+            self.resident.move_to_end(name)
+            self.stats['hits'] += 1
+            return self.resident[name]
+
+        size = self.footprint(name)
+        base = self._findGap(size)
+        while base is None:
+            victim = next(iter(self.resident))
+            self.evict(victim)
+            base = self._findGap(size)
+
+        if self.loader is not None and size:
+            self.loader.storeWordsToBuffer(base, self.models[name]['words'])
+        self.resident[name] = base
+        self.stats['uploads'] += 1
+        self.stats['words_uploaded'] += size
+        self._log(f"Uploaded '{name}' to 0x{base:03X}-0x{base + size - 1:03X}")
+        self.active = name
+        return base
+
+    # buffer address of a weight tile of the active model, None for a zero tile
+    def tileAddress(self, name, weight_tile):
+        tile = np.asarray(weight_tile, dtype=np.int8)
+        if not tile.any():
+            return None
+        index = self.models[name]['tiles'].get(tile.tobytes())
+        if index is None:
+            raise KeyError(f"Tile not part of model '{name}'")
+        return self.activate(name) + index * self.tileWords
+
+    # tile runner for TiledInferenceEngine that executes with resident weights
+    # (only LOADIN/RUN/FETCH traffic once the model is resident)
+    # every attempt looks the tile address up again, so a retry after a resync
+    # re-activates (uploads) the model first
+    def tileRunner(self, name, quantize: bool = True, relu: bool = False):
+        n = self.arraySize
+
+        def run(weight_tile, input_tile):
+            if self.tileAddress(name, weight_tile) is None:
+                return np.zeros(n, dtype=np.int32)
+            results = self.dispatcher.executeResidentTile(
+                lambda: self.tileAddress(name, weight_tile),
+                np.asarray(input_tile, dtype=np.int8).tolist(),
+                self.inputAddr, self.resultAddr,
+                quantize=quantize, relu=relu,
+            )
+            return np.array(results, dtype=np.int32)
+
+        return run
+
+    # partition map and usage of the weight region
+    def occupancy(self) -> Dict[str, object]:
+        total = self.regionEnd - self.regionStart
+        partitions = [(base, base + self.footprint(name), name)
+                      for name, base in sorted(self.resident.items(), key=lambda item: item[1])]
+        used = sum(end - base for base, end, _ in partitions)
+        return {
+            'region_words': total,
+            'used_words': used,
+            'free_words': total - used,
+            'partitions': partitions,
+        }
+
+    # switch statistics, upload_rate is the fraction of switches that needed an upload
+    def summary(self) -> Dict[str, float]:
+        summary = dict(self.stats)
+        summary['upload_rate'] = self.stats['uploads'] / self.stats['switches'] if self.stats['switches'] else 0.0
+        return summary
+
+    def report(self) -> str:
+        s = self.summary()
+        occ = self.occupancy()
+        lines = [
+            f"Switches: {s['switches']}, uploads: {s['uploads']} ({100 * s['upload_rate']:.1f}%), "
+            f"evictions: {s['evictions']}, replacements: {s['replacements']}, "
+            f"words uploaded: {s['words_uploaded']}, invalidations: {s['invalidations']}",
+            f"Weight region: {occ['used_words']}/{occ['region_words']} words used",
+        ]
+        for base, end, name in occ['partitions']:
+            lines.append(f"  0x{base:03X}-0x{end - 1:03X} {name} ({end - base} words)")
+        return "\n".join(lines)
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='uTPU multi-model residency')
+    parser.add_argument('--port', '-p', type=str, default=None,
+                        help='Serial port (e.g. COM3). Omit to only simulate residency.')
+    parser.add_argument('--models', type=int, default=4, help='Number of random classifiers')
+    parser.add_argument('--hidden', type=int, default=8)
+    parser.add_argument('--inputs', type=int, default=64)
+    parser.add_argument('--switches', type=int, default=200)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--verbose', '-v', action='store_true')
+    args = parser.parse_args()
+
+    print("=" * 60)
+    print("uTPU Model Registry")
+    print("=" * 60)
+
+    loader = None
+    uart = None
+    if args.port is not None:
+        from uart_driver import UARTDriver
+        from program_loader import ProgramLoader
+        uart = UARTDriver(args.port, baud=115200)
+        loader = ProgramLoader(uart, verbose=args.verbose)
+        loader.resetChip()
+
+    rng = np.random.default_rng(args.seed)
+    registry = ModelRegistry(loader, verbose=args.verbose)
+    names = [f"model{i}" for i in range(args.models)]
+    weights = {}
+    for name in names:
+        weights[name] = [rng.integers(-8, 8, size=(args.hidden, args.inputs)),
+                         rng.integers(-8, 8, size=(10, args.hidden))]
+        registry.register(name, weights[name])
+        print(f"{name}: {registry.footprint(name)} words")
+
+    #skewed switch pattern: a couple of models are hot
+    popularity = 1.0 / np.arange(1, args.models + 1)
+    sequence = rng.choice(names, size=args.switches, p=popularity / popularity.sum())
+
+    for name in sequence:
+        registry.activate(name)
+        if loader is not None:
+            #check one tile against the host
+            tile = np.asarray(weights[name][0][:registry.arraySize, :registry.arraySize], dtype=np.int8)
+            x = rng.integers(-8, 8, size=registry.arraySize)
+            result = registry.tileRunner(name)(tile, x)
+            print(f"{name}: tile result {result.tolist()}")
+
+    print()
+    print(registry.report())
+    if loader is not None:
+        print(registry.dispatcher.report())
+
+    if uart is not None:
+        uart.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,234 @@
+import multiprocessing
+import os
+import sys
+import time
+from multiprocessing import shared_memory
+
+import numpy as np
+
+
+#process-pool evaluation for simulation/emulation mode
+#
+#the read-only arrays (test images and every layer's weight, array matrix and
+#tile mask) are copied once into a single shared memory block; workers attach
+#to it in their initializer and rebuild the engine around views of it, so
+#tasks only carry sample indices. samples are split into contiguous shards
+#(aligned to batch_size, several per worker for load balance) and results come
+#back through imap in shard order, so predictions, logits and the log are
+#merged in sample order whatever the number of workers
+
+LAYER_ARRAYS = ('weight', 'matrix', 'tile_mask')
+SHARDS_PER_WORKER = 4
+ALIGN = 64
+
+
+#named read-only arrays packed into one shared memory block
+class SharedArrays:
+
+    def __init__(self, arrays):
+        self.layout = {}
+        offset = 0
+        for name, array in arrays.items():
+            array = np.ascontiguousarray(array)
+            self.layout[name] = (offset, array.dtype.str, array.shape)
+            offset += -(-array.nbytes // ALIGN) * ALIGN
+        self.shm = shared_memory.SharedMemory(create=True, size=max(offset, 1))
+        for name, array in arrays.items():
+            self.view(name)[...] = array
+
+    def view(self, name):
+        offset, dtype, shape = self.layout[name]
+        return np.ndarray(shape, dtype=dtype, buffer=self.shm.buf, offset=offset)
+
+    #what a worker needs to attach (picklable)
+    @property
+    def spec(self):
+        return self.shm.name, self.layout
+
+    def close(self):
+        self.shm.close()
+        self.shm.unlink()
+
+
+#attach to a SharedArrays block from a pool worker, returns (shm, {name: array})
+#the creating process owns (and unlinks) the block; pool workers share its
+#resource tracker, so attaching does not add a second owner
+def attach(spec):
+    name, layout = spec
+    shm = shared_memory.SharedMemory(name=name)
+    arrays = {key: np.ndarray(shape, dtype=dtype, buffer=shm.buf, offset=offset)
+              for key, (offset, dtype, shape) in layout.items()}
+    for array in arrays.values():
+        array.flags.writeable = False
+    return shm, arrays
+
+
+#per-worker state set up by _init_worker
+_worker = {}
+
+
+def _init_worker(spec, meta, array_size, lut, emulate_relu):
+    from tiled_inference import TiledInferenceEngine
+
+    shm, arrays = attach(spec)
+    layers = []
+    for i, fields in enumerate(meta):
+        layer = dict(fields)
+        for key in LAYER_ARRAYS:
+            layer[key] = arrays[f'{i}_{key}']
+        layers.append(layer)
+
+    engine = TiledInferenceEngine(None, None, array_size=array_size, lut=lut, layers=layers)
+    if emulate_relu is not None:
+        from fpga_inference import emulate_run
+        engine.tile_runner = lambda w, x: emulate_run(w.astype(np.int32) @ x.astype(np.int32), emulate_relu)
+        engine.batch_tile_runner = lambda w, x: emulate_run(x.astype(np.int32) @ w.astype(np.int32).T,
+                                                            emulate_relu)
+
+    _worker['shm'] = shm
+    _worker['engine'] = engine
+    _worker['images'] = arrays['images']
+
+
+#run one shard of sample indices, returns (indices, preds, logits, seconds per sample)
+#batches are taken the same way as the serial evaluate so the logits match it
+def _run_shard(task):
+    indices, batch_size = task
+    engine = _worker['engine']
+    images = _worker['images']
+
+    preds, logits, seconds = [], [], []
+    step = batch_size or 1
+    for pos in range(0, len(indices), step):
+        chunk = indices[pos:pos + step]
+        start = time.perf_counter()
+        if batch_size is not None:
+            chunk_preds, chunk_logits = engine.predict_batch(images[chunk])
+        else:
+            pred, single = engine.predict(images[chunk[0]])
+            chunk_preds, chunk_logits = [pred], [single]
+        elapsed = (time.perf_counter() - start) / len(chunk)
+        preds.extend(int(p) for p in chunk_preds)
+        logits.extend(np.asarray(chunk_logits, dtype=np.float32))
+        seconds.extend([elapsed] * len(chunk))
+    return indices, preds, np.array(logits, dtype=np.float32), seconds
+
+
+#contiguous shards of indices, each a multiple of batch_size long
+def make_shards(indices, workers, batch_size=None):
+    step = batch_size or 1
+    size = -(-len(indices) // (workers * SHARDS_PER_WORKER))
+    size = max(step, -(-size // step) * step)
+    return [indices[i:i + size] for i in range(0, len(indices), size)]
+
+
+#evaluate a software engine over a process pool
+#same arguments and result as TiledInferenceEngine.evaluate (images/labels
+#already cut to max_samples); emulate_relu set runs every tile through the
+#FPGAInference --emulate RUN model with that relu flag
+#returns (accuracy, correct, total); with return_logits also the (total, classes)
+#logits in sample order
+def evaluate_parallel(engine, images, labels, workers, batch_size=None, sample_range=None, log=None,
+                      emulate_relu=None, return_logits=False):
+    start, stop = sample_range if sample_range is not None else (0, len(labels))
+    todo = [i for i in range(start, stop) if log is None or not log.done(i)]
+    if log is not None and len(todo) < stop - start:
+        print(f"Resuming: {stop - start - len(todo)} samples already logged, {len(todo)} to go")
+
+    arrays = {'images': np.asarray(images)}
+    meta = []
+    for i, layer in enumerate(engine.layers):
+        meta.append({key: value for key, value in layer.items() if key not in LAYER_ARRAYS})
+        for key in LAYER_ARRAYS:
+            arrays[f'{i}_{key}'] = layer[key]
+    shared = SharedArrays(arrays)
+
+    shards = make_shards(todo, workers, batch_size)
+    correct = 0
+    done = 0
+    logits = []
+    try:
+        initargs = (shared.spec, meta, engine.array_size, engine.fc1_lut is not None, emulate_relu)
+        with multiprocessing.get_context().Pool(workers, initializer=_init_worker, initargs=initargs) as pool:
+            for indices, preds, shard_logits, seconds in pool.imap(_run_shard, [(s, batch_size) for s in shards]):
+                for i, pred, row, t in zip(indices, preds, shard_logits, seconds):
+                    correct += int(pred == labels[i])
+                    if log is not None:
+                        log.add(i, pred, labels[i], t, row)
+                logits.append(shard_logits)
+
+                if (done + len(indices)) // 1000 > done // 1000:
+                    print(f"Progress: {done + len(indices)}/{len(todo)}, "
+                          f"Accuracy: {100.0 * correct / (done + len(indices)):.2f}%")
+                done += len(indices)
+    finally:
+        shared.close()
+
+    if log is not None:
+        correct, total = log.score(range(start, stop))
+    else:
+        total = len(todo)
+    result = ((correct / total if total else 0.0), correct, total)
+    if return_logits:
+        return result + (np.concatenate(logits) if logits else np.zeros((0, 0), dtype=np.float32),)
+    return result
+
+
+def main():
+    import argparse
+    from tiled_inference import TiledInferenceEngine, get_default_paths
+
+    weights_dir, model_path, data_dir = get_default_paths()
+
+    parser = argparse.ArgumentParser(description='uTPU parallel evaluation scaling benchmark')
+    parser.add_argument('--weights', type=str, default=weights_dir)
+    parser.add_argument('--model', type=str, default=model_path)
+    parser.add_argument('--data', type=str, default=data_dir)
+    parser.add_argument('--num-samples', type=int, default=2000)
+    parser.add_argument('--batch-size', type=int, default=None)
+    parser.add_argument('--workers', type=str, default=None,
+                        help='Comma-separated worker counts (default: 1, 2, 4, ... up to the core count)')
+    args = parser.parse_args()
+
+    print("=" * 60)
+    print("uTPU Parallel Evaluation")
+    print("=" * 60)
+
+    engine = TiledInferenceEngine(args.weights, args.model)
+    images = np.load(os.path.join(args.data, 'mnist_14x14_test.npy'))[:args.num_samples]
+    labels = np.load(os.path.join(args.data, 'test_labels.npy'))[:args.num_samples]
+
+    cores = os.cpu_count() or 1
+    if args.workers is not None:
+        counts = [int(w) for w in args.workers.split(',')]
+    else:
+        counts = [1 << i for i in range(cores.bit_length()) if 1 << i <= cores]
+    print(f"{len(labels)} samples, {cores} cores, batch size {args.batch_size or 'none'}")
+
+    #serial reference
+    start = time.perf_counter()
+    acc, _, _ = engine.evaluate(images, labels, batch_size=args.batch_size)
+    serial = time.perf_counter() - start
+    if args.batch_size is None:
+        reference = np.stack([engine.forward(image) for image in images])
+    else:
+        reference = np.concatenate([engine.forward_batch(images[i:i + args.batch_size])
+                                    for i in range(0, len(images), args.batch_size)])
+    print(f"\nSerial: {100 * acc:.2f}% in {serial:.2f} s")
+
+    status = 0
+    print(f"\n  {'workers':>7} {'seconds':>8} {'speedup':>8} {'efficiency':>10}  logits")
+    for workers in counts:
+        start = time.perf_counter()
+        _, _, _, logits = evaluate_parallel(engine, images, labels, workers, batch_size=args.batch_size,
+                                            return_logits=True)
+        elapsed = time.perf_counter() - start
+        match = np.array_equal(logits, reference)
+        status |= not match
+        print(f"  {workers:>7} {elapsed:>8.2f} {serial / elapsed:>7.2f}x {100 * serial / elapsed / workers:>9.1f}%  "
+              f"{'identical' if match else 'DIFFER'}")
+    return int(status)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
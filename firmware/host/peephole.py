@@ -0,0 +1,268 @@
+import random
+import sys
+from typing import List, Tuple
+
+from isa_encoder import (
+    OPCODE_STORE,
+    OPCODE_FETCH,
+    OPCODE_RUN,
+    OPCODE_LOAD,
+    OPCODE_HALT,
+    OPCODE_NOP,
+)
+from isa_model import (
+    BUFFER_SIZE,
+    ISAModel,
+    Instruction,
+    decodeProgram,
+    encodeProgram,
+    weightWords,
+    inputWords,
+    resultWords,
+)
+from utpu_config import ARRAY_SIZE
+
+
+#peephole optimizer for uTPU instruction streams
+#removes LOADs of values already in the PE array, STOREs/RUNs whose word is
+#overwritten before anything reads it, STOREs of a value the word already
+#holds, NOPs and HALTs that are not the last instruction.
+#the buffer is treated as fully live at the end of the program because the
+#host may FETCH or LOAD it from a later program
+class PeepholeOptimizer:
+
+    def __init__(self, verbose=False, array_size=ARRAY_SIZE):
+        self.verbose = verbose
+        self.arraySize = array_size
+        self.stats = {}
+
+    #words read by a LOAD (weights or inputs)
+    def _loadSpan(self, instr):
+        count = weightWords(self.arraySize) if instr.flags & 0b1 else inputWords(self.arraySize)
+        return range(instr.addr, instr.addr + count)
+
+    #words written by a RUN
+    def _runSpan(self, instr):
+        return range(instr.addr, instr.addr + resultWords(self.arraySize))
+
+    def _log(self, message):
+        if self.verbose:
+            print(f"[Peephole] {message}")
+
+    def _count(self, name, n=1):
+        self.stats[name] = self.stats.get(name, 0) + n
+
+    #drop NOPs and every HALT except a trailing one
+    def removeNops(self, instructions: List[Instruction]) -> List[Instruction]:
+        result = []
+        last = len(instructions) - 1
+        for i, instr in enumerate(instructions):
+            if instr.opcode == OPCODE_NOP:
+                self._count('nop')
+            elif instr.opcode == OPCODE_HALT and i != last:
+                self._count('halt')
+            else:
+                result.append(instr)
+        return result
+
+    #forward pass tracking what every word and the PE array hold
+    #values are symbolic tokens: immediates compare by value, RUN results by
+    #the PE state and flags that produced them, unknown words by address
+    def removeRedundant(self, instructions: List[Instruction]) -> List[Instruction]:
+        buffer = {}
+        weights = ('init', 'weights')
+        inputs = ('init', 'inputs')
+        result = []
+
+        def word(addr):
+            return buffer.get(addr, ('init', addr))
+
+        for instr in instructions:
+            op = instr.opcode
+
+            if op == OPCODE_STORE:
+                token = ('imm', instr.operand) if instr.immediate else word(instr.operand & 0x1FF)
+                if word(instr.addr) == token:
+                    self._count('store')
+                    continue
+                buffer[instr.addr] = token
+
+            elif op == OPCODE_LOAD:
+                token = tuple(word(a) for a in self._loadSpan(instr))
+                if instr.flags & 0b1:
+                    if weights == token:
+                        self._count('loadwei')
+                        continue
+                    weights = token
+                else:
+                    if inputs == token:
+                        self._count('loadin')
+                        continue
+                    inputs = token
+
+            elif op == OPCODE_RUN:
+                span = self._runSpan(instr)
+                tokens = [('run', weights, inputs, instr.flags, i) for i in range(len(span))]
+                if [word(a) for a in span] == tokens:
+                    self._count('run')
+                    continue
+                for a, token in zip(span, tokens):
+                    buffer[a] = token
+
+            result.append(instr)
+
+        return result
+
+    #backward liveness pass: drop writes that are overwritten before being read
+    def removeDeadWrites(self, instructions: List[Instruction]) -> List[Instruction]:
+        live = set(range(BUFFER_SIZE))
+        kept = []
+
+        for instr in reversed(instructions):
+            op = instr.opcode
+
+            if op == OPCODE_STORE:
+                if instr.addr not in live:
+                    self._count('dead_store')
+                    continue
+                live.discard(instr.addr)
+                if not instr.immediate:
+                    live.add(instr.operand & 0x1FF)
+
+            elif op == OPCODE_RUN:
+                span = self._runSpan(instr)
+                if not any(a in live for a in span):
+                    self._count('dead_run')
+                    continue
+                live.difference_update(span)
+
+            elif op == OPCODE_LOAD:
+                live.update(self._loadSpan(instr))
+
+            elif op == OPCODE_FETCH:
+                live.add(instr.addr)
+
+            kept.append(instr)
+
+        kept.reverse()
+        return kept
+
+    #run all passes until nothing changes
+    def optimizeInstructions(self, instructions: List[Instruction]) -> List[Instruction]:
+        self.stats = {}
+        current = self.removeNops(list(instructions))
+        while True:
+            before = len(current)
+            current = self.removeRedundant(current)
+            current = self.removeDeadWrites(current)
+            if len(current) == before:
+                break
+        return current
+
+    #optimize an encoded program, returns (program, report)
+    def optimize(self, program: bytes) -> Tuple[bytes, dict]:
+        instructions = decodeProgram(program)
+        optimized = encodeProgram(self.optimizeInstructions(instructions))
+
+        report = {
+            'instructions_before': len(instructions),
+            'instructions_after': len(decodeProgram(optimized)),
+            'bytes_before': len(program),
+            'bytes_after': len(optimized),
+            'removed': dict(self.stats),
+        }
+        self._log(f"{report['bytes_before']} -> {report['bytes_after']} bytes")
+        return optimized, report
+
+
+#run both programs on the host ISA model from the same random initial states
+#and compare transmitted bytes, final buffer and PE array state
+def checkEquivalent(original: bytes, optimized: bytes, trials: int = 8, seed: int = 0,
+                    array_size: int = ARRAY_SIZE) -> bool:
+    rng = random.Random(seed)
+    n = array_size
+
+    for _ in range(trials):
+        init = [rng.randrange(0x10000) for _ in range(BUFFER_SIZE)]
+        weights = [[rng.randrange(-8, 8) for _ in range(n)] for _ in range(n)]
+        ins = [rng.randrange(-8, 8) for _ in range(n)]
+
+        models = []
+        outputs = []
+        for program in (original, optimized):
+            model = ISAModel(array_size=n)
+            model.buffer = list(init)
+            model.weights = [list(row) for row in weights]
+            model.inputs = list(ins)
+            outputs.append(model.execute(program))
+            models.append(model)
+
+        a, b = models
+        if outputs[0] != outputs[1] or a.buffer != b.buffer:
+            return False
+        if a.weights != b.weights or a.inputs != b.inputs:
+            return False
+
+    return True
+
+
+#print an optimization report
+def printReport(report):
+    saved_instr = report['instructions_before'] - report['instructions_after']
+    saved_bytes = report['bytes_before'] - report['bytes_after']
+    pct = 100.0 * saved_bytes / report['bytes_before'] if report['bytes_before'] else 0.0
+
+    print(f"Instructions: {report['instructions_before']} -> {report['instructions_after']} (-{saved_instr})")
+    print(f"Bytes:        {report['bytes_before']} -> {report['bytes_after']} (-{saved_bytes}, {pct:.1f}%)")
+    for name, count in sorted(report['removed'].items()):
+        print(f"  removed {name}: {count}")
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Peephole optimizer for uTPU binaries')
+    parser.add_argument('input', nargs='?', help='Program binary (e.g. from assembler). Omit for a demo.')
+    parser.add_argument('--output', '-o', type=str, default=None)
+    parser.add_argument('--verify', action='store_true', help='Check equivalence on the host ISA model')
+    parser.add_argument('--verbose', '-v', action='store_true')
+    args = parser.parse_args()
+
+    if args.input is not None:
+        with open(args.input, 'rb') as f:
+            program = f.read()
+    else:
+        #two back-to-back tile programs sharing a weight tile
+        from isa_encoder import ISAEncoder
+        encoder = ISAEncoder()
+        for inputs in ([1, 1, 0, 0], [2, 3, 0, 0]):
+            encoder.store(0x080, [1, 2, 3, 4]).loadWeights(0x080)
+            encoder.store(0x000, inputs).loadInputs(0x000)
+            encoder.run(0x100).nop()
+            encoder.fetch(0x100, top_half=False).fetch(0x100, top_half=True).halt()
+        program = encoder.getProgram()
+
+    optimizer = PeepholeOptimizer(verbose=args.verbose)
+    optimized, report = optimizer.optimize(program)
+
+    print("=" * 50)
+    print("uTPU Peephole Optimizer")
+    print("=" * 50)
+    printReport(report)
+
+    if args.verify:
+        ok = checkEquivalent(program, optimized)
+        print(f"Equivalent on ISA model: {'yes' if ok else 'NO'}")
+        if not ok:
+            return 1
+
+    if args.output is not None:
+        with open(args.output, 'wb') as f:
+            f.write(optimized)
+        print(f"Wrote {args.output}")
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
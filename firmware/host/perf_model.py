@@ -0,0 +1,438 @@
+import json
+import math
+import sys
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+
+from isa_encoder import (
+    ISAEncoder,
+    OPCODE_STORE,
+    OPCODE_FETCH,
+    OPCODE_RUN,
+    OPCODE_LOAD,
+    OPCODE_HALT,
+    OPCODE_NOP,
+    encodeFetchWords,
+    encodeFetchResults,
+    encodeHalt,
+)
+from isa_model import BUFFER_SIZE, decodeProgram, weightWords, inputWords, resultWords
+from utpu_config import load_config
+
+
+STRATEGIES = ('tile', 'weight_stationary', 'pipelined')
+
+OPCODE_NAMES = {
+    OPCODE_STORE: 'STORE',
+    OPCODE_FETCH: 'FETCH',
+    OPCODE_RUN: 'RUN',
+    OPCODE_LOAD: 'LOAD',
+    OPCODE_HALT: 'HALT',
+    OPCODE_NOP: 'NOP',
+}
+
+# host-side pacing used by ProgramLoader.sendProgram and UARTDriver.send_bytes_to_chip
+PROGRAM_CHUNK = 128
+BITS_PER_BYTE = 10  # 8N1
+
+# latency = sum(constant * feature), see features()
+# wire:        multiplier on the raw 8N1 time of every TX and RX byte
+# chunk_sleep: sleep after every 128-byte sendProgram chunk
+# write_sleep: sleep after every FIFO/2 serial write
+# round_trip:  fixed cost of each blocking wait for results (USB latency, scheduling)
+# instruction: core execution time per instruction
+DEFAULT_CONSTANTS = {
+    'wire': 1.0,
+    'chunk_sleep': 0.015,
+    'write_sleep': 0.010,
+    'round_trip': 0.002,
+    'instruction': 0.0,
+}
+CONSTANT_NAMES = tuple(DEFAULT_CONSTANTS)
+
+
+#one host -> chip transfer: a program sent `count` times, each followed by a
+#blocking wait for `rx` result bytes (rx == 0 means no wait)
+#mode 'program' goes through ProgramLoader.sendProgram, 'stream' straight to the UART
+class Transfer(NamedTuple):
+    program: bytes
+    rx: int = 0
+    count: int = 1
+    mode: str = 'program'
+
+
+#parse "196,9,10" into [(9, 196), (10, 9)] (out, in) weight shapes
+def parseLayers(spec: str) -> List[Tuple[int, int]]:
+    dims = [int(d) for d in spec.split(',') if d.strip()]
+    if len(dims) < 2:
+        raise ValueError(f"Need at least input and output sizes, got '{spec}'")
+    return [(dims[i + 1], dims[i]) for i in range(len(dims) - 1)]
+
+
+#(out, in) shapes of the matrices an exported model dispatches, read with
+#tiled_inference.load_layers. a conv layer runs its im2col matrix (kernel rows
+#padded to the array size) once per output position
+def layersFromWeights(weights_dir: str, array_size: int) -> List[Tuple[int, int]]:
+    from tiled_inference import load_layers
+    from conv_layer import conv_output_size, im2col_weights
+
+    layers = []
+    for layer in load_layers(weights_dir):
+        if layer['conv'] is None:
+            layers.append(tuple(int(d) for d in layer['weight'].shape))
+            continue
+        shape = tuple(int(d) for d in im2col_weights(layer['weight'], layer['conv'], array_size).shape)
+        height, width = conv_output_size(layer['conv'])
+        layers.extend([shape] * (height * width))
+    return layers
+
+
+#analytical cost model for one model/config/link combination
+#builds the programs each host schedule would send for one inference and
+#counts bytes, instructions and buffer words without touching a board
+class PerfModel:
+
+    def __init__(self, layers, config_path=None, baud=115200, fifo_size=256, batch_size=32,
+                 constants: Optional[Dict[str, float]] = None):
+        config = load_config(config_path)
+        self.layers = [tuple(layer) for layer in layers]
+        self.arraySize = config['array_size']
+        self.config = config
+        self.baud = baud
+        self.fifoSize = fifo_size
+        self.batchSize = batch_size
+        self.constants = dict(DEFAULT_CONSTANTS)
+        if constants:
+            self.constants.update(constants)
+
+    #row/column tile counts of a layer
+    def _tileGrid(self, layer):
+        n = self.arraySize
+        out_dim, in_dim = layer
+        return -(-out_dim // n), -(-in_dim // n)
+
+    #rows of each row tile holding real weights (trailing padded rows are skipped
+    #by executeWeightStationary)
+    def _tileRows(self, layer):
+        n = self.arraySize
+        rowTiles, _ = self._tileGrid(layer)
+        return [min(n, layer[0] - r * n) for r in range(rowTiles)]
+
+    #mirrors ProgramLoader.executeTileMatMul: compute program, then fetch program
+    def _tileTransfers(self):
+        n = self.arraySize
+        enc = ISAEncoder()
+        enc.storeWords(0x080, [0] * (n * n)).loadWeights(0x080)
+        enc.storeWords(0x000, [0] * (4 * inputWords(n))).loadInputs(0x000)
+        enc.run(0x100, compute=True, quantize=True, relu=False).halt()
+        compute = enc.getProgram()
+        fetch = encodeFetchResults(0x100, n) + encodeHalt()
+
+        tiles = sum(r * c for r, c in map(self._tileGrid, self.layers))
+        return [Transfer(compute, 0, tiles), Transfer(fetch, n, tiles)], 1
+
+    #mirrors ProgramLoader.executeWeightStationary for batchSize images per weight tile
+    def _weightStationaryTransfers(self):
+        n = self.arraySize
+        inStride = inputWords(n)
+        outStride = resultWords(n)
+        perProgram = 0x080 // max(inStride, outStride)
+        transfers = []
+
+        for layer in self.layers:
+            _, colTiles = self._tileGrid(layer)
+            for rows in self._tileRows(layer):
+                for start in range(0, self.batchSize, perProgram):
+                    chunk = min(perProgram, self.batchSize - start)
+                    enc = ISAEncoder()
+                    if start == 0:
+                        enc.storeWords(0x080, [0] * (n * n))
+                    enc.loadWeights(0x080)
+                    for j in range(chunk):
+                        enc.storeWords(0x000 + j * inStride, [0] * (4 * inStride))
+                        enc.loadInputs(0x000 + j * inStride)
+                        enc.run(0x100 + j * outStride, compute=True, quantize=True, relu=False)
+
+                    if rows == n and n % 2 == 0:
+                        fetch = encodeFetchWords(0x100, chunk * outStride)
+                    else:
+                        fetch = b''.join(encodeFetchResults(0x100 + i * outStride, rows) for i in range(chunk))
+
+                    transfers.append(Transfer(enc.getProgram(), 0, colTiles))
+                    transfers.append(Transfer(fetch + encodeHalt(), rows * chunk, colTiles))
+
+        return transfers, self.batchSize
+
+    #ProgramLoader.buildPipelinedProgram, one stream per layer
+    def _pipelinedTransfers(self):
+        from program_loader import ProgramLoader
+
+        n = self.arraySize
+        loader = ProgramLoader(None, False, array_size=n)
+        transfers = []
+        for layer in self.layers:
+            rowTiles, colTiles = self._tileGrid(layer)
+            tiles = [([0] * (n * n), [0] * n)] * (rowTiles * colTiles)
+            program = loader.buildPipelinedProgram(tiles, quantize=True, relu=False)
+            transfers.append(Transfer(program, n * len(tiles), 1, 'stream'))
+        return transfers, 1
+
+    #(transfers, images) for one run of a strategy's schedule
+    def transfers(self, strategy):
+        builders = {
+            'tile': self._tileTransfers,
+            'weight_stationary': self._weightStationaryTransfers,
+            'pipelined': self._pipelinedTransfers,
+        }
+        if strategy not in builders:
+            raise ValueError(f"Unknown strategy '{strategy}', expected one of {STRATEGIES}")
+        return builders[strategy]()
+
+    #number of serial writes UARTDriver.send_bytes_to_chip makes for `size` bytes
+    def _writes(self, size):
+        return math.ceil(size / (self.fifoSize // 2))
+
+    #linear latency features for a list of transfers
+    def features(self, transfers) -> Dict[str, float]:
+        txBytes = rxBytes = chunks = writes = roundTrips = instructions = 0
+        for t in transfers:
+            size = len(t.program)
+            txBytes += size * t.count
+            rxBytes += t.rx * t.count
+            instructions += len(decodeProgram(t.program)) * t.count
+            if t.rx:
+                roundTrips += t.count
+
+            pieces = [min(PROGRAM_CHUNK, size - i) for i in range(0, size, PROGRAM_CHUNK)]
+            if t.mode == 'program':
+                chunks += len(pieces) * t.count
+            writes += sum(self._writes(p) for p in pieces) * t.count
+
+        return {
+            'wire': (txBytes + rxBytes) * BITS_PER_BYTE / self.baud,
+            'chunk_sleep': chunks,
+            'write_sleep': writes,
+            'round_trip': roundTrips,
+            'instruction': instructions,
+        }
+
+    #instructions by opcode for a list of transfers
+    def opcodeCounts(self, transfers) -> Dict[str, int]:
+        counts = {name: 0 for name in OPCODE_NAMES.values()}
+        for t in transfers:
+            for instr in decodeProgram(t.program):
+                counts[OPCODE_NAMES[instr.opcode]] += t.count
+        return counts
+
+    #unified buffer words written (STORE, RUN) or read (LOAD, FETCH), per 128-word section
+    def occupancy(self, transfers) -> Dict[str, int]:
+        n = self.arraySize
+        used = set()
+        for t in transfers:
+            for instr in decodeProgram(t.program):
+                if instr.opcode == OPCODE_STORE:
+                    used.add(instr.addr)
+                elif instr.opcode == OPCODE_RUN:
+                    used.update(range(instr.addr, instr.addr + resultWords(n)))
+                elif instr.opcode == OPCODE_LOAD:
+                    span = weightWords(n) if instr.flags & 0b1 else inputWords(n)
+                    used.update(range(instr.addr, instr.addr + span))
+                elif instr.opcode == OPCODE_FETCH:
+                    used.add(instr.addr)
+
+        sections = {}
+        for i, name in enumerate('ABCD'):
+            base = i * 0x080
+            sections[name] = sum(1 for a in used if base <= a < base + 0x080)
+        sections['total'] = len(used)
+        return sections
+
+    #seconds for a feature dict under the current constants
+    def latency(self, features: Dict[str, float]) -> float:
+        return sum(self.constants[name] * features[name] for name in CONSTANT_NAMES)
+
+    #full per-inference estimate for one strategy
+    def estimate(self, strategy) -> dict:
+        transfers, images = self.transfers(strategy)
+
+        features = self.features(transfers)
+        seconds = self.latency(features) / images
+        return {
+            'strategy': strategy,
+            'images': images,
+            'tx_bytes': sum(len(t.program) * t.count for t in transfers) / images,
+            'rx_bytes': sum(t.rx * t.count for t in transfers) / images,
+            'opcodes': {k: v / images for k, v in self.opcodeCounts(transfers).items()},
+            'occupancy': self.occupancy(transfers),
+            'features': {k: v / images for k, v in features.items()},
+            'latency': seconds,
+            'images_per_second': 1.0 / seconds if seconds > 0 else float('inf'),
+        }
+
+    def estimateAll(self) -> List[dict]:
+        return [self.estimate(s) for s in STRATEGIES]
+
+
+#non-negative least squares by repeatedly dropping columns with negative weights
+def _nnls(A, b):
+    active = list(range(A.shape[1]))
+    x = np.zeros(A.shape[1])
+    while active:
+        sol, *_ = np.linalg.lstsq(A[:, active], b, rcond=None)
+        if np.all(sol >= 0):
+            x[active] = sol
+            break
+        active = [c for c, v in zip(active, sol) if v > 0]
+    return x
+
+
+#fit latency constants from recorded traces (JSON lines written by
+#fpga_inference.py --trace). each trace holds strategy, layers, images,
+#seconds and optionally batch_size, baud, fifo_size and array_size.
+#constants whose feature never varies across traces keep their defaults.
+def calibrate(traces: List[dict], config_path=None) -> Tuple[Dict[str, float], dict]:
+    rows = []
+    targets = []
+    for trace in traces:
+        model = PerfModel(trace['layers'], config_path=config_path,
+                          baud=trace.get('baud', 115200),
+                          fifo_size=trace.get('fifo_size', 256),
+                          batch_size=trace.get('batch_size') or 32)
+        if trace.get('array_size', model.arraySize) != model.arraySize:
+            raise ValueError(f"Trace recorded with array size {trace['array_size']}, "
+                             f"config has {model.arraySize}")
+
+        transfers, images = model.transfers(trace['strategy'])
+        features = model.features(transfers)
+        scale = trace['images'] / images
+        rows.append([features[name] * scale for name in CONSTANT_NAMES])
+        targets.append(trace['seconds'])
+
+    A = np.array(rows, dtype=np.float64)
+    b = np.array(targets, dtype=np.float64)
+
+    #only fit constants the traces can tell apart
+    free = [c for c in range(A.shape[1]) if np.any(A[:, c] != 0)]
+    constants = dict(DEFAULT_CONSTANTS)
+    if free:
+        fitted = _nnls(A[:, free], b)
+        for c, value in zip(free, fitted):
+            constants[CONSTANT_NAMES[c]] = float(value)
+
+    predicted = A @ np.array([constants[name] for name in CONSTANT_NAMES])
+    relative = np.abs(predicted - b) / np.maximum(b, 1e-9)
+    report = {
+        'traces': len(traces),
+        'fitted': [CONSTANT_NAMES[c] for c in free],
+        'mean_relative_error': float(relative.mean()) if len(b) else 0.0,
+        'max_relative_error': float(relative.max()) if len(b) else 0.0,
+    }
+    return constants, report
+
+
+def loadTraces(path) -> List[dict]:
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+#print estimates as a table plus per-strategy details
+def printEstimates(model: PerfModel, estimates: List[dict]):
+    n = model.arraySize
+    if all(prev[0] == layer[1] for prev, layer in zip(model.layers, model.layers[1:])):
+        shapes = ' -> '.join([str(model.layers[0][1])] + [str(out) for out, _ in model.layers])
+    else:
+        #conv positions: one (out, in) matrix repeated, listed once with its count
+        groups = []
+        for layer in model.layers:
+            if groups and groups[-1][0] == layer:
+                groups[-1][1] += 1
+            else:
+                groups.append([layer, 1])
+        shapes = ', '.join(f"{inp}->{out}" + (f" x{count}" if count > 1 else "") for (out, inp), count in groups)
+    print(f"Model:  {shapes}")
+    print(f"Array:  {n}x{n}, {model.config['input_width']}-bit inputs, "
+          f"{model.config['accumulator_width']}-bit accumulators")
+    print(f"Link:   {model.baud} baud, {model.fifoSize} B FIFO")
+    print()
+    print(f"{'strategy':<18} {'TX B/img':>10} {'RX B/img':>9} {'instr/img':>10} "
+          f"{'buf words':>9} {'ms/img':>9} {'img/s':>8}")
+    for e in estimates:
+        instr = sum(e['opcodes'].values())
+        print(f"{e['strategy']:<18} {e['tx_bytes']:>10.1f} {e['rx_bytes']:>9.1f} {instr:>10.1f} "
+              f"{e['occupancy']['total']:>9} {1000 * e['latency']:>9.2f} {e['images_per_second']:>8.3f}")
+
+    for e in estimates:
+        print()
+        label = e['strategy'] + (f" (batch of {e['images']})" if e['images'] > 1 else '')
+        print(f"{label}:")
+        print("  opcodes/img: " + ", ".join(f"{k} {v:.1f}" for k, v in e['opcodes'].items() if v))
+        occ = e['occupancy']
+        print("  buffer:      " + ", ".join(f"{s} {occ[s]}/128" for s in 'ABCD')
+              + f", total {occ['total']}/{BUFFER_SIZE} ({100.0 * occ['total'] / BUFFER_SIZE:.1f}%)")
+        parts = [(name, model.constants[name] * e['features'][name]) for name in CONSTANT_NAMES]
+        print("  latency:     " + ", ".join(f"{name} {1000 * sec:.2f} ms" for name, sec in parts if sec))
+
+
+def main():
+    import argparse
+    from tiled_inference import get_default_paths
+
+    weights_dir, _, _ = get_default_paths()
+
+    parser = argparse.ArgumentParser(description='uTPU analytical performance model')
+    parser.add_argument('--layers', type=str, default=None,
+                        help='Layer sizes, e.g. 196,9,10. Default: shapes of the exported weights.')
+    parser.add_argument('--weights', type=str, default=weights_dir)
+    parser.add_argument('--config', type=str, default=None, help='uTPU toml (default configs/utpu.toml)')
+    parser.add_argument('--baud', type=int, default=115200)
+    parser.add_argument('--fifo', type=int, default=256, help='UART FIFO size in bytes')
+    parser.add_argument('--batch-size', type=int, default=32,
+                        help='Images per weight tile for the weight-stationary schedule')
+    parser.add_argument('--strategy', choices=STRATEGIES, default=None)
+    parser.add_argument('--constants', type=str, default=None, help='JSON file of fitted constants')
+    parser.add_argument('--calibrate', type=str, default=None, metavar='TRACES',
+                        help='Fit constants from a JSONL trace file')
+    parser.add_argument('--save-constants', type=str, default=None)
+    args = parser.parse_args()
+
+    print("=" * 60)
+    print("uTPU Performance Model")
+    print("=" * 60)
+
+    constants = None
+    if args.constants is not None:
+        with open(args.constants) as f:
+            constants = json.load(f)
+
+    if args.calibrate is not None:
+        constants, report = calibrate(loadTraces(args.calibrate), config_path=args.config)
+        print(f"Calibrated on {report['traces']} traces (fitted: {', '.join(report['fitted']) or 'none'})")
+        print(f"  relative error: mean {100 * report['mean_relative_error']:.1f}%, "
+              f"max {100 * report['max_relative_error']:.1f}%")
+        for name in CONSTANT_NAMES:
+            print(f"  {name:<12} {constants[name]:.6g}")
+        if args.save_constants is not None:
+            with open(args.save_constants, 'w') as f:
+                json.dump(constants, f, indent=2)
+            print(f"Wrote {args.save_constants}")
+        print()
+
+    if args.layers:
+        layers = parseLayers(args.layers)
+    else:
+        layers = layersFromWeights(args.weights, load_config(args.config)['array_size'])
+    model = PerfModel(layers, config_path=args.config, baud=args.baud, fifo_size=args.fifo,
+                      batch_size=args.batch_size, constants=constants)
+
+    if args.strategy is not None:
+        estimates = [model.estimate(args.strategy)]
+    else:
+        estimates = model.estimateAll()
+
+    printEstimates(model, estimates)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
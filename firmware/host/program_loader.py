@@ -10,8 +10,51 @@ from isa_encoder import (
     encodeRun,
     encodeFetch,
     encodeHalt,
+    encodeNop,
+    encodeFetchWords,
+    encodeFetchResults,
+    encodeStoreWords,
     int4To16
 )
+from result_decoder import unpackInt4, decodeRunResults
+from latency_model import LatencyModel
+from isa_model import weightWords, inputWords, resultWords, BUFFER_SIZE
+from utpu_config import ARRAY_SIZE
+
+
+# ping-pong buffer allocator for pipelined tiles
+# even tiles put operands in section A and results in section C,
+# odd tiles use sections B and D, so tile N+1 can be uploaded while
+# tile N is computing and its FETCH bytes are draining
+class PingPongAllocator:
+
+    def __init__(self, banks=((0x000, 0x100), (0x080, 0x180)), section_words=0x080, regions=None,
+                 array_size: int = ARRAY_SIZE):
+        self.banks = banks
+        self.sectionWords = section_words
+        self.weightWords = weightWords(array_size)
+        self.operandWords = self.weightWords + inputWords(array_size)
+        self.resultWords = resultWords(array_size)
+        # sub-regions per bank: limits how far ahead the stream may run
+        maxRegions = min(section_words // self.operandWords, section_words // self.resultWords)
+        self.regions = maxRegions if regions is None else min(regions, maxRegions)
+        self.count = 0
+
+    # addresses for the next tile: (weight_addr, input_addr, result_addr)
+    def allocate(self):
+        operandBase, resultBase = self.banks[self.count % len(self.banks)]
+        slot = (self.count // len(self.banks)) % self.regions
+        self.count += 1
+
+        weightAddr = operandBase + slot * self.operandWords
+        return weightAddr, weightAddr + self.weightWords, resultBase + slot * self.resultWords
+
+    # number of tiles in flight before an address is reused
+    def capacity(self):
+        return len(self.banks) * self.regions
+
+    def reset(self):
+        self.count = 0
 
 
 # loads programs and data onto tpu
@@ -20,11 +63,28 @@ class ProgramLoader:
     BUFFER_SECTION_B = 0x080  # 0x080-0x0FF: Section B
     BUFFER_SECTION_C = 0x100  # 0x100-0x17F: Section C
     BUFFER_SECTION_D = 0x180  # 0x180-0x1FF: Section D
-
-    def __init__(self, uart, verbose):
+    BUFFER_SECTION_WORDS = 0x080
+    # words per FETCH burst when dumping the buffer (2 RX bytes each)
+    DUMP_BURST_WORDS = 64
+    # pause between program chunks (seconds)
+    CHUNK_PACE = 0.015
+
+    def __init__(self, uart, verbose, latency: Optional[LatencyModel] = None,
+                 array_size: int = ARRAY_SIZE):
         self.uart = uart
         self.verbose = verbose
+        self.arraySize = array_size
         self.encoder = ISAEncoder()
+        # learned round-trip times, replaces fixed sleeps/timeouts
+        self.latency = latency if latency is not None else LatencyModel()
+        # bytes moved over the link since construction (bandwidth accounting)
+        self.txBytes = 0
+        self.rxBytes = 0
+        # earliest perf_counter() time for the next paced chunk
+        self.pacedUntil = 0.0
+        # called after resync(): anything caching what the buffer holds
+        # (e.g. ModelRegistry residency) must forget it
+        self.resyncListeners = []
 
     def _log(self, message):
         if self.verbose:
@@ -33,24 +93,64 @@ class ProgramLoader:
     # send bytes to chip
     def sendBytes(self, data):
         self.uart.send_bytes_to_chip(data)
+        self.txBytes += len(data)
         self._log(f"Sent {len(data)} bytes")
 
     # send single encoded instruction
     def sendInstructions(self, instruction_bytes):
         self.uart.send_bytes_to_chip(instruction_bytes)
+        self.txBytes += len(instruction_bytes)
         time.sleep(0.001)
 
     # send program to chip
-    def sendProgram(self, program):
+    # chunks are paced 15 ms apart; the pause is taken before the next chunk
+    # (of this or a later program) rather than after each one, so the host can
+    # read results as soon as the last chunk is out
+    # pace=False skips the pauses (bulk STOREs, which return nothing and need no
+    # time to execute)
+    # returns the perf_counter() timestamp of the last chunk write
+    def sendProgram(self, program, pace: bool = True):
         self._log(f"Sending program: {len(program)} bytes")
         chunk_size = 128
+        sent = time.perf_counter()
 
         for i in range(0, len(program), chunk_size):
             chunk = program[i:i + chunk_size]
+            if pace:
+                self._pace()
             self.uart.send_bytes_to_chip(chunk)
-            time.sleep(0.015)
+            sent = time.perf_counter()
+            self.txBytes += len(chunk)
+            if pace:
+                self.pacedUntil = sent + self.CHUNK_PACE
 
         self._log("Program sent successfully")
+        return sent
+
+    # wait out the pause owed after the last paced chunk
+    def _pace(self):
+        wait = self.pacedUntil - time.perf_counter()
+        if wait > 0:
+            time.sleep(wait)
+
+    # wait for count result bytes of an operation, timing the round trip
+    # sent is the perf_counter() timestamp of the program's last byte write
+    def receiveResults(self, op, count, sent, timeout: Optional[float] = None):
+        if timeout is None:
+            timeout = self.latency.timeout(op, count)
+
+        received = self.uart.receive_blocking(count, timeout)
+        self.rxBytes += len(received)
+        if len(received) < count:
+            self.latency.recordTimeout(op)
+            self._log(f"{op}: received {len(received)}/{count} bytes within {1000 * timeout:.1f} ms")
+        else:
+            self.latency.record(op, time.perf_counter() - sent, count)
+        return received
+
+    # learned latency model (per op, per RX byte)
+    def latencySummary(self):
+        return self.latency.summary()
 
     # load array to unified buffer
     def loadInt4ArrayToBuffer(self, base_addr, data):
@@ -81,49 +181,53 @@ class ProgramLoader:
         self._log(f"Loading inputs {inputs.shape} to 0x{base_addr:03X}")
         self.loadInt4ArrayToBuffer(base_addr, inputs)
 
+    # read packed int4 values (4 per word) starting at base_addr
     def readResults(self, base_addr, count):
         self._log(f"Reading {count} values from 0x{base_addr:03X}")
-        program = b''
         numWords = (count + 3) // 4
 
-        for i in range(numWords):
-            addr = base_addr + i
-            program += encodeFetch(addr, top_half=False)
-            program += encodeFetch(addr, top_half=True)
-
-        self.sendProgram(program)
-        time.sleep(0.1)
+        sent = self.sendProgram(encodeFetchWords(base_addr, numWords))
 
         numBytes = numWords * 2
-        received = self.uart.receive_exact(numBytes, timeout=0.2)
+        received = self.receiveResults('fetch', numBytes, sent)
         self._log(f"Received {len(received)} bytes")
 
-        results = []
-        for byte in received:
-            lowNibble = byte & 0x0F
-            highNibble = (byte >> 4) & 0x0F
-
-            if lowNibble >= 8:
-                lowNibble -= 16
-            if highNibble >= 8:
-                highNibble -= 16
-
-            results.append(lowNibble)
-            results.append(highNibble)
-
-        return results[:count]
-
-    # execute 2x2 matrix multiply on the chip
-    def execute2x2MatMul(self, weights, inputs, weight_addr, input_addr, result_addr,
-                         quantize: bool = True, relu: bool = True, timeout: float = 0.5):
-        self._log("Executing 2x2 matmul")
+        return unpackInt4(received)[:count].tolist()
+
+    # read RUN outputs of num_tiles tiles written back to back from base_addr
+    # rows < array size only fetches the first rows outputs (the rest known to be zero)
+    def readRunResults(self, base_addr, num_tiles, rows: Optional[int] = None,
+                       timeout: Optional[float] = None):
+        n = self.arraySize
+        rows = n if rows is None else rows
+        stride = resultWords(n)
+        self._log(f"Reading {num_tiles} tile results from 0x{base_addr:03X}")
+
+        if rows == n and n % 2 == 0:
+            program = encodeFetchWords(base_addr, num_tiles * stride)
+        else:
+            program = b''.join(encodeFetchResults(base_addr + i * stride, rows) for i in range(num_tiles))
+
+        sent = self.sendProgram(program + encodeHalt())
+        received = self.receiveResults('batch', rows * num_tiles, sent, timeout)
+        return decodeRunResults(received, rows, n)
+
+    # execute one NxN tile matmul on the chip (N = configured array size)
+    # weights is the row-major N*N tile, inputs up to N values
+    # weights=None uses the tile already resident at weight_addr (no STORE)
+    # timeout=None uses the learned latency model
+    def executeTileMatMul(self, weights, inputs, weight_addr, input_addr, result_addr,
+                          quantize: bool = True, relu: bool = True, timeout: Optional[float] = None):
+        n = self.arraySize
+        self._log(f"Executing {n}x{n} matmul")
         self.encoder.clear()
 
-        self.encoder.store(weight_addr, weights)
+        if weights is not None:
+            self.encoder.storeWords(weight_addr, list(weights))
         self.encoder.loadWeights(weight_addr)
 
-        inputPadded = inputs + [0] * (4 - len(inputs))
-        self.encoder.store(input_addr, inputPadded)
+        inputPadded = list(inputs) + [0] * (4 * inputWords(n) - len(inputs))
+        self.encoder.storeWords(input_addr, inputPadded)
         self.encoder.loadInputs(input_addr)
 
         self.encoder.run(result_addr, compute=True, quantize=quantize, relu=relu)
@@ -133,33 +237,177 @@ class ProgramLoader:
         self.uart.flush_input()
         self.sendProgram(compute_program)
 
-        # allow compute to complete before fetch
-        time.sleep(0.01)
-
+        # the core executes in order, so the FETCH queues behind the RUN
+        # and no settle delay is needed
         self.encoder.clear()
-        self.encoder.fetch(result_addr, top_half=False)
-        self.encoder.fetch(result_addr, top_half=True)
+        self.encoder.fetchResults(result_addr, n)
         self.encoder.halt()
 
         fetch_program = self.encoder.getProgram()
         self.uart.flush_input()
-        self.sendProgram(fetch_program)
+        sent = self.sendProgram(fetch_program)
+
+        received = self.receiveResults('tile', n, sent, timeout)
+
+        return unpackInt4(received)[0::2][:n].tolist()
+
+    # store raw words starting at base_addr as a single program
+    def storeWordsToBuffer(self, base_addr, words, pace: bool = True):
+        self.sendProgram(encodeStoreWords(base_addr, words), pace)
+        self._log(f"Stored {len(words)} words at 0x{base_addr:03X}")
+
+    # read num_words raw words from base_addr as FETCH bursts of burst_words
+    # each burst is streamed (RX drained while its FETCHes are still being sent);
+    # returns a uint16 array, shorter than num_words if a burst timed out
+    def dumpBuffer(self, base_addr: int = 0, num_words: int = BUFFER_SIZE,
+                   burst_words: Optional[int] = None, timeout: Optional[float] = None):
+        burst_words = burst_words or self.DUMP_BURST_WORDS
+        self._log(f"Dumping {num_words} words from 0x{base_addr:03X} in bursts of {burst_words}")
+
+        received = bytearray()
+        for addr in range(base_addr, base_addr + num_words, burst_words):
+            count = min(burst_words, base_addr + num_words - addr)
+            data = self.streamProgram(encodeFetchWords(addr, count), 2 * count, timeout, op='dump')
+            received += data[:len(data) - len(data) % 2]
+            if len(data) < 2 * count:
+                self._log(f"Dump stopped at 0x{addr + len(data) // 2:03X}")
+                break
 
-        deadline = time.time() + timeout
-        while self.uart.bytes_waiting() < 2 and time.time() < deadline:
-            time.sleep(0.002)
+        # FETCH sends the bottom byte first: the stream is little-endian words
+        return np.frombuffer(bytes(received), dtype='<u2').astype(np.uint16)
 
-        remaining = max(0.0, deadline - time.time())
-        received = self.uart.receive_exact(2, timeout=remaining if remaining > 0 else 0.1)
+    # execute 2x2 matrix multiply on the chip
+    def execute2x2MatMul(self, weights, inputs, weight_addr, input_addr, result_addr,
+                         quantize: bool = True, relu: bool = True, timeout: Optional[float] = None):
+        return self.executeTileMatMul(weights, inputs, weight_addr, input_addr, result_addr,
+                                      quantize=quantize, relu=relu, timeout=timeout)
+
+    # weight-stationary batch: load one weight tile, then stream
+    # LOADIN+RUN for every input vector before fetching all results at once
+    # results are written back to back and read in one burst
+    def executeWeightStationary(self, weights, input_batch, weight_addr, input_addr, result_addr,
+                                quantize: bool = True, relu: bool = True, timeout: Optional[float] = None):
+        n = self.arraySize
+        inStride = inputWords(n)
+        outStride = resultWords(n)
+        batchSize = self.BUFFER_SECTION_WORDS // max(inStride, outStride)
+        self._log(f"Executing weight-stationary {n}x{n} matmul over {len(input_batch)} inputs")
+
+        # trailing all-zero weight rows always produce 0, so skip their bytes
+        weights = list(weights)
+        rows = n
+        while rows > 1 and not any(weights[(rows - 1) * n:rows * n]):
+            rows -= 1
 
         results = []
-        for byte in received:
-            low = byte & 0x0F
-            if low >= 8:
-                low -= 16
-            results.append(low)
+        for start in range(0, len(input_batch), batchSize):
+            chunk = input_batch[start:start + batchSize]
+            self.encoder.clear()
+
+            # weights are uploaded once; LOADWEI is repeated per chunk in case
+            # anything touched the PE array between programs
+            if start == 0:
+                self.encoder.storeWords(weight_addr, weights)
+            self.encoder.loadWeights(weight_addr)
+
+            for j, inputs in enumerate(chunk):
+                inputPadded = list(inputs) + [0] * (4 * inStride - len(inputs))
+                self.encoder.storeWords(input_addr + j * inStride, inputPadded)
+                self.encoder.loadInputs(input_addr + j * inStride)
+                self.encoder.run(result_addr + j * outStride, compute=True, quantize=quantize, relu=relu)
+
+            self.uart.flush_input()
+            self.sendProgram(self.encoder.getProgram())
+
+            chunkResults = self.readRunResults(result_addr, len(chunk), rows=rows, timeout=timeout)
+            results.append(chunkResults)
+
+            if len(chunkResults) < len(chunk):
+                break
+
+        if not results:
+            return []
+        return np.concatenate(results).reshape(-1).tolist()
+
+    # build one instruction stream for independent tiles using ping-pong buffers
+    # the FETCH for tile N is placed after the STOREs of tile N+1
+    def buildPipelinedProgram(self, tiles, quantize: bool = True, relu: bool = True,
+                              allocator: Optional[PingPongAllocator] = None):
+        n = self.arraySize
+        allocator = allocator or PingPongAllocator(array_size=n)
+        allocator.reset()
+        self.encoder.clear()
+
+        pendingResult = None
+        for weights, inputs in tiles:
+            weightAddr, inputAddr, resultAddr = allocator.allocate()
 
-        return results[:2]
+            inputPadded = list(inputs) + [0] * (4 * inputWords(n) - len(inputs))
+            self.encoder.storeWords(weightAddr, list(weights))
+            self.encoder.storeWords(inputAddr, inputPadded)
+
+            if pendingResult is not None:
+                self.encoder.fetchResults(pendingResult, n)
+
+            self.encoder.loadWeights(weightAddr)
+            self.encoder.loadInputs(inputAddr)
+            self.encoder.run(resultAddr, compute=True, quantize=quantize, relu=relu)
+            pendingResult = resultAddr
+
+        if pendingResult is not None:
+            self.encoder.fetchResults(pendingResult, n)
+        self.encoder.halt()
+
+        return self.encoder.getProgram()
+
+    # run a list of (weights, inputs) tiles as one pipelined stream
+    def executeTilesPipelined(self, tiles, quantize: bool = True, relu: bool = True,
+                              timeout: Optional[float] = None):
+        tiles = list(tiles)
+        self._log(f"Executing {len(tiles)} pipelined {self.arraySize}x{self.arraySize} tiles")
+        program = self.buildPipelinedProgram(tiles, quantize=quantize, relu=relu)
+        received = self.streamProgram(program, self.arraySize * len(tiles), timeout)
+        return unpackInt4(received)[0::2].tolist()
+
+    # send a prebuilt stream in 128-byte chunks and collect its expected RX bytes
+    # RX bytes are drained while the rest of the stream is still being sent
+    def streamProgram(self, program, expected, timeout: Optional[float] = None, op: str = 'pipeline'):
+        received = bytearray()
+        chunk_size = 128
+
+        self._pace()
+        self.uart.flush_input()
+        sent = time.perf_counter()
+        for i in range(0, len(program), chunk_size):
+            self.uart.send_bytes_to_chip(program[i:i + chunk_size])
+            sent = time.perf_counter()
+            self.txBytes += len(program[i:i + chunk_size])
+            waiting = self.uart.bytes_waiting()
+            if waiting:
+                data = self.uart.receive_bytes(min(waiting, expected - len(received)))
+                self.rxBytes += len(data)
+                received += data
+
+        # only the tail of the stream is timed: earlier bytes overlapped the upload
+        if len(received) < expected:
+            received += self.receiveResults(op, expected - len(received), sent, timeout)
+        self._log(f"Received {len(received)}/{expected} bytes")
+        return bytes(received)
+
+    # recover after a failed transfer without a hardware reset
+    # two NOPs complete any STORE the core received only part of (the padding
+    # may land in the buffer), late RX bytes are drained and dropped, and
+    # listeners are told the buffer contents are no longer known
+    def resync(self, settle: float = 0.02):
+        self._log("Resync: padding instruction stream, flushing input")
+        padding = encodeNop() * 2
+        self.uart.send_bytes_to_chip(padding)
+        self.txBytes += len(padding)
+        self.uart.flush_input()
+        time.sleep(settle)
+        self.uart.flush_input()
+        for listener in self.resyncListeners:
+            listener()
 
     # sends reset sequence to chip
     def resetChip(self):
@@ -201,6 +449,8 @@ if __name__ == "__main__":
         print(f"Weights: {weights}")
         print(f"Inputs: {inputs}")
         print(f"Results: {results}")
+        print()
+        print(loader.latency.report())
 
         uart.close()
 
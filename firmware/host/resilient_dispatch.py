@@ -0,0 +1,289 @@
+import sys
+import time
+from collections import deque
+from typing import Optional
+
+import numpy as np
+
+from isa_model import inputWords, resultWords
+
+
+# retry-on-failure at tile granularity on top of ProgramLoader
+#
+# every loader call sends a self-contained tile program (operands STOREd, then
+# LOADWEI, LOADIN, RUN, FETCH), so a failed call can be sent again as is. a short
+# read (timeout) or a link error resyncs the loader (instruction stream padded,
+# RX flushed, buffer residency invalidated) and re-sends only that program after
+# a backoff; the rest of the image or eval carries on. weight-stationary batches
+# and pipelined streams are dispatched in chunks so a failure only repeats one
+# chunk.
+# LinkHealth keeps per-link counts and the recent error rate. the backoff doubles
+# on every consecutive failure and halves on every success, so a flaky link
+# settles at a slower retry pace while a healthy one retries almost at once
+# (the loader's latency model separately widens the timeout of an op that timed out)
+
+
+# per-link reliability counters and retry backoff
+class LinkHealth:
+
+    def __init__(self, name, window: int = 256, base_backoff: float = 0.01, max_backoff: float = 1.0):
+        self.name = name
+        self.baseBackoff = base_backoff
+        self.maxBackoff = max_backoff
+        self.backoff = base_backoff
+        self.consecutive = 0
+        # 1 per failed attempt, 0 per successful one
+        self.recent = deque(maxlen=window)
+        self.stats = {
+            'calls': 0,
+            'attempts': 0,
+            'timeouts': 0,
+            'errors': 0,
+            'retries': 0,
+            'resyncs': 0,
+            'failures': 0,
+            'backoff_seconds': 0.0,
+        }
+
+    def recordSuccess(self):
+        self.stats['attempts'] += 1
+        self.recent.append(0)
+        self.consecutive = 0
+        self.backoff = max(self.baseBackoff, self.backoff / 2)
+
+    # kind is 'timeouts' (short read) or 'errors' (the link raised)
+    def recordFailure(self, kind):
+        self.stats['attempts'] += 1
+        self.stats[kind] += 1
+        self.recent.append(1)
+        self.consecutive += 1
+
+    # delay before the next retry, then widen it for the one after
+    def nextBackoff(self) -> float:
+        delay = self.backoff
+        self.backoff = min(self.maxBackoff, self.backoff * 2)
+        self.stats['backoff_seconds'] += delay
+        return delay
+
+    # fraction of recent attempts that failed
+    @property
+    def errorRate(self) -> float:
+        return sum(self.recent) / len(self.recent) if self.recent else 0.0
+
+    def summary(self):
+        summary = dict(self.stats)
+        summary['error_rate'] = self.errorRate
+        summary['backoff'] = self.backoff
+        return summary
+
+    def report(self) -> str:
+        s = self.summary()
+        return (f"Link {self.name}: {s['calls']} calls, {s['attempts']} attempts, "
+                f"{s['timeouts']} timeouts, {s['errors']} errors, {s['retries']} retries, "
+                f"{s['failures']} failed\n"
+                f"  recent error rate {100 * s['error_rate']:.2f}%, backoff {1000 * s['backoff']:.1f} ms "
+                f"(waited {s['backoff_seconds']:.2f} s in total)")
+
+
+# ProgramLoader tile calls with resync + retry
+# batches and pipelined streams are split into chunks whose size adapts to the
+# link: a failed chunk is retried at half the size (fewer bytes that can be
+# lost), and the size doubles back toward the maximum after each success
+class ResilientDispatcher:
+
+    def __init__(self, loader, link: Optional[str] = None, max_retries: int = 3,
+                 base_backoff: float = 0.01, max_backoff: float = 1.0, pipeline_tiles: int = 64,
+                 verbose: bool = False):
+        self.loader = loader
+        self.maxRetries = max_retries
+        self.verbose = verbose
+        name = link if link is not None else getattr(loader.uart, 'port', 'uart')
+        self.health = LinkHealth(name, base_backoff=base_backoff, max_backoff=max_backoff)
+
+        n = loader.arraySize
+        # largest chunk per kind, and the current (adaptive) chunk size
+        self.maxChunk = {
+            'batch': loader.BUFFER_SECTION_WORDS // max(inputWords(n), resultWords(n)),
+            'pipelined stream': pipeline_tiles,
+        }
+        self.chunk = dict(self.maxChunk)
+
+    def _log(self, message):
+        if self.verbose:
+            print(f"[ResilientDispatcher] {message}")
+
+    # one attempt: results if at least expected values came back, else None
+    # after recording the failure and resyncing the loader
+    def _attempt(self, attempt, expected):
+        try:
+            results = attempt()
+        except OSError as e:
+            self.health.recordFailure('errors')
+            reason = f"link error: {e}"
+        else:
+            if len(results) >= expected:
+                self.health.recordSuccess()
+                return results[:expected], None
+            self.health.recordFailure('timeouts')
+            reason = f"{len(results)}/{expected} values"
+
+        self.loader.resync()
+        self.health.stats['resyncs'] += 1
+        return None, reason
+
+    def _retry(self, what, reason, retry):
+        delay = self.health.nextBackoff()
+        self._log(f"{what} failed ({reason}), retry {retry}/{self.maxRetries} in {1000 * delay:.0f} ms")
+        time.sleep(delay)
+
+    def _giveUp(self, what, reason):
+        self.health.stats['failures'] += 1
+        raise RuntimeError(f"FPGA {what} failed after {self.maxRetries + 1} attempts on {self.health.name} "
+                           f"({reason})")
+
+    # run attempt() until it returns at least expected values
+    # raises RuntimeError once max_retries retries have failed (the loader is
+    # resynced first, so the caller may carry on with other tiles)
+    def dispatch(self, attempt, expected, what='tile'):
+        self.health.stats['calls'] += 1
+        for retry in range(self.maxRetries + 1):
+            if retry:
+                self.health.stats['retries'] += 1
+                self._retry(what, reason, retry)
+            results, reason = self._attempt(attempt, expected)
+            if results is not None:
+                return results
+        self._giveUp(what, reason)
+
+    # run(chunk) over items in adaptive chunks, each expected to return
+    # array_size values per item; gives up after max_retries failures in a row
+    def _dispatchChunks(self, items, run, what):
+        n = self.loader.arraySize
+        results = []
+        pos = 0
+        failures = 0
+        while pos < len(items):
+            chunk = items[pos:pos + self.chunk[what]]
+            if failures:
+                self.health.stats['retries'] += 1
+                self._retry(what, reason, failures)
+            else:
+                self.health.stats['calls'] += 1
+
+            values, reason = self._attempt(lambda: run(chunk), n * len(chunk))
+            if values is None:
+                failures += 1
+                self.chunk[what] = max(1, len(chunk) // 2)
+                if failures > self.maxRetries:
+                    self._giveUp(what, reason)
+                continue
+
+            results.extend(values)
+            pos += len(chunk)
+            failures = 0
+            self.chunk[what] = min(self.maxChunk[what], self.chunk[what] * 2)
+        return results
+
+    # ProgramLoader.executeTileMatMul with retries
+    # the weight tile is always re-sent: after a resync the buffer contents are unknown
+    def executeTileMatMul(self, weights, inputs, weight_addr, input_addr, result_addr, **kwargs):
+        if weights is None:
+            raise ValueError("Retried tiles need their weights (use executeResidentTile for resident weights)")
+        return self.dispatch(lambda: self.loader.executeTileMatMul(weights, inputs, weight_addr, input_addr,
+                                                                   result_addr, **kwargs),
+                             self.loader.arraySize, 'tile')
+
+    # tile whose weights are already resident in the buffer
+    # prepare() returns the weight address and runs before every attempt, so
+    # after a resync it can upload the weights again (ModelRegistry.activate)
+    def executeResidentTile(self, prepare, inputs, input_addr, result_addr, **kwargs):
+        attempt = lambda: self.loader.executeTileMatMul(None, inputs, prepare(), input_addr, result_addr, **kwargs)
+        return self.dispatch(attempt, self.loader.arraySize, 'resident tile')
+
+    # ProgramLoader.executeWeightStationary with retries, one program per chunk
+    # of inputs (the weight tile is re-sent with each chunk)
+    def executeWeightStationary(self, weights, input_batch, weight_addr, input_addr, result_addr, **kwargs):
+        run = lambda inputs: self.loader.executeWeightStationary(weights, inputs, weight_addr, input_addr,
+                                                                 result_addr, **kwargs)
+        return self._dispatchChunks(list(input_batch), run, 'batch')
+
+    # ProgramLoader.executeTilesPipelined with retries, one stream per chunk of tiles
+    def executeTilesPipelined(self, tiles, **kwargs):
+        run = lambda group: self.loader.executeTilesPipelined(group, **kwargs)
+        return self._dispatchChunks(list(tiles), run, 'pipelined stream')
+
+    # current chunk sizes next to the link report
+    def report(self) -> str:
+        return (self.health.report() + "\n  chunk sizes: "
+                + ", ".join(f"{what} {self.chunk[what]}/{self.maxChunk[what]}" for what in self.chunk))
+
+
+def main():
+    import argparse
+    from loopback_uart import LoopbackUART
+    from program_loader import ProgramLoader
+    from isa_model import quantizeAccumulatorArray
+    from utpu_config import ARRAY_SIZE
+
+    parser = argparse.ArgumentParser(description='uTPU resilient tile dispatch')
+    parser.add_argument('--port', '-p', type=str, default=None,
+                        help='Serial port (e.g. COM3). Omit to use the loopback stand-in.')
+    parser.add_argument('--drop-rate', type=float, default=0.01,
+                        help='Loopback only: probability that a FETCH byte is lost')
+    parser.add_argument('--tiles', type=int, default=500)
+    parser.add_argument('--batch-size', type=int, default=None,
+                        help='Run weight-stationary batches of this many inputs instead of single tiles')
+    parser.add_argument('--retries', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--verbose', '-v', action='store_true')
+    args = parser.parse_args()
+
+    print("=" * 60)
+    print("uTPU Resilient Dispatch")
+    print("=" * 60)
+
+    if args.port is not None:
+        from uart_driver import UARTDriver
+        uart = UARTDriver(args.port, baud=115200)
+    else:
+        uart = LoopbackUART(drop_rate=args.drop_rate, seed=args.seed)
+    n = ARRAY_SIZE
+    loader = ProgramLoader(uart, args.verbose, array_size=n)
+    loader.resetChip()
+    dispatcher = ResilientDispatcher(loader, max_retries=args.retries, verbose=args.verbose)
+    addrs = (loader.BUFFER_SECTION_B, loader.BUFFER_SECTION_A, loader.BUFFER_SECTION_C)
+
+    rng = np.random.default_rng(args.seed)
+    correct = 0
+    failed = 0
+    start = time.perf_counter()
+    for _ in range(args.tiles):
+        weights = rng.integers(-8, 8, size=(n, n))
+        inputs = rng.integers(-8, 8, size=(args.batch_size or 1, n))
+        expected = quantizeAccumulatorArray(inputs @ weights.T)
+        try:
+            if args.batch_size is None:
+                results = dispatcher.executeTileMatMul(weights.flatten().tolist(), inputs[0].tolist(), *addrs,
+                                                       relu=False)
+            else:
+                results = dispatcher.executeWeightStationary(weights.flatten().tolist(), inputs.tolist(), *addrs,
+                                                             relu=False)
+        except RuntimeError as e:
+            print(f"  {e}")
+            failed += 1
+            continue
+        correct += int(np.array_equal(np.reshape(results, expected.shape), expected))
+    elapsed = time.perf_counter() - start
+
+    print(f"\n{args.tiles} tile calls in {elapsed:.2f} s: {correct} correct, {failed} gave up")
+    if args.port is None:
+        print(f"Loopback dropped {uart.dropped} bytes")
+    print(dispatcher.report())
+    print()
+    print(loader.latency.report())
+    uart.close()
+    return 0 if correct + failed == args.tiles else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,136 @@
+import hashlib
+import os
+import struct
+from typing import Dict, Iterable, Optional
+
+import numpy as np
+
+
+MAGIC = b'UTPUCACH'
+VERSION = 1
+# magic, version, logits per record
+HEADER = struct.Struct('<8sII')
+KEY_BYTES = 32
+
+
+#sha256 of any mix of arrays, bytes and strings (order matters)
+def hashParts(parts: Iterable) -> bytes:
+    h = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, np.ndarray):
+            array = np.ascontiguousarray(part)
+            h.update(str((array.dtype.str, array.shape)).encode())
+            h.update(array.tobytes())
+        elif isinstance(part, (bytes, bytearray)):
+            h.update(part)
+        else:
+            h.update(str(part).encode())
+        h.update(b'\0')
+    return h.digest()
+
+
+#sha256 of a file's contents (e.g. the FPGA bitstream)
+def hashFile(path) -> bytes:
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.digest()
+
+
+def hashImage(image) -> bytes:
+    return hashParts([np.asarray(image)])
+
+
+# append-only cache of per-image logits
+# file layout: header, then fixed-size records of (32-byte key, float32 logits)
+# so the whole file can be np.memmap'ed. records are only ever appended;
+# a torn record at the end (interrupted write) is ignored on open.
+# the key is sha256(model hash, scheduling mode, image hash): any change to
+# the model, bitstream or mode simply misses instead of serving stale logits
+class ResultCache:
+
+    def __init__(self, path, model_hash: bytes, mode: str, num_logits: int = 10):
+        self.path = path
+        self.modelHash = model_hash
+        self.mode = mode
+        self.numLogits = num_logits
+        self.dtype = np.dtype([('key', 'V%d' % KEY_BYTES), ('logits', '<f4', (num_logits,))])
+        self.index = {}      # key -> record number in the memmap
+        self.appended = {}   # key -> logits written since open
+        self.records = None
+        self.hits = 0
+        self.misses = 0
+        self._open()
+
+    # a file shorter than the header is a create that was interrupted (it must
+    # be the start of a header) and is initialised again like an empty one
+    def _open(self):
+        header = HEADER.pack(MAGIC, VERSION, self.numLogits)
+        start = b''
+        if os.path.exists(self.path):
+            with open(self.path, 'rb') as f:
+                start = f.read(HEADER.size)
+        if len(start) < HEADER.size:
+            if not header.startswith(start):
+                raise ValueError(f"{self.path} is not a uTPU result cache (v{VERSION})")
+            with open(self.path, 'wb') as f:
+                f.write(header)
+            return
+
+        magic, version, numLogits = HEADER.unpack(start)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{self.path} is not a uTPU result cache (v{VERSION})")
+        if numLogits != self.numLogits:
+            raise ValueError(f"{self.path} stores {numLogits} logits per image, expected {self.numLogits}")
+
+        count = (os.path.getsize(self.path) - HEADER.size) // self.dtype.itemsize
+        if count:
+            self.records = np.memmap(self.path, dtype=self.dtype, mode='r', offset=HEADER.size, shape=(count,))
+            for i, key in enumerate(self.records['key']):
+                self.index[key.tobytes()] = i
+
+        # drop a partially written trailing record so appends stay aligned
+        end = HEADER.size + count * self.dtype.itemsize
+        if os.path.getsize(self.path) != end:
+            with open(self.path, 'r+b') as f:
+                f.truncate(end)
+
+    def key(self, image) -> bytes:
+        return hashParts([self.modelHash, self.mode, hashImage(image)])
+
+    def get(self, key: bytes) -> Optional[np.ndarray]:
+        if key in self.appended:
+            self.hits += 1
+            return self.appended[key]
+        i = self.index.get(key)
+        if i is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return np.array(self.records['logits'][i])
+
+    # append one record per (key, logits) pair and flush
+    def putMany(self, keys, logits) -> None:
+        logits = np.asarray(logits, dtype='<f4').reshape(-1, self.numLogits)
+        batch = np.empty(len(keys), dtype=self.dtype)
+        for i, key in enumerate(keys):
+            batch['key'][i] = np.frombuffer(key, dtype='V%d' % KEY_BYTES)[0]
+        batch['logits'] = logits
+
+        with open(self.path, 'ab') as f:
+            f.write(batch.tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+
+        for key, row in zip(keys, logits):
+            self.appended[key] = row.copy()
+
+    def put(self, key: bytes, logits) -> None:
+        self.putMany([key], logits)
+
+    def __len__(self):
+        return len(self.index) + len(self.appended)
+
+    def summary(self) -> Dict[str, int]:
+        return {'entries': len(self), 'hits': self.hits, 'misses': self.misses}
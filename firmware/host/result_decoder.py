@@ -0,0 +1,35 @@
+import numpy as np
+
+from utpu_config import ARRAY_SIZE
+
+
+# vectorized int4 unpack: each byte holds two nibbles, low nibble first
+# lanes selects nibbles within each 16-bit word (e.g. isa_model.RESULT_LANES for RUN output)
+def unpackInt4(data, lanes=None) -> np.ndarray:
+    raw = np.frombuffer(bytes(data), dtype=np.uint8)
+    nibbles = np.empty(raw.size * 2, dtype=np.int8)
+    nibbles[0::2] = raw & 0x0F
+    nibbles[1::2] = raw >> 4
+    nibbles = (nibbles ^ 8) - 8  # sign extend int4
+
+    if lanes is None:
+        return nibbles
+
+    numWords = -(-nibbles.size // 4)
+    index = (np.arange(numWords)[:, None] * 4 + np.asarray(lanes)).reshape(-1)
+    return nibbles[index[index < nibbles.size]]
+
+
+# decode fetched RUN results into (tiles, array_size) outputs
+# rows is how many result bytes were fetched per tile; rows not fetched
+# (known to be zero) are filled with 0
+def decodeRunResults(data, rows: int = None, array_size: int = ARRAY_SIZE) -> np.ndarray:
+    rows = array_size if rows is None else rows
+    outputs = unpackInt4(data)[0::2]  # one result per byte, in the low nibble
+    outputs = outputs[:outputs.size - outputs.size % rows].reshape(-1, rows)
+    if rows == array_size:
+        return outputs
+
+    decoded = np.zeros((outputs.shape[0], array_size), dtype=np.int8)
+    decoded[:, :rows] = outputs
+    return decoded
@@ -5,15 +5,159 @@ import os
 
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), '../../software/model'))
 
-
-#runs inference using 2x2 tiled matmul
+from utpu_config import ARRAY_SIZE, RELU_ALPHA
+from export_weights import quantize_multiplier, nonzero_tile_mask, ACTIVATIONS
+from conv_layer import conv_output_size, im2col_weights, pad_input, operand_starts, conv_int32
+
+
+#fused integer requantize + leaky relu, in place on an int32 accumulator array
+#y = clip(round_half_up(leaky(acc) * multiplier / 2**shift), -8, 7)
+#leaky is x for x >= 0 else x / 2**RELU_ALPHA (alpha = 0.25).
+#rounding is round half up (floor(x + 0.5)): ties go toward +inf, so it only
+#differs from np.round (half to even) on exact .5 products.
+#the relu shift is applied to acc * multiplier before rounding, which is exact:
+#floor(floor(t / 4) / 2**s + 1/2) == floor(t / 2**(s+2) + 1/2)
+def requantize_leaky_relu_(acc, multiplier, shift, apply_relu=True):
+    np.multiply(acc, multiplier, out=acc)
+    if apply_relu:
+        #max(t, t >> alpha) is t for t >= 0 and t >> alpha for t < 0
+        np.maximum(acc, acc >> RELU_ALPHA, out=acc)
+    np.add(acc, 1 << (shift - 1), out=acc)
+    np.right_shift(acc, shift, out=acc)
+    np.clip(acc, -8, 7, out=acc)
+    return acc
+
+
+#per-pixel lookup table for a layer with int4 inputs
+#lut[i, v + 8, o] = weights[o, i] * v for every input value v in [-8, 7]
+def build_lut(weights):
+    values = np.arange(-8, 8, dtype=np.int32)
+    return weights.T.astype(np.int32)[:, None, :] * values[None, :, None]
+
+
+#int32 accumulators (batch, out) as a sum of gathered LUT rows
+#same integer sums as the tiled matmul, only the addition order differs
+def lut_matmul_int32(lut, inputs):
+    in_dim, _, out_dim = lut.shape
+    index = inputs.astype(np.intp) + 8
+    index += np.arange(in_dim, dtype=np.intp) * 16
+    rows = lut.reshape(in_dim * 16, out_dim).take(index, axis=0)
+    return rows.sum(axis=-2, dtype=np.int32)
+
+
+#(multiplier, shift) for a layer from scales.npy, derived from the scale if missing
+def _layer_requant(scales, name, scale, in_features):
+    if f'{name}_multiplier' in scales:
+        return int(scales[f'{name}_multiplier']), int(scales[f'{name}_shift'])
+    return quantize_multiplier(scale, in_features)
+
+
+#load an exported layer stack as a list of dicts (name, type, weight, scale,
+#requant, activation, in/out_features and, for conv layers, conv geometry)
+#scales['layers'] names the layers in order; older exports are fc1_weight.npy,
+#fc2_weight.npy, ... without activation keys (leaky relu on all but the last layer)
+def load_layers(weights_dir):
+    scales_path = os.path.join(weights_dir, 'scales.npy')
+    if not os.path.exists(scales_path):
+        raise FileNotFoundError(f"Scales not found: {scales_path}")
+    scales = np.load(scales_path, allow_pickle=True).item()
+
+    names = list(scales.get('layers', []))
+    if not names:
+        while os.path.exists(os.path.join(weights_dir, f'fc{len(names) + 1}_weight.npy')):
+            names.append(f'fc{len(names) + 1}')
+    if not names:
+        raise FileNotFoundError(f"FC1 weights not found: {os.path.join(weights_dir, 'fc1_weight.npy')}")
+
+    layers = []
+    for index, name in enumerate(names):
+        weight_path = os.path.join(weights_dir, f'{name}_weight.npy')
+        if not os.path.exists(weight_path):
+            raise FileNotFoundError(f"{name.upper()} weights not found: {weight_path}")
+        weight = np.load(weight_path).astype(np.int8)
+        scale = float(scales[f'{name}_scale'])
+        last = index == len(names) - 1
+        activation = scales.get(f'{name}_activation', 'none' if last else 'leaky_relu')
+
+        conv = scales.get(f'{name}_conv')
+
+        #validate shapes, int4 range and activation
+        if weight.ndim != 2:
+            raise ValueError(f"{name}: expected a 2D (out, in) weight, got shape {weight.shape}")
+        in_features, out_features = weight.shape[1], weight.shape[0]
+        if conv is not None:
+            if weight.shape[1] != conv['in_channels'] * conv['kernel_size'] ** 2:
+                raise ValueError(f"{name}: weight {weight.shape} does not match a "
+                                 f"{conv['in_channels']}x{conv['kernel_size']}x{conv['kernel_size']} kernel")
+            out_height, out_width = conv_output_size(conv)
+            in_features = conv['in_channels'] * conv['input_size'][0] * conv['input_size'][1]
+            out_features = weight.shape[0] * out_height * out_width
+        if layers and in_features != layers[-1]['out_features']:
+            raise ValueError(f"{name} expects {in_features} inputs but "
+                             f"{layers[-1]['name']} has {layers[-1]['out_features']} outputs")
+        if weight.min() < -8 or weight.max() > 7:
+            raise ValueError(f"{name}: weights outside the int4 range [-8, 7]")
+        if activation not in ACTIVATIONS:
+            raise ValueError(f"{name}: unknown activation '{activation}'")
+        if last and activation != 'none':
+            raise ValueError(f"{name}: the output layer returns logits and cannot have an activation")
+
+        layers.append({
+            'name': name,
+            'type': 'fc' if conv is None else 'conv',
+            'weight': weight,
+            'conv': conv,
+            'in_features': in_features,
+            'out_features': out_features,
+            'scale': scale,
+            'requant': _layer_requant(scales, name, scale, weight.shape[1]),
+            'activation': activation,
+        })
+
+    return layers
+
+
+#runs inference using NxN tiled matmul (N from configs/utpu.toml)
 #models hardware int32 accumulator behavior exactly
 class TiledInferenceEngine:
 
-    def __init__(self, weights_dir, model_path, verbose=False, tile_runner=None):
+    #layers: an already prepared layer stack (another engine's .layers, e.g.
+    #attached from shared memory by parallel_eval.py); weights_dir and
+    #model_path are not read then
+    def __init__(self, weights_dir, model_path, verbose=False, tile_runner=None, batch_tile_runner=None,
+                 tiles_runner=None, array_size=ARRAY_SIZE, lut=False, layers=None):
         self.verbose = verbose
+        self.array_size = array_size
         self.tile_runner = tile_runner
+        self.batch_tile_runner = batch_tile_runner
+        #runs every tile of a layer as one stream (pipelined hardware dispatch)
+        self.tiles_runner = tiles_runner
+
+        if layers is not None:
+            self.layers = layers
+        else:
+            self.layers = self._load_layers(weights_dir, model_path, array_size)
+
+        #per-layer attributes (fc1_weight, fc2_scale, ...) for code written
+        #against the two-layer model
+        for layer in self.layers:
+            for key in ('weight', 'scale', 'requant', 'tile_mask'):
+                setattr(self, f"{layer['name']}_{key}", layer[key])
+
+        #first layer LUT-gather backend (software only, hardware runners take precedence)
+        self.fc1_lut = build_lut(self.layers[0]['weight']) if lut and self.layers[0]['type'] == 'fc' else None
+
+        #biases removed (HW mismatch)
 
+        for layer in self.layers:
+            self._log(f"{layer['name'].upper()}: {layer['type']} weight {layer['weight'].shape}, "
+                      f"scale {layer['scale']:.6f}, activation {layer['activation']}")
+        self._log(f"Tile size: {array_size}x{array_size}")
+        self._log("Initialization complete")
+
+    #exported int4 layer stack (fc1, fc2, ... with scales and activations) plus
+    #the matrix each layer dispatches to the array and its nonzero-tile mask
+    def _load_layers(self, weights_dir, model_path, array_size):
         weights_dir = os.path.abspath(weights_dir)
         model_path = os.path.abspath(model_path)
 
@@ -26,44 +170,40 @@ class TiledInferenceEngine:
         if not os.path.exists(model_path):
             raise FileNotFoundError(f"Model file not found: {model_path}")
 
-        #load int4 weights from npy files
-        fc1_weight_path = os.path.join(weights_dir, 'fc1_weight.npy')
-        fc2_weight_path = os.path.join(weights_dir, 'fc2_weight.npy')
-        scales_path = os.path.join(weights_dir, 'scales.npy')
-
-        if not os.path.exists(fc1_weight_path):
-            raise FileNotFoundError(f"FC1 weights not found: {fc1_weight_path}")
-        if not os.path.exists(fc2_weight_path):
-            raise FileNotFoundError(f"FC2 weights not found: {fc2_weight_path}")
-        if not os.path.exists(scales_path):
-            raise FileNotFoundError(f"Scales not found: {scales_path}")
-
-        self.fc1_weight = np.load(fc1_weight_path).astype(np.int8)  # (16, 196)
-        self.fc2_weight = np.load(fc2_weight_path).astype(np.int8)  # (10, 16)
-
-        #load scale factors
-        scales = np.load(scales_path, allow_pickle=True).item()
-        self.fc1_scale = float(scales['fc1_scale'])
-        self.fc2_scale = float(scales['fc2_scale'])
-
-        #biases removed (HW mismatch)
-
-        #validate shapes
-        assert self.fc1_weight.shape == (9, 196) # 196-9-10
-        assert self.fc2_weight.shape == (10, 9)
-
-        #validate weight ranges are int4
-        assert self.fc1_weight.min() >= -8 and self.fc1_weight.max() <= 7
-        assert self.fc2_weight.min() >= -8 and self.fc2_weight.max() <= 7
-
-        self._log(f"FC1: weight {self.fc1_weight.shape}, scale {self.fc1_scale:.6f}")
-        self._log(f"FC2: weight {self.fc2_weight.shape}, scale {self.fc2_scale:.6f}")
-        self._log("Initialization complete")
+        layers = load_layers(weights_dir)
+        for layer in layers:
+            #matrix dispatched to the array: the weights, or the im2col matrix of a conv
+            if layer['type'] == 'conv':
+                layer['matrix'] = im2col_weights(layer['weight'], layer['conv'], array_size)
+                layer['tile_mask'] = nonzero_tile_mask(layer['matrix'], array_size)
+            else:
+                layer['matrix'] = layer['weight']
+                #tiles that are all zero (pruned) are never dispatched
+                layer['tile_mask'] = self._load_tile_mask(weights_dir, layer['name'], layer['weight'])
+        return layers
 
     def _log(self, msg):
         if self.verbose:
             print(f"[TiledInference] {msg}")
 
+    #nonzero-tile mask for a layer: the exported {name}_tile_mask.npy when it was
+    #written for this array size, otherwise derived from the weights
+    def _load_tile_mask(self, weights_dir, name, weights):
+        derived = nonzero_tile_mask(weights, self.array_size)
+        path = os.path.join(weights_dir, f'{name}_tile_mask.npy')
+        if not os.path.exists(path):
+            return derived
+
+        mask = np.load(path).astype(bool)
+        if mask.shape != derived.shape:
+            self._log(f"{name}: tile mask {mask.shape} is for another array size, deriving from weights")
+            return derived
+        if np.any(derived & ~mask):
+            raise ValueError(f"{name}_tile_mask.npy marks tiles with nonzero weights as zero")
+
+        self._log(f"{name}: skipping {mask.size - int(mask.sum())}/{mask.size} zero tiles")
+        return mask
+
     #load state dict from pth file
     def _load_state_dict(self, model_path):
         state_dict = torch.load(model_path, map_location='cpu')
@@ -89,55 +229,110 @@ class TiledInferenceEngine:
         available = list(state_dict.keys())
         raise KeyError(f"Key '{key}' not found. Available: {available}")
 
-    #compute 2x2 tile in int32 (matches hardware PE array)
-    def matmul_2x2_int32(self, weight_tile, input_tile):
-        w = weight_tile.astype(np.int32)
-        x = input_tile.astype(np.int32)
+    #compute one NxN tile in int32 (matches hardware PE array)
+    #out[r] = sum_c w[r,c]*in[c]
+    def matmul_tile_int32(self, weight_tile, input_tile):
+        return weight_tile.astype(np.int32) @ input_tile.astype(np.int32)
 
-        #out[0] = w[0,0]*in[0] + w[0,1]*in[1]
-        #out[1] = w[1,0]*in[0] + w[1,1]*in[1]
-        return np.array([
-            w[0, 0] * x[0] + w[0, 1] * x[1],
-            w[1, 0] * x[0] + w[1, 1] * x[1]
-        ], dtype=np.int32)
+    #compute 2x2 tile in int32
+    def matmul_2x2_int32(self, weight_tile, input_tile):
+        return self.matmul_tile_int32(weight_tile, input_tile)
 
     def _run_tile(self, weight_tile, input_tile):
         if self.tile_runner is None:
-            return self.matmul_2x2_int32(weight_tile, input_tile)
+            return self.matmul_tile_int32(weight_tile, input_tile)
         result = self.tile_runner(weight_tile, input_tile)
-        if result is None or len(result) != 2:
-            raise RuntimeError("Tile runner did not return 2 values")
+        if result is None or len(result) != self.array_size:
+            raise RuntimeError(f"Tile runner did not return {self.array_size} values")
         return result
 
-    #matrix-vector multiply using 2x2 tiles with int32 accumulator
-    def tiled_matmul_int32(self, weights, inputs):
+    #zero-pad weights (out, in) and inputs (..., in) up to multiples of the tile size
+    def _pad_to_tiles(self, weights, inputs):
+        n = self.array_size
         out_dim, in_dim = weights.shape
+        out_padded = -(-out_dim // n) * n
+        in_padded = -(-in_dim // n) * n
 
-        #pad to even dimensions
-        out_padded = out_dim + (out_dim % 2)
-        in_padded = in_dim + (in_dim % 2)
-
-        #create padded arrays
         weights_pad = np.zeros((out_padded, in_padded), dtype=np.int8)
         weights_pad[:out_dim, :in_dim] = weights
 
-        inputs_pad = np.zeros(in_padded, dtype=np.int8)
-        inputs_pad[:in_dim] = inputs
+        inputs_pad = np.zeros(inputs.shape[:-1] + (in_padded,), dtype=np.int8)
+        inputs_pad[..., :in_dim] = inputs
+        return weights_pad, inputs_pad
+
+    #matrix-vector multiply using NxN tiles with int32 accumulator
+    #tiles where tile_mask is False (all-zero weights) are skipped
+    def tiled_matmul_int32(self, weights, inputs, tile_mask=None):
+        n = self.array_size
+        out_dim, _ = weights.shape
+        weights_pad, inputs_pad = self._pad_to_tiles(weights, inputs)
+        out_padded, in_padded = weights_pad.shape
+        if tile_mask is None:
+            tile_mask = nonzero_tile_mask(weights_pad, n)
 
         #accumulate in int32 (matches hardware)
         accum = np.zeros(out_padded, dtype=np.int32)
 
-        #process 2x2 tiles
-        for o in range(0, out_padded, 2):
-            for i in range(0, in_padded, 2):
-                weight_tile = weights_pad[o:o+2, i:i+2]
-                input_tile = inputs_pad[i:i+2]
+        if self.tiles_runner is not None:
+            positions = [(o, i) for o in range(0, out_padded, n) for i in range(0, in_padded, n)
+                         if tile_mask[o // n, i // n]]
+            tiles = [(weights_pad[o:o+n, i:i+n], inputs_pad[i:i+n]) for o, i in positions]
+            partials = self.tiles_runner(tiles)
+            if partials is None or len(partials) != len(tiles):
+                raise RuntimeError("Tiles runner did not return one result per tile")
+            for (o, _), partial in zip(positions, partials):
+                accum[o:o+n] += partial
+            return accum[:out_dim]
+
+        #process NxN tiles
+        for o in range(0, out_padded, n):
+            for i in range(0, in_padded, n):
+                if not tile_mask[o // n, i // n]:
+                    continue
+                weight_tile = weights_pad[o:o+n, i:i+n]
+                input_tile = inputs_pad[i:i+n]
 
                 partial = self._run_tile(weight_tile, input_tile)
-                accum[o:o+2] += partial
+                accum[o:o+n] += partial
 
         return accum[:out_dim]
 
+    def _run_tile_batch(self, weight_tile, input_tiles):
+        if self.batch_tile_runner is not None:
+            result = self.batch_tile_runner(weight_tile, input_tiles)
+            if result is None or len(result) != len(input_tiles):
+                raise RuntimeError("Batch tile runner did not return one result per image")
+            return np.asarray(result, dtype=np.int32)
+        if self.tile_runner is not None:
+            return np.array([self._run_tile(weight_tile, x) for x in input_tiles], dtype=np.int32)
+
+        #(B, N) @ (N, N)^T, same int32 products as matmul_tile_int32
+        return input_tiles.astype(np.int32) @ weight_tile.astype(np.int32).T
+
+    #weight-stationary batch matmul: each weight tile is loaded once and the
+    #same tile position of every image is streamed through it before moving on
+    #per-image partial sums live in accum (batch, out)
+    def tiled_matmul_int32_batch(self, weights, inputs, tile_mask=None):
+        n = self.array_size
+        out_dim, _ = weights.shape
+        weights_pad, inputs_pad = self._pad_to_tiles(weights, inputs)
+        out_padded, in_padded = weights_pad.shape
+        if tile_mask is None:
+            tile_mask = nonzero_tile_mask(weights_pad, n)
+
+        accum = np.zeros((inputs.shape[0], out_padded), dtype=np.int32)
+
+        for o in range(0, out_padded, n):
+            for i in range(0, in_padded, n):
+                if not tile_mask[o // n, i // n]:
+                    continue
+                weight_tile = weights_pad[o:o+n, i:i+n]
+                input_tiles = inputs_pad[:, i:i+n]
+
+                accum[:, o:o+n] += self._run_tile_batch(weight_tile, input_tiles)
+
+        return accum[:, :out_dim]
+
     #quantize to int4 range [-8, 7]
     def quantize_int4(self, x):
         return np.clip(np.round(x), -8, 7).astype(np.float32)
@@ -148,22 +343,74 @@ class TiledInferenceEngine:
         activated = np.where(x >= 0, x, x * 0.25)
         return np.clip(np.round(activated), -8, 7).astype(np.float32)
 
-    #compute fc layer using hardware-equivalent tiled matmul
-    def fc_layer(self, inputs, weights, scale, apply_relu=True):
-        #ensure inputs are int8
-        inputs_int = np.clip(np.round(inputs), -8, 7).astype(np.int8)
-
-        #step 1: integer tiled matmul (hardware behavior)
-        accum = self.tiled_matmul_int32(weights, inputs_int)
-
-        #step 2: scale (software/float) - NO BIAS
-        output = accum.astype(np.float32) * scale
+    #int4 activations as int8, integer inputs pass through without rounding
+    def _as_int4(self, inputs):
+        if np.issubdtype(inputs.dtype, np.integer):
+            return inputs.astype(np.int8, copy=False)
+        return np.clip(np.round(inputs), -8, 7).astype(np.int8)
+
+    #true when every matmul runs in software (no hardware tile runner attached)
+    def _software_only(self):
+        return self.tile_runner is None and self.batch_tile_runner is None and self.tiles_runner is None
+
+    #int32 accumulator -> layer output
+    #hidden layers are requantized to int4 in place (integer only, see
+    #requantize_leaky_relu_), the output layer (no relu, no requant) returns float logits
+    def _requantize(self, accum, weights, scale, requant, apply_relu):
+        if not apply_relu and requant is None:
+            return accum.astype(np.float32) * scale
+        if requant is None:
+            requant = quantize_multiplier(scale, weights.shape[1])
+        multiplier, shift = requant
+        return requantize_leaky_relu_(accum, multiplier, shift, apply_relu)
 
-        #step 3: activation and quantization
-        if apply_relu:
-            output = self.leaky_relu_int4(output)
-
-        return output
+    #compute fc layer using hardware-equivalent tiled matmul
+    #requant is the layer's (multiplier, shift), derived from scale if None
+    #lut (from build_lut) replaces the tiled matmul when no hardware runner is attached
+    #tile_mask selects the weight tiles to dispatch (nonzero tiles if None)
+    def fc_layer(self, inputs, weights, scale, apply_relu=True, requant=None, lut=None, tile_mask=None):
+        #step 1: integer tiled matmul (hardware behavior) - NO BIAS
+        if lut is not None and self._software_only():
+            accum = lut_matmul_int32(lut, self._as_int4(inputs))
+        else:
+            accum = self.tiled_matmul_int32(weights, self._as_int4(inputs), tile_mask)
+
+        #step 2: requantize (+ leaky relu) or scale to logits
+        return self._requantize(accum, weights, scale, requant, apply_relu)
+
+    #batched fc layer, inputs shape (batch, in_dim)
+    def fc_layer_batch(self, inputs, weights, scale, apply_relu=True, requant=None, lut=None,
+                       tile_mask=None):
+        if lut is not None and self._software_only():
+            accum = lut_matmul_int32(lut, self._as_int4(inputs))
+        else:
+            accum = self.tiled_matmul_int32_batch(weights, self._as_int4(inputs), tile_mask)
+        return self._requantize(accum, weights, scale, requant, apply_relu)
+
+    #conv layer as im2col tiles: per output position the patch is gathered from
+    #the padded input (one position at a time, never the whole patch matrix) and
+    #run through the tiled matmul; in software the exact sum is computed directly
+    #inputs shape (in_features,) or (batch, in_features) with batch=True
+    def conv_layer(self, inputs, layer, apply_relu=True, requant=None, batch=False):
+        n = self.array_size
+        x = self._as_int4(inputs).reshape(-1, layer['in_features'])
+
+        if self._software_only():
+            accum = conv_int32(x, layer['weight'], layer['conv'])
+        else:
+            padded = pad_input(x, layer['conv'], n)
+            starts = operand_starts(layer['conv'], n)
+            patches = (starts[:, :, None] + np.arange(n)).reshape(len(starts), -1)
+            accum = np.zeros((len(x), layer['matrix'].shape[0], len(patches)), dtype=np.int32)
+            for p, index in enumerate(patches):
+                if batch:
+                    accum[:, :, p] = self.tiled_matmul_int32_batch(layer['matrix'], padded[:, index], layer['tile_mask'])
+                else:
+                    accum[0, :, p] = self.tiled_matmul_int32(layer['matrix'], padded[0, index], layer['tile_mask'])
+            accum = accum.reshape(len(x), -1)
+
+        out = self._requantize(accum, layer['weight'], layer['scale'], requant, apply_relu)
+        return out if batch else out[0]
 
     #preprocess 14x14 image to int4
     def preprocess_image(self, image):
@@ -173,20 +420,51 @@ class TiledInferenceEngine:
         x = self.quantize_int4(x)
         return x
 
+    #fc_layer arguments for layer index: hidden layers requantize (with leaky
+    #relu if the layer has it), the last layer returns float logits
+    def _layer_args(self, index):
+        layer = self.layers[index]
+        output = index == len(self.layers) - 1
+        return {
+            'weights': layer['weight'],
+            'scale': layer['scale'],
+            'apply_relu': layer['activation'] == 'leaky_relu',
+            'requant': None if output else layer['requant'],
+            'lut': self.fc1_lut if index == 0 else None,
+            'tile_mask': layer['tile_mask'],
+        }
+
+    def _apply_layer(self, x, index, batch):
+        args = self._layer_args(index)
+        layer = self.layers[index]
+        if layer['type'] == 'conv':
+            return self.conv_layer(x, layer, args['apply_relu'], args['requant'], batch=batch)
+        if batch:
+            return self.fc_layer_batch(x, **args)
+        return self.fc_layer(x, **args)
+
     #run complete forward pass
     def forward(self, image):
         #preprocess
         x = self.preprocess_image(image)
         self._log(f"Preprocessed: shape={x.shape}, range=[{x.min()}, {x.max()}]")
 
-        #fc1 + relu + quantize
-        x = self.fc_layer(x, self.fc1_weight, self.fc1_scale, apply_relu=True)
-        self._log(f"After FC1: shape={x.shape}, range=[{x.min()}, {x.max()}]")
+        for index, layer in enumerate(self.layers):
+            x = self._apply_layer(x, index, batch=False)
+            self._log(f"After {layer['name'].upper()}: shape={x.shape}, range=[{x.min()}, {x.max()}]")
+
+        return x
 
-        #fc2 (no relu on output layer)
-        x = self.fc_layer(x, self.fc2_weight, self.fc2_scale, apply_relu=False)
-        self._log(f"After FC2: shape={x.shape}, range=[{x.min():.2f}, {x.max():.2f}]")
+    #forward pass for a batch of images, returns (batch, outputs) logits
+    def forward_batch(self, images):
+        return self.forward_int4_batch(self.preprocess_image(images).reshape(len(images), -1))
 
+    #forward pass for a batch of already quantized int4 inputs (batch, in_features),
+    #e.g. from input_pipeline.py
+    def forward_int4_batch(self, inputs):
+        x = np.asarray(inputs).reshape(len(inputs), -1)
+        for index in range(len(self.layers)):
+            x = self._apply_layer(x, index, batch=True)
         return x
 
     #predict digit class for an image
@@ -195,15 +473,48 @@ class TiledInferenceEngine:
         prediction = int(np.argmax(logits))
         return prediction, logits
 
+    #predict digit classes for a batch of images
+    def predict_batch(self, images):
+        logits = self.forward_batch(images)
+        return np.argmax(logits, axis=1), logits
+
     #evaluate accuracy on dataset
-    def evaluate(self, images, labels, max_samples=None):
+    #batch_size switches to the weight-stationary schedule
+    #sample_range (start, stop) evaluates only those indices; log (eval_log.EvalLog)
+    #streams every sample to disk and skips samples it already holds (resume)
+    #workers > 1 shards the samples over a process pool (parallel_eval.py)
+    def evaluate(self, images, labels, max_samples=None, batch_size=None, sample_range=None, log=None,
+                 workers=None):
         if max_samples is not None:
             images = images[:max_samples]
             labels = labels[:max_samples]
 
+        if workers is not None and workers > 1:
+            if not self._software_only():
+                raise ValueError("Parallel evaluation runs the software engine, tile runners cannot be "
+                                 "shipped to workers (use FPGAInference.evaluate for emulated tiles)")
+            from parallel_eval import evaluate_parallel
+            return evaluate_parallel(self, images, labels, workers, batch_size=batch_size,
+                                     sample_range=sample_range, log=log)
+
+        if sample_range is not None or log is not None:
+            return self._evaluate_logged(images, labels, batch_size, sample_range, log)
+
         total = len(labels)
         correct = 0
 
+        if batch_size is not None:
+            for start in range(0, total, batch_size):
+                preds, _ = self.predict_batch(images[start:start + batch_size])
+                correct += int(np.sum(preds == labels[start:start + batch_size]))
+
+                done = min(start + batch_size, total)
+                if done // 1000 > start // 1000:
+                    acc = 100.0 * correct / done
+                    print(f"Progress: {done}/{total}, Accuracy: {acc:.2f}%")
+
+            return correct / total, correct, total
+
         for i in range(total):
             pred, _ = self.predict(images[i])
             if pred == labels[i]:
@@ -216,6 +527,71 @@ class TiledInferenceEngine:
         accuracy = correct / total
         return accuracy, correct, total
 
+    #per-sample evaluation over an index range, checkpointed through log
+    def _evaluate_logged(self, images, labels, batch_size, sample_range, log):
+        import time
+
+        start, stop = sample_range if sample_range is not None else (0, len(labels))
+        todo = [i for i in range(start, stop) if log is None or not log.done(i)]
+        if log is not None and len(todo) < stop - start:
+            print(f"Resuming: {stop - start - len(todo)} samples already logged, {len(todo)} to go")
+
+        step = batch_size or 1
+        correct = 0
+        for pos in range(0, len(todo), step):
+            chunk = todo[pos:pos + step]
+            t0 = time.perf_counter()
+            if batch_size is not None:
+                preds, logits = self.predict_batch(images[chunk])
+            else:
+                pred, single = self.predict(images[chunk[0]])
+                preds, logits = [pred], [single]
+            seconds = (time.perf_counter() - t0) / len(chunk)
+
+            for i, pred, row in zip(chunk, preds, logits):
+                correct += int(pred == labels[i])
+                if log is not None:
+                    log.add(i, pred, labels[i], seconds, row)
+
+            done = pos + len(chunk)
+            if done // 1000 > pos // 1000:
+                print(f"Progress: {done}/{len(todo)}, Accuracy: {100.0 * correct / done:.2f}%")
+
+        if log is not None:
+            correct, total = log.score(range(start, stop))
+        else:
+            total = len(todo)
+        return (correct / total if total else 0.0), correct, total
+
+
+#time the fc1 matmul of the tiled path against the LUT gather and check that
+#both produce identical int32 accumulators
+def benchmark_lut(engine, images, repeats=3):
+    import time
+
+    x = engine.preprocess_image(images).reshape(len(images), -1).astype(np.int8)
+    lut = engine.fc1_lut if engine.fc1_lut is not None else build_lut(engine.layers[0]['weight'])
+
+    def best(fn):
+        times = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            result = fn()
+            times.append(time.perf_counter() - start)
+        return min(times), result
+
+    tiled_time, tiled_accum = best(lambda: engine.tiled_matmul_int32_batch(engine.layers[0]['weight'], x))
+    lut_time, lut_accum = best(lambda: lut_matmul_int32(lut, x))
+
+    return {
+        'samples': len(images),
+        'tiled_seconds': tiled_time,
+        'lut_seconds': lut_time,
+        'speedup': tiled_time / lut_time if lut_time > 0 else float('inf'),
+        'bit_exact': bool(np.array_equal(tiled_accum, lut_accum)),
+        'lut_bytes': lut.nbytes,
+    }
+
 
 #get default paths relative to this script
 def get_default_paths():
@@ -239,6 +615,18 @@ def main():
     parser.add_argument('--eval', action='store_true')
     parser.add_argument('--sample', type=int, default=None)
     parser.add_argument('--num-samples', type=int, default=None)
+    parser.add_argument('--batch-size', type=int, default=None,
+                        help='Evaluate with the weight-stationary batch schedule')
+    parser.add_argument('--log', type=str, default=None,
+                        help='Stream per-sample results to this JSONL file and resume from it')
+    parser.add_argument('--range', type=str, default=None, metavar='START:STOP',
+                        help='Only evaluate these sample indices (merge shards with eval_log.py)')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='Shard --eval over this many processes (weights in shared memory)')
+    parser.add_argument('--lut', action='store_true',
+                        help='Compute fc1 with per-pixel lookup tables instead of the tiled matmul')
+    parser.add_argument('--benchmark-lut', action='store_true',
+                        help='Compare fc1 LUT gather against the tiled path (speed and bit-exactness)')
     parser.add_argument('--verbose', '-v', action='store_true')
 
     args = parser.parse_args()
@@ -249,7 +637,7 @@ def main():
 
     #initialize engine
     try:
-        engine = TiledInferenceEngine(args.weights, args.model, verbose=args.verbose)
+        engine = TiledInferenceEngine(args.weights, args.model, verbose=args.verbose, lut=args.lut)
     except FileNotFoundError as e:
         print(f"Error: {e}")
         print("\nMake sure you have trained and exported:")
@@ -270,7 +658,17 @@ def main():
 
     print(f"Loaded {len(test_labels)} test samples")
 
-    if args.sample is not None:
+    if args.benchmark_lut:
+        images = test_images[:args.num_samples]
+        result = benchmark_lut(engine, images)
+        print(f"\nfc1 on {result['samples']} samples (LUT {result['lut_bytes'] / 1024:.1f} KiB):")
+        print(f"  Tiled matmul: {1000 * result['tiled_seconds']:.2f} ms")
+        print(f"  LUT gather:   {1000 * result['lut_seconds']:.2f} ms ({result['speedup']:.1f}x)")
+        print(f"  Bit-exact:    {'yes' if result['bit_exact'] else 'NO'}")
+        if not result['bit_exact']:
+            return 1
+
+    elif args.sample is not None:
         #single sample inference
         idx = args.sample
         pred, logits = engine.predict(test_images[idx])
@@ -284,7 +682,18 @@ def main():
     elif args.eval:
         #full evaluation
         print(f"\nEvaluating...")
-        accuracy, correct, total = engine.evaluate(test_images, test_labels, args.num_samples)
+        from eval_log import EvalLog, parse_range
+
+        count = len(test_labels) if args.num_samples is None else min(args.num_samples, len(test_labels))
+        sample_range = parse_range(args.range, count) if args.range else None
+        log = None
+        if args.log is not None:
+            log = EvalLog(args.log, meta={'range': list(sample_range or (0, count))})
+        accuracy, correct, total = engine.evaluate(test_images, test_labels, args.num_samples,
+                                                   batch_size=args.batch_size,
+                                                   sample_range=sample_range, log=log, workers=args.workers)
+        if log is not None:
+            log.close()
 
         print("\n" + "=" * 60)
         print(f"ACCURACY: {100*accuracy:.2f}% ({correct}/{total})")
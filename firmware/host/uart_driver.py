@@ -101,6 +101,18 @@ class UARTDriver:
             print(f"Warning: Only received {len(data)}/{count} bytes (timeout?)")
         return data
 
+    #block until count bytes arrive or timeout expires, returns as soon as they are in
+    def receive_blocking(self, count: int, timeout: float) -> bytes:
+        if count <= 0:
+            return b""
+
+        previous = self.ser.timeout
+        self.ser.timeout = max(timeout, 0.0)
+        try:
+            return self.ser.read(count)
+        finally:
+            self.ser.timeout = previous
+
     #discard unread data in RX buffer
     def flush_input(self) -> None:
         self.ser.reset_input_buffer()
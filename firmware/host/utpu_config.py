@@ -0,0 +1,53 @@
+import os
+
+try:
+    import tomllib
+except ImportError:  # python < 3.11
+    tomllib = None
+
+
+REPO_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+DEFAULT_CONFIG_PATH = os.path.join(REPO_ROOT, 'configs', 'utpu.toml')
+GENERATED_PARAMS_PATH = os.path.join(REPO_ROOT, 'generated', 'generated_params.py')
+
+
+#read configs/utpu.toml (same file scripts/gen_params.py uses for the RTL)
+#falls back to generated/generated_params.py when tomllib is unavailable
+def load_config(path=None):
+    path = path or DEFAULT_CONFIG_PATH
+
+    if tomllib is not None and os.path.exists(path):
+        with open(path, 'rb') as f:
+            cfg = tomllib.load(f)
+        return {
+            'array_size': int(cfg['array']['size']),
+            'input_width': int(cfg['datatypes']['input_width']),
+            'accumulator_width': int(cfg['datatypes']['accumulator_width']),
+            'relu_alpha': int(cfg.get('quantization', {}).get('a', 2)),
+        }
+
+    if os.path.exists(GENERATED_PARAMS_PATH):
+        params = {}
+        with open(GENERATED_PARAMS_PATH) as f:
+            exec(f.read(), params)
+        return {
+            'array_size': params['ARRAY_SIZE'],
+            'input_width': params['INPUT_DATA_WIDTH'],
+            'accumulator_width': params['ACCUMULATOR_DATA_WIDTH'],
+            'relu_alpha': params.get('RELU_ALPHA', 2),
+        }
+
+    raise FileNotFoundError(f"No uTPU config at {path} and no {GENERATED_PARAMS_PATH}")
+
+
+CONFIG = load_config()
+ARRAY_SIZE = CONFIG['array_size']
+INPUT_DATA_WIDTH = CONFIG['input_width']
+ACCUMULATOR_DATA_WIDTH = CONFIG['accumulator_width']
+RELU_ALPHA = CONFIG['relu_alpha']
+
+
+if __name__ == "__main__":
+    print(f"Config: {DEFAULT_CONFIG_PATH}")
+    for key, value in CONFIG.items():
+        print(f"  {key} = {value}")
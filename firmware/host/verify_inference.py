@@ -2,24 +2,17 @@ import numpy as np
 import torch
 import sys
 import os
+import time
 
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), '../../software/model'))
 
 from tiled_inference import TiledInferenceEngine, get_default_paths
 
 
-#verify tiled inference matches pytorch model
-def verify():
-    print("=" * 60)
-    print("VERIFICATION: Tiled Inference vs PyTorch")
-    print("=" * 60)
-
-    weights_dir, model_path, data_dir = get_default_paths()
-
-    #check required files exist
+#check required files exist, returns False (after printing what is missing) if any is
+def check_files(weights_dir, model_path, data_dir):
     required_files = [
         (os.path.join(weights_dir, 'fc1_weight.npy'), "FC1 weights"),
-        (os.path.join(weights_dir, 'fc2_weight.npy'), "FC2 weights"),
         (os.path.join(weights_dir, 'scales.npy'), "Scale factors"),
         (model_path, "Trained model"),
         (os.path.join(data_dir, 'mnist_14x14_test.npy'), "Test images"),
@@ -41,13 +34,35 @@ def verify():
         print("  2. python software/model/train.py")
         print("  3. python software/model/export_weights.py")
         return False
+    return True
+
+
+#pytorch model for a checkpoint (MNISTNet, or MNISTConvNet for train.py --arch conv)
+def load_pytorch_model(model_path):
+    from qat_model import MNISTNet, MNISTConvNet
+    state_dict = torch.load(model_path, map_location='cpu')
+    if 'conv1.weight' in state_dict:
+        model = MNISTConvNet(channels=state_dict['conv1.weight'].shape[0])
+    else:
+        model = MNISTNet()
+    model.load_state_dict(state_dict)
+    model.eval()
+    return model
+
+
+#verify tiled inference matches pytorch model
+def verify():
+    print("=" * 60)
+    print("VERIFICATION: Tiled Inference vs PyTorch")
+    print("=" * 60)
+
+    weights_dir, model_path, data_dir = get_default_paths()
+    if not check_files(weights_dir, model_path, data_dir):
+        return False
 
     #load pytorch model
     print("\n2. Loading PyTorch model...")
-    from qat_model import MNISTNet
-    pytorch_model = MNISTNet()
-    pytorch_model.load_state_dict(torch.load(model_path, map_location='cpu'))
-    pytorch_model.eval()
+    pytorch_model = load_pytorch_model(model_path)
     print("   ✓ PyTorch model loaded")
 
     #load tiled inference engine
@@ -127,6 +142,195 @@ def verify():
         return False
 
 
+#logits of the pytorch model for every image, batch_size images per forward
+def pytorch_logits(model, images, batch_size=1000):
+    outputs = []
+    with torch.no_grad():
+        for start in range(0, len(images), batch_size):
+            batch = torch.from_numpy(np.ascontiguousarray(images[start:start + batch_size], dtype=np.float32))
+            outputs.append(model(batch).numpy())
+    return np.concatenate(outputs)
+
+
+#logits of the tiled engine for every image (weight-stationary batch schedule)
+def engine_logits(engine, images, batch_size=1000):
+    return np.concatenate([engine.forward_batch(images[start:start + batch_size])
+                           for start in range(0, len(images), batch_size)])
+
+
+#distribution of pytorch vs engine logit differences and argmax agreement, all vectorized
+#step is the output layer scale: both sides produce multiples of it (up to float
+#rounding), so differences are also reported as whole output steps
+def compare_logits(reference, logits, labels, step):
+    diff = np.abs(reference - logits)
+    per_sample = diff.max(axis=1)
+    steps = np.rint(per_sample / step).astype(np.int64)
+    ref_pred = np.argmax(reference, axis=1)
+    pred = np.argmax(logits, axis=1)
+    return {
+        'samples': len(labels),
+        'max_diff': float(diff.max()),
+        'mean_diff': float(diff.mean()),
+        'percentiles': {p: float(np.percentile(per_sample, p)) for p in (50, 90, 99, 99.9)},
+        'step': float(step),
+        'step_counts': np.bincount(steps, minlength=3),
+        'agreement': float(np.mean(ref_pred == pred)),
+        'disagree': np.flatnonzero(ref_pred != pred),
+        'reference_correct': int(np.sum(ref_pred == labels)),
+        'correct': int(np.sum(pred == labels)),
+    }
+
+
+#verify the whole test set in large batches (pytorch and the engine)
+def verify_batched(batch_size=1000, num_samples=None):
+    print("=" * 60)
+    print("VERIFICATION (batched): Tiled Inference vs PyTorch")
+    print("=" * 60)
+
+    weights_dir, model_path, data_dir = get_default_paths()
+    if not check_files(weights_dir, model_path, data_dir):
+        return False
+
+    print("\n2. Loading models and test data...")
+    pytorch_model = load_pytorch_model(model_path)
+    engine = TiledInferenceEngine(weights_dir, model_path, verbose=False)
+    test_images = np.load(os.path.join(data_dir, 'mnist_14x14_test.npy'))[:num_samples]
+    test_labels = np.load(os.path.join(data_dir, 'test_labels.npy'))[:num_samples]
+    print(f"   ✓ {len(test_labels)} test samples, batch size {batch_size}")
+
+    print("\n3. Running both models...")
+    start = time.perf_counter()
+    reference = pytorch_logits(pytorch_model, test_images, batch_size)
+    pt_time = time.perf_counter() - start
+    start = time.perf_counter()
+    logits = engine_logits(engine, test_images, batch_size)
+    engine_time = time.perf_counter() - start
+    print(f"   PyTorch: {pt_time:.2f} s, tiled engine: {engine_time:.2f} s")
+
+    result = compare_logits(reference, logits, test_labels, engine.layers[-1]['scale'])
+    total = result['samples']
+
+    print("\n4. Logit differences (max |diff| per sample)")
+    print(f"   Max: {result['max_diff']:.6f}, mean over all logits: {result['mean_diff']:.6f}")
+    print("   Percentiles: " + ", ".join(f"p{p:g} {v:.6f}" for p, v in result['percentiles'].items()))
+    counts = result['step_counts']
+    print(f"   In output steps of {result['step']:.6f}: "
+          + ", ".join(f"{k}: {int(c)}" for k, c in enumerate(counts[:3]))
+          + (f", 3+: {int(counts[3:].sum())}" if len(counts) > 3 else ""))
+    print(f"   Argmax agreement: {100 * result['agreement']:.2f}% "
+          f"({total - len(result['disagree'])}/{total})")
+    if len(result['disagree']):
+        print(f"   First differing samples: {result['disagree'][:10].tolist()}")
+
+    pt_acc = 100.0 * result['reference_correct'] / total
+    tiled_acc = 100.0 * result['correct'] / total
+    print("\n" + "=" * 60)
+    print("RESULTS")
+    print("=" * 60)
+    print(f"PyTorch accuracy:         {pt_acc:.2f}% ({result['reference_correct']}/{total})")
+    print(f"Tiled inference accuracy: {tiled_acc:.2f}% ({result['correct']}/{total})")
+    print(f"Difference:               {abs(pt_acc - tiled_acc):.4f}%")
+    print("=" * 60)
+
+    if abs(pt_acc - tiled_acc) < 1.0:
+        print("\n✓ VERIFICATION PASSED")
+        print("  Ready for FPGA deployment.")
+        return True
+    print("\n✗ VERIFICATION FAILED")
+    return False
+
+
+#interrupt a logged evaluation halfway, resume it from the log and check that
+#only the remaining samples run and the result matches an uninterrupted run
+#(the same log meta as fpga_inference.py --eval --log, in simulation mode)
+def verify_resume(num_samples=200, batch_size=None):
+    import tempfile
+    from fpga_inference import FPGAInference
+    from eval_log import EvalLog
+
+    print("=" * 60)
+    print("VERIFICATION: Interrupted --eval --log resumes")
+    print("=" * 60)
+
+    weights_dir, model_path, data_dir = get_default_paths()
+    if not check_files(weights_dir, model_path, data_dir):
+        return False
+
+    fpga = FPGAInference()
+    images = np.load(os.path.join(data_dir, 'mnist_14x14_test.npy'))[:num_samples]
+    labels = np.load(os.path.join(data_dir, 'test_labels.npy'))[:num_samples]
+    total = len(labels)
+    meta = fpga.log_meta((0, total), batch_size)
+    reference = fpga.evaluate(images, labels, batch_size=batch_size)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'eval.jsonl')
+
+        print(f"\n2. Evaluating {total} samples, interrupted after {total // 2}...")
+        log = EvalLog(path, meta=meta)
+        add = log.add
+
+        def interrupting_add(index, *rest, **kwargs):
+            if len(log.records) >= total // 2:
+                raise KeyboardInterrupt
+            add(index, *rest, **kwargs)
+
+        log.add = interrupting_add
+        try:
+            fpga.evaluate(images, labels, batch_size=batch_size, log=log)
+        except KeyboardInterrupt:
+            pass
+        log.close()
+        #a torn last line, as if the process died mid-write
+        with open(path, 'a') as f:
+            f.write('{"index": ')
+
+        print("\n3. Resuming from the log...")
+        log = EvalLog(path, meta=meta)
+        logged = len(log.records)
+        result = fpga.evaluate(images, labels, batch_size=batch_size, log=log)
+        rerun = len(log.records) - logged
+        log.close()
+
+        try:
+            EvalLog(path, meta=dict(meta, model='0' * 64)).close()
+            rejected = False
+        except ValueError:
+            rejected = True
+
+    print("\n" + "=" * 60)
+    print("RESULTS")
+    print("=" * 60)
+    print(f"Uninterrupted: {100 * reference[0]:.2f}% ({reference[1]}/{reference[2]})")
+    print(f"Resumed:       {100 * result[0]:.2f}% ({result[1]}/{result[2]}), "
+          f"{logged} samples from the log, {rerun} run")
+    print(f"Log of another model rejected: {rejected}")
+    print("=" * 60)
+
+    if tuple(result) == tuple(reference) and logged == total // 2 and rerun == total - logged and rejected:
+        print("\n✓ VERIFICATION PASSED")
+        return True
+    print("\n✗ VERIFICATION FAILED")
+    return False
+
+
 if __name__ == "__main__":
-    success = verify()
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Verify tiled inference against PyTorch')
+    parser.add_argument('--batched', action='store_true',
+                        help='Run both models in batches over the full test set (seconds instead of minutes)')
+    parser.add_argument('--batch-size', type=int, default=1000)
+    parser.add_argument('--num-samples', type=int, default=None,
+                        help='Only the first N samples (--batched, --resume)')
+    parser.add_argument('--resume', action='store_true',
+                        help='Interrupt a logged evaluation and check that it resumes from its log')
+    args = parser.parse_args()
+
+    if args.resume:
+        success = verify_resume(args.num_samples or 200)
+    elif args.batched:
+        success = verify_batched(args.batch_size, args.num_samples)
+    else:
+        success = verify()
     sys.exit(0 if success else 1)
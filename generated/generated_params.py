@@ -0,0 +1,5 @@
+# generated by scripts/gen_params.py from configs/utpu.toml, do not edit
+ARRAY_SIZE = 2
+INPUT_DATA_WIDTH = 4
+ACCUMULATOR_DATA_WIDTH = 16
+RELU_ALPHA = 2
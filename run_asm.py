@@ -9,6 +9,8 @@ sys.path.append(os.path.join(os.path.dirname(__file__), 'firmware/host'))
 try:
     from uart_driver import UARTDriver
     from program_loader import ProgramLoader
+    from isa_model import decodeProgram
+    from isa_encoder import OPCODE_FETCH
 except ImportError:
     print("Error: Could not import uTPU drivers. Make sure you are in the uTPU root directory.")
     sys.exit(1)
@@ -37,15 +39,19 @@ def run_binary(bin_path: str, port: str):
         print(f"Sending {len(program_data)} bytes to FPGA...")
         loader.sendProgram(program_data)
 
-        # 4. Wait for potential output (if the program produces any, e.g. FETCH)
-        # For the demo, we expect 2 bytes (1 word) of result.
-        # We'll wait a bit.
-        print("Program sent. Waiting for output (if any)...")
-        time.sleep(1.0) 
-        
+        # 4. Wait for output: every FETCH returns one byte, so we know exactly
+        # how many to expect and stop as soon as they are in
+        expected = sum(1 for instr in decodeProgram(program_data) if instr.opcode == OPCODE_FETCH)
+        print(f"Program sent. Waiting for {expected} byte(s) of output...")
+        received = loader.receiveResults('program', expected, time.perf_counter())
+
+        for byte in received:
+            print(f"Received byte: 0x{byte:02X}")
+
+        # anything beyond the expected FETCH bytes (e.g. debug ACKs)
         while uart.bytes_waiting() > 0:
             byte = uart.receive_byte()
-            print(f"Received byte: 0x{byte:02X}")
+            print(f"Received extra byte: 0x{byte:02X}")
 
         uart.close()
         print("Execution complete.")
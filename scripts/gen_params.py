@@ -6,3 +6,11 @@ with open("../generated/generated_params.sv", "w") as f:
     f.write(f"parameter int ARRAY_SIZE = {cfg['array']['size']};\n")
     f.write(f"parameter int INPUT_DATA_WIDTH = {cfg['datatypes']['input_width']};\n")
     f.write(f"parameter int ACCUMULATOR_DATA_WIDTH = {cfg['datatypes']['accumulator_width']};\n")
+
+# same constants for the host stack (firmware/host/utpu_config.py)
+with open("../generated/generated_params.py", "w") as f:
+    f.write("# generated by scripts/gen_params.py from configs/utpu.toml, do not edit\n")
+    f.write(f"ARRAY_SIZE = {cfg['array']['size']}\n")
+    f.write(f"INPUT_DATA_WIDTH = {cfg['datatypes']['input_width']}\n")
+    f.write(f"ACCUMULATOR_DATA_WIDTH = {cfg['datatypes']['accumulator_width']}\n")
+    f.write(f"RELU_ALPHA = {cfg['quantization']['a']}\n")
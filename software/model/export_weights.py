@@ -3,16 +3,22 @@ import numpy as np
 import os
 import sys
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-from model.qat_model import MNISTNet
+from model.qat_model import MNISTNet, MNISTConvNet, QATLinear, QATConv2d
+
+#activation applied after each exported layer (the host requantizes hidden
+#layers to int4, the output layer stays as float logits)
+ACTIVATIONS = ('leaky_relu', 'none')
 
 def extract_int4_weights(model):
     weights = dict()
-    for name, layer in [("fc1", model.fc1), ("fc2", model.fc2)]:
+    layers = [(name, m) for name, m in model.named_children() if isinstance(m, QATLinear)]
+    weights['layers'] = [name for name, _ in layers]
+    for index, (name, layer) in enumerate(layers):
 
         #learned scale factor
         scale = layer.scale.item() #float
-        #weight_matrix
-        w = layer.weight.data.clone()
+        #weight_matrix (pruned tiles zeroed)
+        w = layer.masked_weight().data.clone()
 
         #quantize
         w_scaled = w/scale
@@ -28,14 +34,69 @@ def extract_int4_weights(model):
 
         weights[f'{name}_weight'] = w_int4
         weights[f'{name}_scale'] = scale
+        weights[f'{name}_multiplier'], weights[f'{name}_shift'] = quantize_multiplier(scale, w_int4.shape[1])
+        #over the matrix the host tiles (conv kernel rows padded)
+        tiled = layer.tile_layout(w_clamped).numpy().astype(np.int8)
+        weights[f'{name}_tile_mask'] = nonzero_tile_mask(tiled, layer.tile_size)
+        weights['tile_size'] = layer.tile_size
+        #MNISTNet applies leaky relu after every layer except the output
+        weights[f'{name}_activation'] = 'none' if index == len(layers) - 1 else 'leaky_relu'
+        #conv geometry, the weight is already the (out, in*k*k) im2col matrix
+        if isinstance(layer, QATConv2d):
+            weights[f'{name}_conv'] = {
+                'in_channels': layer.in_channels,
+                'kernel_size': layer.kernel_size,
+                'stride': layer.stride,
+                'padding': layer.padding,
+                'input_size': layer.input_size,
+            }
 
         print(f"\n{name} layer:")
         print(f"  Weight shape: {w_int4.shape}")
         print(f"  Weight range: [{w_int4.min()}, {w_int4.max()}]")
         print(f"  Scale factor: {scale:.4f}")
+        print(f"  Fixed point:  {weights[f'{name}_multiplier']} / 2^{weights[f'{name}_shift']}")
+        print(f"  Activation:   {weights[f'{name}_activation']}")
+        mask = weights[f'{name}_tile_mask']
+        print(f"  Zero tiles:   {mask.size - int(mask.sum())}/{mask.size} ({layer.tile_size}x{layer.tile_size})")
     
     return weights
 
+#fixed-point form of a layer scale for integer-only requantization on the host
+#scale ~= multiplier / 2**shift. the multiplier is sized so that
+#|acc * multiplier| + 2**(shift-1) stays inside int32 for any int4 x int4
+#accumulator over in_features inputs, so the host never needs int64
+def quantize_multiplier(scale, in_features):
+    if not scale > 0:
+        raise ValueError(f"Scale must be positive, got {scale}")
+
+    max_acc = in_features * 8 * 8
+    mult_bits = 30 - int(max_acc).bit_length()
+    if mult_bits < 1:
+        raise ValueError(f"{in_features} inputs leave no room for a multiplier in int32")
+
+    #largest shift whose multiplier still fits in mult_bits
+    shift = 0
+    while shift < 30 and round(scale * 2 ** (shift + 1)) < 2 ** mult_bits:
+        shift += 1
+    multiplier = int(round(scale * 2 ** shift))
+    if shift < 1 or multiplier < 1:
+        raise ValueError(f"Scale {scale} cannot be represented with a {mult_bits}-bit multiplier")
+
+    return multiplier, shift
+
+
+#True for every tile_size x tile_size weight tile with a nonzero entry
+#(all-zero tiles - pruned or not - can be skipped by the host)
+def nonzero_tile_mask(w_int4, tile_size):
+    n = tile_size
+    rows = -(-w_int4.shape[0] // n)
+    cols = -(-w_int4.shape[1] // n)
+    padded = np.zeros((rows * n, cols * n), dtype=np.int8)
+    padded[:w_int4.shape[0], :w_int4.shape[1]] = w_int4
+    return padded.reshape(rows, n, cols, n).any(axis=(1, 3))
+
+
 def int4_to_bytes(int4_array):
     
     #flatten array
@@ -61,7 +122,7 @@ def int4_to_bytes(int4_array):
 def weights_to_binary(weights, output_dir):
     os.makedirs(output_dir, exist_ok=True)
     os.makedirs(output_dir, exist_ok=True)
-    for name in ['fc1_weight', 'fc2_weight']:
+    for name in [f'{layer}_weight' for layer in weights['layers']]:
         data = weights[name]
         packed = int4_to_bytes(data)
         filepath = f'{output_dir}/{name}.bin'
@@ -70,12 +131,16 @@ def weights_to_binary(weights, output_dir):
         
         print(f"Saved {filepath}: {len(packed)} bytes (from {data.size} values)")
     
-    np.save(f'{output_dir}/fc1_weight.npy', weights['fc1_weight'])
-    np.save(f'{output_dir}/fc2_weight.npy', weights['fc2_weight'])
     scales = {
-        'fc1_scale': weights['fc1_scale'],
-        'fc2_scale': weights['fc2_scale']
+        'layers': list(weights['layers']),
+        'tile_size': weights['tile_size'],
     }
+    for layer in weights['layers']:
+        np.save(f'{output_dir}/{layer}_weight.npy', weights[f'{layer}_weight'])
+        np.save(f'{output_dir}/{layer}_tile_mask.npy', weights[f'{layer}_tile_mask'])
+        for key in ('scale', 'multiplier', 'shift', 'activation', 'conv'):
+            if f'{layer}_{key}' in weights:
+                scales[f'{layer}_{key}'] = weights[f'{layer}_{key}']
     np.save(f'{output_dir}/scales.npy', scales)
 
 
@@ -91,8 +156,12 @@ def main():
         return
     
     print(f"Loading model from {MODEL_PATH}...")
-    model = MNISTNet()
-    model.load_state_dict(torch.load(MODEL_PATH))
+    state_dict = torch.load(MODEL_PATH)
+    if 'conv1.weight' in state_dict:
+        model = MNISTConvNet(channels=state_dict['conv1.weight'].shape[0])
+    else:
+        model = MNISTNet()
+    model.load_state_dict(state_dict)
     model.eval()
 
     #quantize
@@ -105,8 +174,8 @@ def main():
     print("\n" + "="*50)
     print("Export complete!")
     print("Binary files ready for uTPU:")
-    print(f"  {OUTPUT_DIR}/fc1_weight.bin")
-    print(f"  {OUTPUT_DIR}/fc2_weight.bin")
+    for layer in weights['layers']:
+        print(f"  {OUTPUT_DIR}/{layer}_weight.bin")
     print("="*50)
 
 
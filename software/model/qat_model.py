@@ -18,39 +18,170 @@ def quantize_int4(x):
     #quantize tensor to int4
     return Int4Quantize.apply(x)
 
+#int4 codes of [0, 1] input images: quantize_int4(x*15-8)
+#int8 tensors hold codes that were already quantized (quantize_inputs) and are
+#only converted back to float, which gives the same values bit for bit
+def quantize_input(x):
+    if x.dtype == torch.int8:
+        return x.float()
+    return quantize_int4(x*15-8)
+
+#quantize a whole dataset of images once, stored as int8 (a quarter of the memory)
+@torch.no_grad()
+def quantize_inputs(images):
+    return quantize_input(torch.as_tensor(images, dtype=torch.float32)).to(torch.int8)
+
 
 class QATLinear(nn.Module):
     #layer w/ quantized weights
+    #tile_mask marks which tile_size x tile_size weight tiles are kept (structured
+    #sparsity: a pruned tile is never dispatched to the array)
     
-    def __init__(self, in_features, out_features):
+    def __init__(self, in_features, out_features, tile_size=2):
         super().__init__()
         self.weight = nn.Parameter(torch.rand(out_features, in_features)*2)
         #self.bias= nn.Parameter(torch.zeros(out_features)) # HW does not support bias
         self.scale = nn.Parameter(torch.tensor(1.0))
+        self.tile_size = tile_size
+        grid = (-(-out_features // tile_size), -(-in_features // tile_size))
+        self.register_buffer('tile_mask', torch.ones(grid))
+
+    #checkpoints from before tile pruning have no mask: keep every tile
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        if prefix + 'tile_mask' not in state_dict:
+            state_dict[prefix + 'tile_mask'] = torch.ones_like(self.tile_mask)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    #tile mask expanded to the weight shape
+    def weight_mask(self):
+        n = self.tile_size
+        mask = self.tile_mask.repeat_interleave(n, 0).repeat_interleave(n, 1)
+        return mask[:self.weight.shape[0], :self.weight.shape[1]]
+
+    #weights with pruned tiles zeroed
+    def masked_weight(self):
+        return self.weight * self.weight_mask()
+
+    #weight matrix (or mask) in the layout the host cuts into array tiles
+    def tile_layout(self, w):
+        return w
+
+    #L2 norm of every weight tile, shape of tile_mask
+    def tile_norms(self):
+        n = self.tile_size
+        rows, cols = self.tile_mask.shape
+        w = self.tile_layout(self.masked_weight())
+        w = F.pad(w, (0, cols * n - w.shape[1], 0, rows * n - w.shape[0]))
+        #clamp keeps the gradient finite for all-zero (pruned) tiles
+        return w.reshape(rows, n, cols, n).pow(2).sum(dim=(1, 3)).clamp_min(1e-12).sqrt()
+
+    #group lasso penalty: sum of tile norms (pushes whole tiles to zero)
+    def group_lasso(self):
+        return self.tile_norms().sum()
+
+    #fraction of tiles pruned
+    def tile_sparsity(self):
+        return 1.0 - self.tile_mask.mean().item()
+
+    #magnitude pruning: zero the smallest tiles until `sparsity` of them are gone
+    #pruned tiles stay pruned
+    @torch.no_grad()
+    def prune_tiles(self, sparsity):
+        total = self.tile_mask.numel()
+        target = min(int(round(sparsity * total)), total)
+        pruned = total - int(self.tile_mask.sum().item())
+        if target <= pruned:
+            return
+
+        norms = self.tile_norms().flatten()
+        norms[self.tile_mask.flatten() == 0] = -1.0
+        order = torch.argsort(norms)
+        mask = self.tile_mask.flatten().clone()
+        mask[order[:target]] = 0.0
+        self.tile_mask.copy_(mask.view_as(self.tile_mask))
 
     def forward(self, x):
-        w_quant = quantize_int4(self.weight/self.scale)*self.scale
+        w_quant = quantize_int4(self.masked_weight()/self.scale)*self.scale
         return F.linear(x, w_quant, bias=None)
 
+class QATConv2d(QATLinear):
+    #conv layer w/ quantized weights, stored as the (out, in*k*k) im2col matrix
+    #(columns in channel, kernel row, kernel column order)
+    #the host pads every kernel row with zero columns to a multiple of the tile
+    #size (conv_layer.im2col_weights, 3 -> 4 for 3x3 on a 2x2 array), so
+    #tile_mask and the tile norms are over that padded matrix: a pruned tile is
+    #one the host would dispatch
+    #input_size is the (height, width) of the input feature map
+
+    def __init__(self, in_channels, out_channels, kernel_size, stride=1, padding=0,
+                 input_size=(14, 14), tile_size=2):
+        super().__init__(in_channels * kernel_size * kernel_size, out_channels, tile_size)
+        self.in_channels = in_channels
+        self.out_channels = out_channels
+        self.kernel_size = kernel_size
+        self.stride = stride
+        self.padding = padding
+        self.input_size = tuple(input_size)
+        self.row_width = -(-kernel_size // tile_size) * tile_size
+        grid = (-(-out_channels // tile_size), in_channels * kernel_size * self.row_width // tile_size)
+        self.tile_mask = torch.ones(grid)
+
+    #checkpoints from before the padded layout have a mask over the unpadded
+    #matrix: zero the weights it pruned and keep every padded tile with a kept weight
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        mask = state_dict.get(prefix + 'tile_mask')
+        if mask is not None and mask.shape != self.tile_mask.shape:
+            n = self.tile_size
+            weight = state_dict[prefix + 'weight']
+            kept = mask.repeat_interleave(n, 0).repeat_interleave(n, 1)[:weight.shape[0], :weight.shape[1]]
+            state_dict[prefix + 'weight'] = weight * kept
+            rows, cols = self.tile_mask.shape
+            kept = F.pad(self.tile_layout(kept), (0, 0, 0, rows * n - weight.shape[0]))
+            state_dict[prefix + 'tile_mask'] = kept.reshape(rows, n, cols, n).amax(dim=(1, 3))
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    #(out, in*k*k) -> (out, in*k*row_width), kernel rows padded with zeros
+    def tile_layout(self, w):
+        c, k = self.in_channels, self.kernel_size
+        w = w.reshape(w.shape[0], c, k, k)
+        return F.pad(w, (0, self.row_width - k)).reshape(w.shape[0], -1)
+
+    #tile mask of the padded layout, mapped back to the (out, in*k*k) weight
+    def weight_mask(self):
+        n = self.tile_size
+        c, k = self.in_channels, self.kernel_size
+        mask = self.tile_mask.repeat_interleave(n, 0).repeat_interleave(n, 1)[:self.out_channels]
+        return mask.reshape(self.out_channels, c, k, self.row_width)[..., :k].reshape(self.out_channels, -1)
+
+    #(height, width) of the output feature map
+    def output_size(self):
+        k, s, p = self.kernel_size, self.stride, self.padding
+        return tuple((size + 2 * p - k) // s + 1 for size in self.input_size)
+
+    def forward(self, x):
+        w_quant = quantize_int4(self.masked_weight()/self.scale)*self.scale
+        w_quant = w_quant.view(self.out_channels, self.in_channels, self.kernel_size, self.kernel_size)
+        return F.conv2d(x, w_quant, bias=None, stride=self.stride, padding=self.padding)
+
 class MNISTNet(nn.Module):
     #neural network
 
-    def __init__(self):
+    def __init__(self, tile_size=2):
         super().__init__()
 
         #input: 14x14, output: 9 hidden neurons (to fit in 1KB)
-        self.fc1 = QATLinear(196, 9)
+        self.fc1 = QATLinear(196, 9, tile_size)
 
         #input: 9 (from prev layer), output: 10 (one score per digit 0-9)
-        self.fc2 = QATLinear(9, 10)
+        self.fc2 = QATLinear(9, 10, tile_size)
 
     def forward(self, x):
         
         #shape before: (64, 14, 14), shape after: (64, 196)
         x = x.view(-1, 196)
 
-        #formula to quantize to int4
-        x = quantize_int4(x*15-8)
+        #formula to quantize to int4 (already done for int8 inputs)
+        x = quantize_input(x)
 
         #first layer
         x = self.fc1(x)
@@ -66,12 +197,39 @@ class MNISTNet(nn.Module):
 
         return x
     
+class MNISTConvNet(nn.Module):
+    #small conv network: 3x3 stride-2 conv (14x14 -> 7x7) + one fc layer
+    #the conv runs on the array as im2col tiles streamed from the image
+
+    def __init__(self, channels=4, tile_size=2):
+        super().__init__()
+
+        #input: 1x14x14, output: channels x 7x7
+        self.conv1 = QATConv2d(1, channels, 3, stride=2, padding=1, tile_size=tile_size)
+        height, width = self.conv1.output_size()
+
+        #input: channels*7*7 (flattened channel-major), output: 10
+        self.fc1 = QATLinear(channels * height * width, 10, tile_size)
+
+    def forward(self, x):
+        x = x.view(-1, 1, 14, 14)
+        x = quantize_input(x)
+
+        x = self.conv1(x)
+        x = F.leaky_relu(x, negative_slope=0.25)
+        x = quantize_int4(x)
+
+        x = x.flatten(1)
+        return self.fc1(x)
+
 if __name__ == "__main__":
     model = MNISTNet()
     print("Model Architecture")
     print(model)
     total_params = sum(p.numel() for p in model.parameters())
     print(f"\nTotal parameters: {total_params}")
+    model.fc1.prune_tiles(0.5)
+    print(f"fc1 tile sparsity after pruning: {model.fc1.tile_sparsity():.2f}")
     test_input = torch.randn(2, 14, 14)
     test_output = model(test_input)
     print(f"\nTest input shape: {test_input.shape}")
@@ -5,11 +5,14 @@ from torch.utils.data import DataLoader, TensorDataset
 import numpy as np
 import os 
 import sys
-from qat_model import MNISTNet
-
-def load_data(data_dir):
-    print(f"Loading data from {data_dir}...")
+import copy
+import time
+from qat_model import MNISTNet, MNISTConvNet, QATLinear, quantize_inputs
 
+#train and test TensorDatasets from the preprocessed .npy files
+#prequantize stores the images as int4 codes in int8 (the models skip their
+#input quantization for int8 batches, same results as float images)
+def load_datasets(data_dir, prequantize=False):
     #reads .npy files into numpy arrays
     train_images = np.load(f'{data_dir}/mnist_14x14_train.npy')  # (60000, 14, 14)
     train_labels = np.load(f'{data_dir}/train_labels.npy')       # (60000,)
@@ -20,12 +23,20 @@ def load_data(data_dir):
     train_images_tensor = torch.tensor(train_images, dtype=torch.float32)
     train_labels_tensor = torch.tensor(train_labels, dtype=torch.long)
     test_images_tensor = torch.tensor(test_images, dtype=torch.float32)
+    if prequantize:
+        train_images_tensor = quantize_inputs(train_images_tensor)
+        test_images_tensor = quantize_inputs(test_images_tensor)
     test_labels_tensor = torch.tensor(test_labels, dtype=torch.long)
 
 
     #dataset[i] = (image_i, label_i)
     train_dataset = TensorDataset(train_images_tensor, train_labels_tensor)
     test_dataset = TensorDataset(test_images_tensor, test_labels_tensor)
+    return train_dataset, test_dataset
+
+def load_data(data_dir, prequantize=False):
+    print(f"Loading data from {data_dir}...")
+    train_dataset, test_dataset = load_datasets(data_dir, prequantize)
 
     train_loader = DataLoader(train_dataset, batch_size=64, shuffle=True)
     test_loader = DataLoader(test_dataset, batch_size=1000, shuffle=False)
@@ -36,7 +47,8 @@ def load_data(data_dir):
     return train_loader, test_loader
 
 #train model for one epoch
-def train_epoch(model, train_loader, criterion, optimizer, epoch):
+#penalty(model) is added to the loss when given (e.g. tile group lasso)
+def train_epoch(model, train_loader, criterion, optimizer, epoch, penalty=None):
     model.train()
     total_loss = 0.0
     correct = 0
@@ -52,6 +64,8 @@ def train_epoch(model, train_loader, criterion, optimizer, epoch):
 
         #compute loss
         loss = criterion(outputs, labels)
+        if penalty is not None:
+            loss = loss + penalty(model)
 
         #backward pass
         loss.backward()
@@ -90,22 +104,136 @@ def evaluate(model, test_loader):
     accuracy = 100.0 * correct / total
     return accuracy
 
+def create_model(arch='mlp', channels=4, tile_size=2):
+    if arch == 'conv':
+        return MNISTConvNet(channels=channels, tile_size=tile_size)
+    return MNISTNet(tile_size=tile_size)
+
+def qat_layers(model):
+    return [(name, m) for name, m in model.named_children() if isinstance(m, QATLinear)]
+
+#parse "0.5" (every layer) or "fc1=0.5,fc2=0.2" into {layer: sparsity}
+def parse_tile_sparsity(spec, model):
+    names = [name for name, _ in qat_layers(model)]
+    if '=' not in spec:
+        return {name: float(spec) for name in names}
+    targets = {name: 0.0 for name in names}
+    for item in spec.split(','):
+        name, value = item.split('=')
+        if name.strip() not in targets:
+            raise ValueError(f"Unknown layer '{name}', expected one of {names}")
+        targets[name.strip()] = float(value)
+    return targets
+
+#total and pruned tile counts over all layers
+def tile_counts(model):
+    total = sum(layer.tile_mask.numel() for _, layer in qat_layers(model))
+    kept = sum(int(layer.tile_mask.sum().item()) for _, layer in qat_layers(model))
+    return total, total - kept
+
+#accuracy vs tiles eliminated: magnitude-prune a copy of the model to each
+#level (no retraining) and evaluate it
+#the copy starts from a full tile_mask: pruned tiles keep their (frozen) weights,
+#so levels below the trained sparsity bring back the largest pruned tiles
+def tile_sparsity_curve(model, test_loader, levels):
+    curve = []
+    for level in levels:
+        pruned = copy.deepcopy(model)
+        for _, layer in qat_layers(pruned):
+            layer.tile_mask.fill_(1.0)
+            layer.prune_tiles(level)
+        total, eliminated = tile_counts(pruned)
+        curve.append((level, eliminated, total, evaluate(pruned, test_loader)))
+    return curve
+
+#per-epoch time of float images vs prequantized int8 inputs
+#both runs start from the same weights and shuffle order, so the trained
+#parameters must come out identical
+def benchmark_inputs(data_dir, args, epochs=1):
+    datasets = {'float': load_datasets(data_dir), 'int8': load_datasets(data_dir, prequantize=True)}
+    results = {}
+    for name, (train_dataset, test_dataset) in datasets.items():
+        print(f"\n--- {name} inputs ---")
+        torch.manual_seed(0)
+        model = create_model(args.arch, args.channels, args.tile_size)
+        loader = DataLoader(train_dataset, batch_size=64, shuffle=True, generator=torch.Generator().manual_seed(0))
+        optimizer = optim.Adam(model.parameters(), lr=args.lr)
+        seconds = []
+        for epoch in range(1, epochs + 1):
+            start = time.perf_counter()
+            train_epoch(model, loader, nn.CrossEntropyLoss(), optimizer, epoch)
+            seconds.append(time.perf_counter() - start)
+        accuracy = evaluate(model, DataLoader(test_dataset, batch_size=1000, shuffle=False))
+        results[name] = (model.state_dict(), seconds, accuracy)
+
+    reference = results['float'][0]
+    identical = all(torch.equal(reference[key], value) for key, value in results['int8'][0].items())
+    base = np.mean(results['float'][1])
+    print("\n" + "="*50)
+    print(f"  {'inputs':<6} {'s/epoch':>8} {'speedup':>8} {'test acc':>9} {'memory':>9}")
+    for name, (_, seconds, accuracy) in results.items():
+        images = datasets[name][0].tensors[0]
+        print(f"  {name:<6} {np.mean(seconds):>8.2f} {base / np.mean(seconds):>7.2f}x {accuracy:>8.2f}% "
+              f"{images.numel() * images.element_size() / 2**20:>7.1f}MB")
+    print(f"Trained parameters {'identical' if identical else 'DIFFER'}")
+    print("="*50)
+    return identical
+
+
 def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='uTPU QAT training')
+    parser.add_argument('--epochs', type=int, default=50)
+    parser.add_argument('--lr', type=float, default=0.005)
+    parser.add_argument('--prune', choices=['none', 'magnitude', 'group_lasso'], default='none',
+                        help='Structured sparsity at array-tile granularity')
+    parser.add_argument('--tile-sparsity', type=str, default='0.5',
+                        help='Target fraction of tiles to prune: one value or fc1=0.5,fc2=0.2')
+    parser.add_argument('--prune-epochs', type=int, default=10,
+                        help='Epochs over which sparsity ramps up to the target')
+    parser.add_argument('--lasso-weight', type=float, default=1e-3,
+                        help='Group lasso strength (group_lasso only)')
+    parser.add_argument('--tile-size', type=int, default=2)
+    parser.add_argument('--arch', choices=['mlp', 'conv'], default='mlp',
+                        help='mlp: 196-9-10 network, conv: 3x3 stride-2 conv + fc')
+    parser.add_argument('--channels', type=int, default=4, help='Conv channels (conv only)')
+    parser.add_argument('--float-inputs', action='store_true',
+                        help='Keep float images and quantize every batch (default: int8 codes quantized once)')
+    parser.add_argument('--benchmark-inputs', action='store_true',
+                        help='Time --epochs epochs with float vs prequantized inputs and exit')
+    args = parser.parse_args()
+    #best models are only taken at the full target sparsity, reached after --prune-epochs
+    if args.prune != 'none' and not args.benchmark_inputs and args.epochs < args.prune_epochs:
+        parser.error(f"--epochs {args.epochs} ends before the sparsity target is reached "
+                     f"(--prune-epochs {args.prune_epochs})")
+
     script_dir = os.path.dirname(os.path.abspath(__file__))
     DATA_DIR = os.path.join(script_dir, '..', 'data')
     WEIGHTS_DIR = os.path.join(script_dir, 'weights')
-    NUM_EPOCHS = 50
-    LEARNING_RATE = 0.005
+    NUM_EPOCHS = args.epochs
+    LEARNING_RATE = args.lr
     os.makedirs(WEIGHTS_DIR, exist_ok=True)
 
+    if args.benchmark_inputs:
+        sys.exit(0 if benchmark_inputs(DATA_DIR, args, NUM_EPOCHS) else 1)
+
     #load data
-    train_loader, test_loader = load_data(DATA_DIR)
+    train_loader, test_loader = load_data(DATA_DIR, prequantize=not args.float_inputs)
 
     #create model
     print("\nCreating model...")
-    model = MNISTNet()
+    model = create_model(args.arch, args.channels, args.tile_size)
     print(model)
 
+    pruning = args.prune != 'none'
+    targets = parse_tile_sparsity(args.tile_sparsity, model) if pruning else {}
+    penalty = None
+    if args.prune == 'group_lasso':
+        penalty = lambda m: args.lasso_weight * sum(layer.group_lasso() for _, layer in qat_layers(m))
+    if pruning:
+        print(f"Tile pruning ({args.prune}): " + ", ".join(f"{k} {v:.0%}" for k, v in targets.items()))
+
     #loss function
     criterion = nn.CrossEntropyLoss()
 
@@ -115,10 +243,26 @@ def main():
     print("\nStarting training...")
     best_accuracy = 0.0
 
+    history = []
+
     for epoch in range(1, NUM_EPOCHS + 1):
-        train_loss, train_accuracy = train_epoch(model, train_loader, criterion, optimizer, epoch)
+        train_loss, train_accuracy = train_epoch(model, train_loader, criterion, optimizer, epoch, penalty)
+
+        #ramp sparsity linearly, pruning the smallest tiles after each epoch
+        if pruning:
+            ramp = min(1.0, epoch / max(args.prune_epochs, 1))
+            for name, layer in qat_layers(model):
+                layer.prune_tiles(targets[name] * ramp)
+
         test_accuracy = evaluate(model, test_loader)
-        print(f'Epoch {epoch}: Test Accuracy = {test_accuracy:.2f}%\n')
+        total_tiles, eliminated = tile_counts(model)
+        history.append((epoch, eliminated, test_accuracy))
+        print(f'Epoch {epoch}: Test Accuracy = {test_accuracy:.2f}%'
+              + (f', tiles eliminated {eliminated}/{total_tiles}' if pruning else '') + '\n')
+
+        #only models at the full target sparsity count as best
+        if pruning and epoch < args.prune_epochs:
+            continue
 
         if test_accuracy > best_accuracy:
             best_accuracy = test_accuracy
@@ -131,5 +275,19 @@ def main():
     print(f"Model saved to: {WEIGHTS_DIR}/model_best.pth")
     print("="*50)
 
+    if pruning:
+        print("\nAccuracy vs tiles eliminated (training):")
+        print(f"  {'epoch':>5} {'tiles':>7} {'accuracy':>9}")
+        for epoch, eliminated, accuracy in history:
+            print(f"  {epoch:>5} {eliminated:>7} {accuracy:>8.2f}%")
+
+        #post-training sweep on the final model
+        final_sparsity = max(targets.values())
+        levels = sorted(set([round(x, 2) for x in np.linspace(0.0, 0.9, 10)] + [final_sparsity]))
+        print("\nAccuracy vs tiles eliminated (magnitude sweep of final model):")
+        print(f"  {'level':>5} {'tiles':>11} {'accuracy':>9}")
+        for level, eliminated, total, accuracy in tile_sparsity_curve(model, test_loader, levels):
+            print(f"  {level:>5.2f} {eliminated:>5}/{total:<5} {accuracy:>8.2f}%")
+
 if __name__ == "__main__":
     main()
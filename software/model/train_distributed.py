@@ -0,0 +1,283 @@
+import torch
+import torch.nn as nn
+import torch.optim as optim
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data import DataLoader
+from torch.utils.data.distributed import DistributedSampler
+import numpy as np
+import os
+import socket
+import sys
+import time
+from train import load_datasets, create_model, evaluate, qat_layers, parse_tile_sparsity, tile_counts
+
+#data-parallel QAT training over torch.distributed (gloo, localhost, CPU only)
+#
+#every rank builds the same model from the same seed and DistributedDataParallel
+#broadcasts rank 0's parameters and buffers once more at wrap time. each rank
+#trains on its DistributedSampler shard with batch_size / world_size samples per
+#step; DDP averages the gradients of every parameter (weights and the learned
+#QATLinear scales) so the global step equals a single-process step on the whole
+#batch and the identical Adam updates keep all replicas in sync. tile pruning
+#runs on every rank from identical weights (DDP also re-broadcasts the tile_mask
+#buffers from rank 0 on every forward). only rank 0 evaluates, prints and writes
+#checkpoints, saved from the unwrapped model so they load like train.py's
+
+
+#unused localhost port for the process group rendezvous
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+#largest absolute difference of any parameter from rank 0's copy (0.0 when in sync)
+def replica_drift(model):
+    flat = torch.cat([p.detach().flatten() for p in model.parameters()])
+    reference = flat.clone()
+    dist.broadcast(reference, src=0)
+    drift = (flat - reference).abs().max()
+    dist.all_reduce(drift, op=dist.ReduceOp.MAX)
+    return drift.item()
+
+
+#one epoch on this rank's shard, returns (loss, accuracy, samples, seconds) over all ranks
+#max_batches stops the epoch early (scaling benchmark)
+def train_epoch(ddp_model, train_loader, criterion, optimizer, epoch, rank, penalty=None, max_batches=None):
+    ddp_model.train()
+    stats = torch.zeros(3, dtype=torch.float64)
+    batches = min(len(train_loader), max_batches or len(train_loader))
+
+    dist.barrier()
+    start = time.perf_counter()
+    for batch_i, (images, labels) in enumerate(train_loader):
+        if batch_i >= batches:
+            break
+
+        optimizer.zero_grad()
+        outputs = ddp_model(images)
+        loss = criterion(outputs, labels)
+        if penalty is not None:
+            loss = loss + penalty(ddp_model.module)
+
+        #gradients are all-reduced (averaged) across ranks inside backward
+        loss.backward()
+        optimizer.step()
+
+        stats[0] += loss.item()
+        stats[1] += (outputs.argmax(dim=1) == labels).sum().item()
+        stats[2] += labels.size(0)
+
+        if rank == 0 and batch_i % 200 == 0:
+            print(f'  Batch {batch_i}/{batches}, Loss: {loss.item():.4f}')
+    dist.barrier()
+    seconds = time.perf_counter() - start
+
+    dist.all_reduce(stats)
+    world_size = dist.get_world_size()
+    avg_loss = stats[0].item() / (batches * world_size)
+    accuracy = 100.0 * stats[1].item() / stats[2].item()
+    if rank == 0:
+        print(f'Epoch {epoch}: Train Loss = {avg_loss:.4f}, Train Accuracy = {accuracy:.2f}% '
+              f'({int(stats[2].item())} samples in {seconds:.2f} s)')
+    return avg_loss, accuracy, int(stats[2].item()), seconds
+
+
+#body of one rank; rank 0 puts its result dict on results
+def run_worker(rank, world_size, port, args, results):
+    threads = args.threads or max(1, (os.cpu_count() or 1) // world_size)
+    torch.set_num_threads(threads)
+    dist.init_process_group('gloo', init_method=f'tcp://127.0.0.1:{port}', rank=rank, world_size=world_size)
+    try:
+        result = train(rank, world_size, args)
+        if rank == 0:
+            result['threads'] = threads
+            results.put(result)
+    finally:
+        dist.destroy_process_group()
+
+
+def train(rank, world_size, args):
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    weights_dir = args.weights or os.path.join(script_dir, 'weights')
+
+    data_dir = args.data or os.path.join(script_dir, '..', 'data')
+    if rank == 0:
+        print(f"Loading data from {data_dir} ({world_size} workers)...")
+    train_dataset, test_dataset = load_datasets(data_dir, prequantize=not args.float_inputs)
+    sampler = DistributedSampler(train_dataset, num_replicas=world_size, rank=rank, shuffle=True, seed=args.seed)
+    train_loader = DataLoader(train_dataset, batch_size=args.batch_size // world_size, sampler=sampler)
+    test_loader = DataLoader(test_dataset, batch_size=1000, shuffle=False)
+
+    torch.manual_seed(args.seed)
+    model = create_model(args.arch, args.channels, args.tile_size)
+    ddp_model = DistributedDataParallel(model)
+
+    pruning = args.prune != 'none'
+    targets = parse_tile_sparsity(args.tile_sparsity, model) if pruning else {}
+    penalty = None
+    if args.prune == 'group_lasso':
+        penalty = lambda m: args.lasso_weight * sum(layer.group_lasso() for _, layer in qat_layers(m))
+
+    criterion = nn.CrossEntropyLoss()
+    optimizer = optim.Adam(ddp_model.parameters(), lr=args.lr)
+
+    save = rank == 0 and not args.no_save
+    if save:
+        os.makedirs(weights_dir, exist_ok=True)
+
+    best_accuracy = 0.0
+    epoch_seconds = []
+    drift = 0.0
+    for epoch in range(1, args.epochs + 1):
+        #reshuffle the shards every epoch (same permutation on every rank)
+        sampler.set_epoch(epoch)
+        train_loss, _, samples, seconds = train_epoch(ddp_model, train_loader, criterion, optimizer, epoch, rank,
+                                             penalty, args.max_batches)
+        epoch_seconds.append(seconds)
+
+        if pruning:
+            ramp = min(1.0, epoch / max(args.prune_epochs, 1))
+            for name, layer in qat_layers(model):
+                layer.prune_tiles(targets[name] * ramp)
+
+        drift = max(drift, replica_drift(model))
+
+        if rank == 0:
+            test_accuracy = evaluate(model, test_loader)
+            total_tiles, eliminated = tile_counts(model)
+            scales = ", ".join(f"{name} {layer.scale.item():.4f}" for name, layer in qat_layers(model))
+            print(f'Epoch {epoch}: Test Accuracy = {test_accuracy:.2f}%'
+                  + (f', tiles eliminated {eliminated}/{total_tiles}' if pruning else '')
+                  + f'\n  scales: {scales}, replica drift {drift:.3g}\n')
+
+            #only models at the full target sparsity count as best
+            if not (pruning and epoch < args.prune_epochs) and test_accuracy > best_accuracy:
+                best_accuracy = test_accuracy
+                if save:
+                    torch.save(model.state_dict(), f'{weights_dir}/model_best.pth')
+                    print(f'New best model saved! (accuracy: {best_accuracy:.2f}%)')
+        #other ranks wait for rank 0's evaluation and checkpoint
+        dist.barrier()
+
+    if save:
+        torch.save(model.state_dict(), f'{weights_dir}/model_final.pth')
+
+    return {
+        'workers': world_size,
+        'epoch_seconds': epoch_seconds,
+        'samples_per_epoch': samples,
+        'final_loss': train_loss,
+        'best_accuracy': best_accuracy,
+        'drift': drift,
+        'weights_dir': weights_dir,
+    }
+
+
+#spawn world_size ranks and return rank 0's result
+def launch(world_size, args):
+    context = mp.get_context('spawn')
+    results = context.SimpleQueue()
+    mp.spawn(run_worker, args=(world_size, free_port(), args, results), nprocs=world_size, join=True)
+    return results.get()
+
+
+#time the same (shortened) training at each worker count
+#speedups are against a measured 1-worker run, which is added when counts has none
+def scaling_benchmark(counts, args):
+    counts = sorted(set(counts) | {1})
+    print(f"\nScaling benchmark: global batch {args.batch_size}, {args.epochs} epoch(s)"
+          + (f" of {args.max_batches} batches" if args.max_batches else "") + f", {os.cpu_count()} cores")
+    runs = []
+    for workers in counts:
+        print(f"\n--- {workers} worker(s) ---")
+        runs.append(launch(workers, args))
+
+    #first epoch is skipped when there are more (process and allocator warm-up)
+    def epoch_time(run):
+        times = run['epoch_seconds'][1:] or run['epoch_seconds']
+        return sum(times) / len(times)
+
+    base = epoch_time(runs[0])
+    print("\n" + "=" * 60)
+    print("SCALING")
+    print("=" * 60)
+    print(f"  {'workers':>7} {'threads':>7} {'s/epoch':>8} {'samples/s':>10} {'speedup':>8} {'efficiency':>10} "
+          f"{'loss':>7} {'drift':>8}")
+    for run in runs:
+        seconds = epoch_time(run)
+        speedup = base / seconds
+        print(f"  {run['workers']:>7} {run['threads']:>7} {seconds:>8.2f} {run['samples_per_epoch'] / seconds:>10.0f} "
+              f"{speedup:>7.2f}x {100 * speedup / run['workers']:>9.1f}% {run['final_loss']:>7.4f} "
+              f"{run['drift']:>8.2g}")
+    print("=" * 60)
+    return runs
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='uTPU data-parallel QAT training (torch.distributed, gloo)')
+    parser.add_argument('--workers', type=int, default=2, help='Training processes (ranks)')
+    parser.add_argument('--threads', type=int, default=None,
+                        help='Torch threads per worker (default: cores / workers)')
+    parser.add_argument('--scaling', type=str, default=None,
+                        help='Benchmark mode: comma-separated worker counts, e.g. 1,2,4,8 '
+                             '(a 1-worker baseline is always run, no checkpoints)')
+    parser.add_argument('--max-batches', type=int, default=None,
+                        help='Stop each epoch after this many global batches')
+    parser.add_argument('--epochs', type=int, default=50)
+    parser.add_argument('--lr', type=float, default=0.005)
+    parser.add_argument('--batch-size', type=int, default=64,
+                        help='Global batch size, split evenly across workers')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--data', type=str, default=None)
+    parser.add_argument('--weights', type=str, default=None, help='Checkpoint directory')
+    parser.add_argument('--no-save', action='store_true')
+    parser.add_argument('--prune', choices=['none', 'magnitude', 'group_lasso'], default='none')
+    parser.add_argument('--tile-sparsity', type=str, default='0.5')
+    parser.add_argument('--prune-epochs', type=int, default=10)
+    parser.add_argument('--lasso-weight', type=float, default=1e-3)
+    parser.add_argument('--tile-size', type=int, default=2)
+    parser.add_argument('--arch', choices=['mlp', 'conv'], default='mlp')
+    parser.add_argument('--channels', type=int, default=4)
+    parser.add_argument('--float-inputs', action='store_true',
+                        help='Keep float images and quantize every batch (default: int8 codes quantized once)')
+    args = parser.parse_args()
+
+    #best models are only taken at the full target sparsity (benchmarks save none)
+    if args.prune != 'none' and not args.scaling and args.epochs < args.prune_epochs:
+        print(f"Error: --epochs {args.epochs} ends before the sparsity target is reached "
+              f"(--prune-epochs {args.prune_epochs})")
+        return 1
+
+    counts = [int(w) for w in args.scaling.split(',')] if args.scaling else [args.workers]
+    for workers in counts:
+        if workers < 1 or args.batch_size % workers:
+            print(f"Error: global batch size {args.batch_size} does not split across {workers} workers")
+            return 1
+
+    print("=" * 60)
+    print("uTPU Data-Parallel QAT Training")
+    print("=" * 60)
+
+    if args.scaling:
+        args.no_save = True
+        scaling_benchmark(counts, args)
+        return 0
+
+    result = launch(args.workers, args)
+    print("\n" + "=" * 50)
+    print(f"Training complete! ({args.workers} workers, "
+          f"{np.mean(result['epoch_seconds']):.2f} s/epoch, replica drift {result['drift']:.3g})")
+    print(f"Best test accuracy: {result['best_accuracy']:.2f}%")
+    if not args.no_save:
+        print(f"Model saved to: {result['weights_dir']}/model_best.pth")
+    print("=" * 50)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())